@@ -878,7 +878,7 @@ class ElectrumWindow(App):
                 self.show_error("Invalid PIN")
                 return
         self.stop_wallet()
-        os.unlink(wallet_path)
+        WalletStorage.delete_files(wallet_path)
         self.show_error("Wallet removed:" + basename)
         d = os.listdir(dirname)
         name = 'default_wallet'
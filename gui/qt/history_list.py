@@ -68,8 +68,9 @@ class HistoryList(MyTreeWidget):
         self.update_headers(headers)
 
     def get_domain(self):
-        '''Replaced in address_dialog.py'''
-        return self.wallet.get_addresses()
+        '''Replaced in address_dialog.py.  None is the whole wallet, whose
+        history is indexed by the wallet.'''
+        return None
         
     @profiler
     def on_update(self):
@@ -249,7 +249,7 @@ class InstallWizard(QDialog, MessageBoxMixin, BaseWizard):
             file_list = '\n'.join(self.storage.split_accounts())
             msg = _('Your accounts have been moved to') + ':\n' + file_list + '\n\n'+ _('Do you want to delete the old file') + ':\n' + path
             if self.question(msg):
-                os.remove(path)
+                WalletStorage.delete_files(path)
                 self.show_warning(_('The file was removed'))
             return
 
@@ -269,7 +269,7 @@ class InstallWizard(QDialog, MessageBoxMixin, BaseWizard):
                     "Do you want to complete its creation now?").format(path)
             if not self.question(msg):
                 if self.question(_("Do you want to delete '{}'?").format(path)):
-                    os.remove(path)
+                    WalletStorage.delete_files(path)
                     self.show_warning(_('The file was removed'))
                 return
             self.show()
@@ -53,6 +53,7 @@ import electroncash.web as web
 from electroncash import Transaction
 from electroncash import util, bitcoin, commands
 from electroncash import paymentrequest
+from electroncash.storage import WalletStorage
 from electroncash.wallet import Multisig_Wallet, sweep_preparations
 try:
     from electroncash.plot import plot_history
@@ -439,16 +440,7 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
         new_path = os.path.join(wallet_folder, filename)
         if new_path != path:
             try:
-                # Copy file contents
-                shutil.copyfile(path, new_path)
-
-                # Copy file attributes if possible
-                # (not supported on targets like Flatpak documents)
-                try:
-                    shutil.copystat(path, new_path)
-                except (IOError, os.error):
-                    pass
-
+                self.wallet.storage.backup(new_path)
                 self.show_message(_("A copy of your wallet file was created in")+" '%s'" % str(new_path), title=_("Wallet backup created"))
             except (IOError, os.error) as reason:
                 self.show_critical(_("Electron Cash was unable to copy your wallet file to the specified location.") + "\n" + str(reason), title=_("Unable to create backup"))
@@ -2134,7 +2126,7 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
         basename = os.path.basename(wallet_path)
         self.gui_object.daemon.stop_wallet(wallet_path)
         self.close()
-        os.unlink(wallet_path)
+        WalletStorage.delete_files(wallet_path)
         self.update_recently_visited(wallet_path) # this ensures it's deleted from the menu
         self.show_error("Wallet removed:" + basename)
 
@@ -1727,7 +1727,7 @@ class ElectrumGui(PrintError):
                 self.daemon.stop_wallet(self.wallet.storage.path)
                 self.wallet = None
 
-            os.rename(info.full_path, new_path)
+            WalletStorage.rename_files(info.full_path, new_path)
             oldEncPw = self.encPasswords.get(info.name)
             if oldEncPw:
                 self.encPasswords.set(newName, oldEncPw, save = False) # migrate encrypted password to new name if present
@@ -9,6 +9,7 @@ from . import gui
 from . import history
 from . import newwallet
 from electroncash.i18n import _, language
+from electroncash import WalletStorage
 
 from .uikit_bindings import *
 from .custom_objc import *
@@ -595,7 +596,7 @@ def _ShowOptionsForWalletAtIndex(index : int, vc : UIViewController, ipadAnchor
                 txt = str(tf.text).lower().strip()
                 if txt == 'delete' or txt == _("delete"): # support i18n
                     try:
-                        os.remove(info.full_path)
+                        WalletStorage.delete_files(info.full_path)
                         parent.set_wallet_use_touchid(info.name, None, clear_asked = True) # clear cached password if any
                         parent.refresh_components('wallets')
                         utils.show_notification(message = _("Wallet deleted successfully"))
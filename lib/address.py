@@ -506,17 +506,19 @@ def _match_ops(ops, pattern):
 
 class Script(object):
 
+    # Built once, enum lookups are slow and outputs are scripted often
+    P2SH_PREFIX = bytes([OpCodes.OP_HASH160])
+    P2SH_SUFFIX = bytes([OpCodes.OP_EQUAL])
+    P2PKH_PREFIX = bytes([OpCodes.OP_DUP, OpCodes.OP_HASH160])
+    P2PKH_SUFFIX = bytes([OpCodes.OP_EQUALVERIFY, OpCodes.OP_CHECKSIG])
+
     @classmethod
     def P2SH_script(cls, hash160):
-        return (bytes([OpCodes.OP_HASH160])
-                + cls.push_data(hash160)
-                + bytes([OpCodes.OP_EQUAL]))
+        return cls.P2SH_PREFIX + cls.push_data(hash160) + cls.P2SH_SUFFIX
 
     @classmethod
     def P2PKH_script(cls, hash160):
-        return (bytes([OpCodes.OP_DUP, OpCodes.OP_HASH160])
-                + cls.push_data(hash160)
-                + bytes([OpCodes.OP_EQUALVERIFY, OpCodes.OP_CHECKSIG]))
+        return cls.P2PKH_PREFIX + cls.push_data(hash160) + cls.P2PKH_SUFFIX
 
     @classmethod
     def P2PK_script(cls, pubkey):
@@ -36,7 +36,7 @@ from .networks import NetworkConstants
 from .util import (bfh, bh2u, to_string, print_error, InvalidPassword,
                    assert_bytes, to_bytes, inv_dict)
 from . import version
-from .ecc_fast import do_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1
+from .ecc_fast import do_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1, pubkey_tweak_add
 
 do_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1()
 
@@ -737,6 +737,9 @@ def CKD_pub(cK, c, n):
 def _CKD_pub(cK, c, s):
     order = generator_secp256k1.order()
     I = hmac.new(c, cK + s, hashlib.sha512).digest()
+    cK_n = pubkey_tweak_add(cK, I[0:32])
+    if cK_n is not None:
+        return cK_n, I[32:]
     curve = SECP256k1
     pubkey_point = string_to_number(I[0:32])*curve.generator + ser_to_point(cK)
     public_key = ecdsa.VerifyingKey.from_public_point( pubkey_point, curve = SECP256k1 )
@@ -744,6 +747,22 @@ def _CKD_pub(cK, c, s):
     cK_n = GetPubKey(public_key.pubkey,True)
     return cK_n, c_n
 
+def CKD_pub_range(cK, c, n, count):
+    '''Return the public keys of the children n to n+count-1 of (cK, c),
+    as CKD_pub() would, parsing the parent key only once.'''
+    children = []
+    parent_point = None
+    for i in range(n, n + count):
+        if i & BIP32_PRIME: raise
+        I = hmac.new(c, cK + i.to_bytes(4, 'big'), hashlib.sha512).digest()
+        cK_n = pubkey_tweak_add(cK, I[0:32])
+        if cK_n is None:
+            if parent_point is None:
+                parent_point = ser_to_point(cK)
+            cK_n = point_to_ser(string_to_number(I[0:32])*SECP256k1.generator + parent_point, True)
+        children.append(cK_n)
+    return children
+
 
 def xprv_header(xtype):
     return bfh("%08x" % NetworkConstants.XPRV_HEADERS[xtype])
@@ -24,6 +24,8 @@
 import os
 import sys
 import threading
+import mmap
+from collections import OrderedDict
 
 
 from . import util
@@ -74,6 +76,7 @@ def target_to_bits(target):
     return compact | size << 24
 
 HEADER_SIZE = 80 # bytes
+HEADER_CACHE_SIZE = 2048 # deserialized headers kept per Blockchain
 MAX_BITS = 0x1d00ffff
 MAX_TARGET = bits_to_target(MAX_BITS)
 
@@ -105,6 +108,13 @@ def hash_header(header):
         header['prev_block_hash'] = '00'*32
     return hash_encode(Hash(bfh(serialize_header(header))))
 
+def hash_headers(data):
+    '''Return the hashes of the serialized headers in data, as hash_header()
+    would.  This is the part of verify_chunk() that needs no other headers,
+    so it can be done ahead of it, e.g. in another process.'''
+    return [hash_encode(Hash(data[i:i + HEADER_SIZE]))
+            for i in range(0, len(data) - HEADER_SIZE + 1, HEADER_SIZE)]
+
 
 blockchains = {}
 
@@ -190,6 +200,40 @@ class HeaderChunk:
         header_offset = index * HEADER_SIZE
         return self.data[header_offset:header_offset + HEADER_SIZE]
 
+class HeaderWindow:
+    '''Timestamp, bits and cumulative work of the most recent headers of a
+    run of consecutive headers.  Carried forward one header at a time
+    while headers are verified, it lets get_bits() find the medians and
+    the work of its 144 block window in constant time.'''
+
+    # get_bits(h) looks as far back as h - 147
+    SIZE = 147
+
+    def __init__(self, headers=()):
+        self.entries = {}  # height -> (timestamp, bits, cumulative work)
+        self.top = None
+        for header in headers:
+            self.append(header)
+
+    def copy(self):
+        window = HeaderWindow()
+        window.entries = self.entries.copy()
+        window.top = self.top
+        return window
+
+    def append(self, header):
+        height = header['block_height']
+        if self.top is not None and height != self.top + 1:
+            self.entries.clear()
+        prev = self.entries.get(height - 1)
+        work = (prev[2] if prev else 0) + bits_to_work(header['bits'])
+        self.entries[height] = (header['timestamp'], header['bits'], work)
+        self.entries.pop(height - self.SIZE, None)
+        self.top = height
+
+    def get(self, height):
+        return self.entries.get(height)
+
 class Blockchain(util.PrintError):
     """
     Manages blockchain headers and their verification
@@ -202,6 +246,12 @@ class Blockchain(util.PrintError):
         self.parent_base_height = parent_base_height
 
         self.lock = threading.Lock()
+        # read-only map of the headers file, see _get_mmap()
+        self._mmap = None
+        # height -> deserialized header, most recently used last
+        self._header_cache = OrderedDict()
+        # HeaderWindow ending at the tip, see _get_window()
+        self._window = None
         with self.lock:
             self.update_size()
 
@@ -251,40 +301,72 @@ class Blockchain(util.PrintError):
         p = self.path()
         self._size = os.path.getsize(p)//HEADER_SIZE if os.path.exists(p) else 0
 
-    def verify_header(self, header, prev_header, bits=None):
-        prev_header_hash = hash_header(prev_header)
-        this_header_hash = hash_header(header)
+    def verify_header(self, header, prev_header, bits=None, header_hash=None, prev_header_hash=None):
+        '''Check header against prev_header and, if given, the expected bits.
+        The hashes of both can be passed in when already known.  Returns
+        the hash of header.'''
+        if prev_header_hash is None:
+            prev_header_hash = hash_header(prev_header)
+        this_header_hash = header_hash or hash_header(header)
         if prev_header_hash != header.get('prev_block_hash'):
             raise VerifyError("prev hash mismatch: %s vs %s" % (prev_header_hash, header.get('prev_block_hash')))
 
         # We do not need to check the block difficulty if the chain of linked header hashes was proven correct against our checkpoint.
         if bits is not None:
             # checkpoint BitcoinCash fork block
-            if (header.get('block_height') == NetworkConstants.BITCOIN_CASH_FORK_BLOCK_HEIGHT and hash_header(header) != NetworkConstants.BITCOIN_CASH_FORK_BLOCK_HASH):
-                err_str = "block at height %i is not cash chain fork block. hash %s" % (header.get('block_height'), hash_header(header))
+            if (header.get('block_height') == NetworkConstants.BITCOIN_CASH_FORK_BLOCK_HEIGHT and this_header_hash != NetworkConstants.BITCOIN_CASH_FORK_BLOCK_HASH):
+                err_str = "block at height %i is not cash chain fork block. hash %s" % (header.get('block_height'), this_header_hash)
                 raise VerifyError(err_str)
             if bits != header.get('bits'):
                 raise VerifyError("bits mismatch: %s vs %s" % (bits, header.get('bits')))
             target = bits_to_target(bits)
             if int('0x' + this_header_hash, 16) > target:
                 raise VerifyError("insufficient proof of work: %s vs target %s" % (int('0x' + this_header_hash, 16), target))
+        return this_header_hash
 
-    def verify_chunk(self, chunk_base_height, chunk_data):
+    def verify_chunk(self, chunk_base_height, chunk_data, hashes=None):
+        '''hashes, the result of hash_headers(chunk_data), may be passed in
+        when computed ahead.'''
         chunk = HeaderChunk(chunk_base_height, chunk_data)
+        if hashes is None:
+            hashes = hash_headers(chunk_data)
 
         prev_header = None
         if chunk_base_height != 0:
             prev_header = self.read_header(chunk_base_height - 1)
+        # the chunk is not saved yet, so extend a copy of the window
+        window = self._get_window(chunk_base_height - 1).copy()
 
         header_count = len(chunk_data) // HEADER_SIZE
+        if len(hashes) != header_count:
+            raise VerifyError("expected %d header hashes, got %d" % (header_count, len(hashes)))
+        prev_header_hash = None
         for i in range(header_count):
             raw_header = chunk.get_header_at_index(i)
             header = deserialize_header(raw_header, chunk_base_height + i)
             # Check the chain of hashes and the difficulty.
-            bits = self.get_bits(header, chunk)
-            self.verify_header(header, prev_header, bits)
+            bits = self.get_bits(header, chunk, window)
+            prev_header_hash = self.verify_header(header, prev_header, bits, hashes[i], prev_header_hash)
+            window.append(header)
             prev_header = header
 
+    def _get_window(self, top):
+        '''Return the HeaderWindow of the stored headers up to height top.
+        The window of the tip is kept and extended by save_header(), so a
+        catch up run only reads the headers once.'''
+        window = self._window
+        if window is not None and window.top == top:
+            return window
+        headers = []
+        for height in range(top, max(top - HeaderWindow.SIZE, -1), -1):
+            header = self.read_header(height)
+            if header is None:
+                break
+            headers.append(header)
+        window = HeaderWindow(reversed(headers))
+        self._window = window
+        return window
+
     def path(self):
         d = util.get_headers_dir(self.config)
         filename = 'blockchain_headers' if self.parent_base_height is None else os.path.join('forks', 'fork_%d_%d'%(self.parent_base_height, self.base_height))
@@ -326,19 +408,51 @@ class Blockchain(util.PrintError):
         self.parent_base_height = parent.parent_base_height; parent.parent_base_height = parent_base_height
         self.base_height = parent.base_height; parent.base_height = base_height
         self._size = parent._size; parent._size = parent_branch_size
+        # heights moved between the two branches
+        for b in (self, parent):
+            with b.lock:
+                b._header_cache.clear()
+                b._window = None
         # move files
         for b in blockchains.values():
             if b in [self, parent]: continue
             if b.old_path != b.path():
                 self.print_error("renaming", b.old_path, b.path())
-                os.rename(b.old_path, b.path())
+                with b.lock:
+                    # Windows cannot rename a mapped file
+                    b._close_mmap()
+                    os.rename(b.old_path, b.path())
         # update pointers
         blockchains[self.base_height] = self
         blockchains[parent.base_height] = parent
 
+    def _close_mmap(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _get_mmap(self):
+        '''Map the headers file on first use after a write.  Call with
+        self.lock held.'''
+        if self._mmap is None and self._size:
+            with open(self.path(), 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
     def write(self, data, offset, truncate=True):
         filename = self.path()
         with self.lock:
+            # The map is dropped before writing, as a mapped file cannot be
+            # truncated on Windows, and recreated at the new size on the
+            # next read.
+            self._close_mmap()
+            first_height = self.base_height + offset // HEADER_SIZE
+            for height in [h for h in self._header_cache if h >= first_height]:
+                del self._header_cache[height]
+            # forks see these heights through their parent
+            for b in set(blockchains.values()) | {self}:
+                if b._window is not None and b._window.top >= first_height:
+                    b._window = None
             with open(filename, 'rb+') as f:
                 if truncate and offset != self._size*HEADER_SIZE:
                     f.seek(offset)
@@ -355,6 +469,9 @@ class Blockchain(util.PrintError):
         assert delta == self.size()
         assert len(data) == HEADER_SIZE
         self.write(data, delta*HEADER_SIZE)
+        window = self._window
+        if window is not None and window.top == header['block_height'] - 1:
+            window.append(header)
         self.swap_with_parent()
 
     def read_header(self, height, chunk=None):
@@ -370,16 +487,24 @@ class Blockchain(util.PrintError):
             return self.parent().read_header(height)
         if height > self.height():
             return
-        delta = height - self.base_height
-        name = self.path()
-        if os.path.exists(name):
-            with open(name, 'rb') as f:
-                f.seek(delta * HEADER_SIZE)
-                h = f.read(HEADER_SIZE)
+        with self.lock:
+            header = self._header_cache.get(height)
+            if header is not None:
+                self._header_cache.move_to_end(height)
+                return header
+            m = self._get_mmap()
+            if m is None:
+                return
+            delta = height - self.base_height
+            h = m[delta * HEADER_SIZE:(delta + 1) * HEADER_SIZE]
             # Is it a pre-checkpoint header that has never been requested?
-            if h == bytes([0])*HEADER_SIZE:
+            if len(h) < HEADER_SIZE or h == bytes(HEADER_SIZE):
                 return None
-            return deserialize_header(h, height)
+            header = deserialize_header(h, height)
+            self._header_cache[height] = header
+            if len(self._header_cache) > HEADER_CACHE_SIZE:
+                self._header_cache.popitem(last=False)
+            return header
 
     def get_hash(self, height):
         if height == -1:
@@ -393,34 +518,42 @@ class Blockchain(util.PrintError):
         v = self.read_header(height)['version']
         return ((v & 0xE0000000) == 0x20000000) and ((v & flag) == flag)
 
-    def get_median_time_past(self, height, chunk=None):
+    def _get_timestamp(self, height, chunk=None, window=None):
+        entry = window.get(height) if window is not None else None
+        if entry is not None:
+            return entry[0]
+        return self.read_header(height, chunk)['timestamp']
+
+    def get_median_time_past(self, height, chunk=None, window=None):
         if height < 0:
             return 0
         times = [
-            self.read_header(h, chunk)['timestamp']
+            self._get_timestamp(h, chunk, window)
             for h in range(max(0, height - 10), height + 1)
         ]
         return sorted(times)[len(times) // 2]
 
-    def get_suitable_block_height(self, suitableheight, chunk=None):
+    def get_suitable_block_height(self, suitableheight, chunk=None, window=None):
         #In order to avoid a block in a very skewed timestamp to have too much
         #influence, we select the median of the 3 top most block as a start point
         #Reference: github.com/Bitcoin-ABC/bitcoin-abc/master/src/pow.cpp#L201
-        blocks2 = self.read_header(suitableheight, chunk)
-        blocks1 = self.read_header(suitableheight-1, chunk)
-        blocks = self.read_header(suitableheight-2, chunk)
+        # (timestamp, height) of each block
+        blocks2 = (self._get_timestamp(suitableheight, chunk, window), suitableheight)
+        blocks1 = (self._get_timestamp(suitableheight-1, chunk, window), suitableheight-1)
+        blocks = (self._get_timestamp(suitableheight-2, chunk, window), suitableheight-2)
 
-        if (blocks['timestamp'] > blocks2['timestamp'] ):
+        if (blocks[0] > blocks2[0] ):
             blocks,blocks2 = blocks2,blocks
-        if (blocks['timestamp'] > blocks1['timestamp'] ):
+        if (blocks[0] > blocks1[0] ):
             blocks,blocks1 = blocks1,blocks
-        if (blocks1['timestamp'] > blocks2['timestamp'] ):
+        if (blocks1[0] > blocks2[0] ):
             blocks1,blocks2 = blocks2,blocks1
 
-        return blocks1['block_height']
+        return blocks1[1]
 
-    def get_bits(self, header, chunk=None):
-        '''Return bits for the given height.'''
+    def get_bits(self, header, chunk=None, window=None):
+        '''Return bits for the given height.  window, a HeaderWindow ending
+        at the previous header, is optional and only saves work.'''
         # Difficulty adjustment interval?
         height = header['block_height']
         # Genesis
@@ -435,7 +568,7 @@ class Blockchain(util.PrintError):
         #NOV 13 HF DAA
 
         prevheight = height -1
-        daa_mtp = self.get_median_time_past(prevheight, chunk)
+        daa_mtp = self.get_median_time_past(prevheight, chunk, window)
 
         #if (daa_mtp >= 1509559291):  #leave this here for testing
         if (daa_mtp >= 1510600000):
@@ -446,20 +579,25 @@ class Blockchain(util.PrintError):
                     return MAX_BITS
 
             # determine block range
-            daa_starting_height = self.get_suitable_block_height(prevheight-144, chunk)
-            daa_ending_height = self.get_suitable_block_height(prevheight, chunk)
+            daa_starting_height = self.get_suitable_block_height(prevheight-144, chunk, window)
+            daa_ending_height = self.get_suitable_block_height(prevheight, chunk, window)
 
             # calculate cumulative work (EXcluding work from block daa_starting_height, INcluding work from block daa_ending_height)
-            daa_cumulative_work = 0
-            for daa_i in range (daa_starting_height+1, daa_ending_height+1):
-                daa_prior = self.read_header(daa_i, chunk)
-                daa_bits_for_a_block = daa_prior['bits']
-                daa_work_for_a_block = bits_to_work(daa_bits_for_a_block)
-                daa_cumulative_work += daa_work_for_a_block
+            start = window.get(daa_starting_height) if window is not None else None
+            end = window.get(daa_ending_height) if window is not None else None
+            if start is not None and end is not None:
+                daa_cumulative_work = end[2] - start[2]
+            else:
+                daa_cumulative_work = 0
+                for daa_i in range (daa_starting_height+1, daa_ending_height+1):
+                    daa_prior = self.read_header(daa_i, chunk)
+                    daa_bits_for_a_block = daa_prior['bits']
+                    daa_work_for_a_block = bits_to_work(daa_bits_for_a_block)
+                    daa_cumulative_work += daa_work_for_a_block
 
             # calculate and sanitize elapsed time
-            daa_starting_timestamp = self.read_header(daa_starting_height, chunk)['timestamp']
-            daa_ending_timestamp = self.read_header(daa_ending_height, chunk)['timestamp']
+            daa_starting_timestamp = self._get_timestamp(daa_starting_height, chunk, window)
+            daa_ending_timestamp = self._get_timestamp(daa_ending_height, chunk, window)
             daa_elapsed_time = daa_ending_timestamp - daa_starting_timestamp
             if (daa_elapsed_time>172800):
                 daa_elapsed_time=172800
@@ -488,7 +626,7 @@ class Blockchain(util.PrintError):
         # Can't go below minimum, so early bail
         if bits == MAX_BITS:
             return bits
-        mtp_6blocks = self.get_median_time_past(height - 1, chunk) - self.get_median_time_past(height - 7, chunk)
+        mtp_6blocks = self.get_median_time_past(height - 1, chunk, window) - self.get_median_time_past(height - 7, chunk, window)
         if mtp_6blocks < 12 * 3600:
             return bits
 
@@ -526,7 +664,7 @@ class Blockchain(util.PrintError):
         prev_hash = hash_header(previous_header)
         if prev_hash != header.get('prev_block_hash'):
             return False
-        bits = self.get_bits(header)
+        bits = self.get_bits(header, window=self._get_window(height - 1))
         try:
             self.verify_header(header, previous_header, bits)
         except VerifyError as e:
@@ -535,7 +673,7 @@ class Blockchain(util.PrintError):
             return False
         return True
 
-    def connect_chunk(self, base_height, hexdata, proof_was_provided=False):
+    def connect_chunk(self, base_height, hexdata, proof_was_provided=False, hashes=None):
         chunk = HeaderChunk(base_height, hexdata)
 
         header_count = len(hexdata) // HEADER_SIZE
@@ -577,7 +715,7 @@ class Blockchain(util.PrintError):
 
         try:
             if not proof_was_provided:
-                self.verify_chunk(base_height, hexdata)
+                self.verify_chunk(base_height, hexdata, hashes)
             self.save_chunk(base_height, hexdata)
             return CHUNK_ACCEPTED
         except VerifyError as e:
@@ -22,7 +22,9 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import time
 from collections import defaultdict, namedtuple
+from itertools import accumulate
 from math import floor, log10
 
 from .bitcoin import sha256, COIN, TYPE_ADDRESS
@@ -79,11 +81,33 @@ def strip_unneeded(bkts, sufficient_funds):
     # Shouldn't get here
     return bkts
 
+def input_size_key(coin):
+    '''The estimated size of a signed input only depends on these, except
+    for inputs whose script is given as is.'''
+    if coin['type'] not in ('p2pkh', 'p2sh', 'p2pk'):
+        return None
+    return (coin['type'], coin.get('num_sig', 1),
+            len(coin.get('x_pubkeys', [None])),
+            Transaction.estimate_pubkey_size_for_txin(coin))
+
+
 class CoinChooserBase(PrintError):
 
+    # Estimated input sizes by input_size_key(), shared by all choosers
+    input_sizes = {}
+
     def keys(self, coins):
         raise NotImplementedError
 
+    def estimated_input_size(self, coin):
+        key = input_size_key(coin)
+        if key is None:
+            return Transaction.estimated_input_size(coin)
+        size = self.input_sizes.get(key)
+        if size is None:
+            size = self.input_sizes[key] = Transaction.estimated_input_size(coin)
+        return size
+
     def bucketize_coins(self, coins):
         keys = self.keys(coins)
         buckets = defaultdict(list)
@@ -91,7 +115,7 @@ class CoinChooserBase(PrintError):
             buckets[key].append(coin)
 
         def make_Bucket(desc, coins):
-            size = sum(Transaction.estimated_input_size(coin)
+            size = sum(self.estimated_input_size(coin)
                        for coin in coins)
             value = sum(coin['value'] for coin in coins)
             return Bucket(desc, size, value, coins)
@@ -181,6 +205,11 @@ class CoinChooserBase(PrintError):
         # Size of the transaction with no inputs and no change
         base_size = tx.estimated_size()
         spent_amount = tx.output_value()
+        # For choosers working on totals rather than lists of buckets
+        self.base_size = base_size
+        self.spent_amount = spent_amount
+        self.fee_estimator = fee_estimator
+        self.dust_threshold = dust_threshold
 
         def sufficient_funds(buckets):
             '''Given a list of buckets, return True if it has enough
@@ -284,8 +313,142 @@ class CoinChooserPrivacy(CoinChooserRandom):
         return penalty
 
 
+class CoinChooserBranchAndBound(CoinChooserPrivacy):
+    '''Looks first for buckets paying for the transaction with no change
+    output, that is with an excess over the amount and fee smaller than
+    the cost of a change output plus the dust threshold, which would be
+    added to the fee anyway.  A depth first search over the buckets by
+    decreasing value, pruned with suffix sums, keeps the set with the
+    least excess found within time_budget seconds.
+
+    If there is none, buckets are chosen as by CoinChooserPrivacy, keeping
+    running totals rather than summing every prefix again, so that wallets
+    with many coins are handled in linear time.'''
+
+    # Seconds the search may take, and the most steps it may take
+    time_budget = 0.25
+    max_tries = 100000
+
+    def sufficient_totals(self, value, size):
+        return value >= self.spent_amount + self.fee_estimator(self.base_size + size)
+
+    def fee_rate(self):
+        '''Fee per byte added to the transaction, in satoshis.'''
+        n = 100000
+        return (self.fee_estimator(self.base_size + n)
+                - self.fee_estimator(self.base_size)) / n
+
+    def branch_and_bound(self, buckets):
+        '''Returns the buckets paying for the transaction without change
+        with the least excess found, or None.'''
+        rate = self.fee_rate()
+        target = self.spent_amount + self.fee_estimator(self.base_size)
+        # Change of less than this would not be kept
+        window = rate * 34 + self.dust_threshold
+        # The value of a bucket net of the fee to spend it
+        candidates = [(bucket.value - bucket.size * rate, bucket)
+                      for bucket in buckets]
+        candidates = sorted((c for c in candidates if c[0] > 0),
+                            key=lambda c: c[0], reverse=True)
+        values = [value for value, bucket in candidates]
+        n = len(values)
+        # remaining[i] is the value of candidates i and after
+        remaining = list(accumulate(reversed(values)))[::-1] + [0]
+        if not n or remaining[0] < target:
+            return None
+
+        best, best_excess = None, window
+        selected = []
+        total = 0
+        i = 0
+        deadline = time.time() + self.time_budget
+        for tries in range(self.max_tries):
+            if total + remaining[i] < target or total - target >= best_excess:
+                backtrack = True
+            elif total >= target:
+                best, best_excess = list(selected), total - target
+                if not best_excess:
+                    break
+                backtrack = True
+            else:
+                backtrack = False
+            if backtrack:
+                if not selected:
+                    break
+                # Leave out the last bucket taken, and the ones of the
+                # same value after it, which would give the same totals
+                j = selected.pop()
+                total -= values[j]
+                i = j + 1
+                while i < n and values[i] == values[j]:
+                    i += 1
+            else:
+                selected.append(i)
+                total += values[i]
+                i += 1
+            if not tries % 1000 and time.time() > deadline:
+                break
+        self.print_error("branch and bound: {} steps, excess {}"
+                         .format(tries + 1, best_excess if best else None))
+        if best is None:
+            return None
+        return [candidates[j][1] for j in best]
+
+    def strip_unneeded(self, bkts):
+        '''strip_unneeded() with suffix sums.'''
+        bkts = sorted(bkts, key=lambda bkt: bkt.value)
+        values = list(accumulate(bkt.value for bkt in reversed(bkts)))[::-1] + [0]
+        sizes = list(accumulate(bkt.size for bkt in reversed(bkts)))[::-1] + [0]
+        for i in range(len(bkts)):
+            if not self.sufficient_totals(values[i + 1], sizes[i + 1]):
+                return bkts[i:]
+        return bkts
+
+    def bucket_candidates(self, buckets, sufficient_funds):
+        candidates = set()
+
+        # Add all singletons
+        for n, bucket in enumerate(buckets):
+            if self.sufficient_totals(bucket.value, bucket.size):
+                candidates.add((n, ))
+
+        # And now some random ones, shuffling only as far as needed
+        attempts = min(100, (len(buckets) - 1) * 10 + 1)
+        permutation = list(range(len(buckets)))
+        for i in range(attempts):
+            value = size = 0
+            for count in range(len(permutation)):
+                j = self.p.randint(count, len(permutation))
+                permutation[count], permutation[j] = permutation[j], permutation[count]
+                bucket = buckets[permutation[count]]
+                value += bucket.value
+                size += bucket.size
+                if self.sufficient_totals(value, size):
+                    candidates.add(tuple(sorted(permutation[:count + 1])))
+                    break
+            else:
+                raise NotEnoughFunds()
+
+        candidates = [[buckets[n] for n in c] for c in candidates]
+        return [self.strip_unneeded(c) for c in candidates]
+
+    def choose_buckets(self, buckets, sufficient_funds, penalty_func):
+        winner = self.branch_and_bound(buckets)
+        if winner is not None and sufficient_funds(winner):
+            return winner
+        return super().choose_buckets(buckets, sufficient_funds, penalty_func)
+
+
+COIN_CHOOSERS = {
+    'Privacy': CoinChooserPrivacy,
+    'BranchAndBound': CoinChooserBranchAndBound,
+}
+
 def get_name(config):
     kind = config.get('coin_chooser')
     if not kind in COIN_CHOOSERS:
-        kind = 'Priority'
+        kind = 'Privacy'
     return kind
+
+def get_coin_chooser(config):
+    return COIN_CHOOSERS[get_name(config)]()
@@ -24,7 +24,9 @@
 # SOFTWARE.
 
 import sys
+import csv
 import datetime
+import time
 import argparse
 import json
 import ast
@@ -33,12 +35,13 @@ from functools import wraps
 from decimal import Decimal
 
 from .import util
-from .util import bfh, bh2u, format_satoshis, json_decode, print_error
+from .util import bfh, bh2u, format_satoshis, json_decode, print_error, NotEnoughFunds
 from .import bitcoin
 from .address import Address
 from .bitcoin import hash_160, COIN, TYPE_ADDRESS
 from .i18n import _
-from .transaction import Transaction, multisig_script
+from .metrics import metrics
+from .transaction import Transaction, multisig_script, MAX_STANDARD_TX_SIZE
 from .paymentrequest import PR_PAID, PR_UNPAID, PR_UNKNOWN, PR_EXPIRED
 from .plugins import run_hook
 
@@ -56,6 +59,9 @@ class Command:
         self.requires_network = 'n' in s
         self.requires_wallet = 'w' in s
         self.requires_password = 'p' in s
+        # Only reads the wallet, so can run alongside other such commands.
+        # Commands that decrypt the keystores, or sign, are never marked so.
+        self.read_only = 'r' in s
         self.description = func.__doc__
         self.help = self.description.split('.')[0] if self.description else None
         varnames = func.__code__.co_varnames[1:func.__code__.co_argcount]
@@ -84,6 +90,7 @@ def command(s):
         global known_commands
         name = func.__name__
         known_commands[name] = Command(func, s)
+        timed_func = metrics.timed('command', name)(func)
         @wraps(func)
         def func_wrapper(*args, **kwargs):
             c = known_commands[func.__name__]
@@ -97,7 +104,7 @@ def command(s):
             if c.requires_password and password is None and wallet.storage.get('use_encryption') \
                and not kwargs.get("unsigned"):
                 return {'error': 'Password required' }
-            return func(*args, **kwargs)
+            return timed_func(*args, **kwargs)
         return func_wrapper
     return decorator
 
@@ -221,7 +228,7 @@ class Commands:
         sh = Address.from_string(address).to_scripthash_hex()
         return self.network.synchronous_get(('blockchain.scripthash.get_history', [sh]))
 
-    @command('w')
+    @command('wr')
     def listunspent(self):
         """List unspent outputs. Returns the list of unspent transaction
         outputs in your wallet."""
@@ -328,7 +335,7 @@ class Commands:
         else:
             return [get_pk(addr) for addr in address]
 
-    @command('w')
+    @command('wr')
     def ismine(self, address):
         """Check if address is in wallet. Return true if and only address is in wallet"""
         address = Address.from_string(address)
@@ -344,13 +351,13 @@ class Commands:
         """Check that an address is valid. """
         return Address.is_valid(address)
 
-    @command('w')
+    @command('wr')
     def getpubkeys(self, address):
         """Return the public keys for a wallet address. """
         address = Address.from_string(address)
         return self.wallet.get_public_keys(address)
 
-    @command('w')
+    @command('wr')
     def getbalance(self):
         """Return the balance of your wallet. """
         c, u, x = self.wallet.get_balance()
@@ -389,7 +396,7 @@ class Commands:
         from .version import PACKAGE_VERSION
         return PACKAGE_VERSION
 
-    @command('w')
+    @command('wr')
     def getmpk(self):
         """Get master public key. Return your wallet\'s master public key"""
         return self.wallet.get_master_public_key()
@@ -490,12 +497,69 @@ class Commands:
         tx = self._mktx(outputs, tx_fee, change_addr, domain, nocheck, unsigned, password, locktime)
         return tx.as_dict()
 
-    @command('w')
+    @command('wp')
+    def bulkpay(self, payouts, fee=None, from_addr=None, change_addr=None, nocheck=False, unsigned=False, password=None, locktime=None, max_tx_size=MAX_STANDARD_TX_SIZE):
+        """Create transactions paying a list of outputs too long for one
+        transaction, each at most max_tx_size bytes. The fee, if given, is
+        paid by each transaction. Returns the transactions, and how many
+        outputs were built and inputs signed per second. If the funds run
+        out part way, the transactions already made are returned with an
+        error."""
+        self.nocheck = nocheck
+        tx_fee = satoshis(fee)
+        domain = from_addr.split(',') if from_addr else None
+        change_addr = self._resolver(change_addr)
+        domain = None if domain is None else map(self._resolver, domain)
+        def outputs():
+            for address, amount in payouts:
+                yield (TYPE_ADDRESS, self._resolver(address), satoshis(amount))
+
+        coins = self.wallet.get_spendable_coins(domain, self.config)
+        txs = self.wallet.make_payout_transactions(coins, outputs(), self.config, tx_fee,
+                                                   change_addr, max_tx_size)
+        result = []
+        paid = signed = 0
+        build_time = sign_time = 0
+        error = None
+        t0 = time.perf_counter()
+        while True:
+            try:
+                tx, n = next(txs)
+            except StopIteration:
+                break
+            except NotEnoughFunds:
+                # Keep what was already built, and say how far it got
+                error = _("Insufficient funds")
+                break
+            t1 = time.perf_counter()
+            build_time += t1 - t0
+            if locktime != None:
+                tx.locktime = locktime
+            if not unsigned:
+                run_hook('sign_tx', self.wallet, tx)
+                self.wallet.sign_transaction(tx, password)
+                signed += len(tx.inputs())
+            result.append(tx.as_dict())
+            paid += n
+            t0 = time.perf_counter()
+            sign_time += t0 - t1
+        ret = {
+            'transactions': result,
+            'outputs': paid,
+            'build_time': round(build_time, 3),
+            'sign_time': round(sign_time, 3),
+            'outputs_per_second': round(paid / build_time) if build_time else None,
+            'inputs_per_second': round(signed / sign_time) if sign_time else None,
+        }
+        if error:
+            ret['error'] = error
+        return ret
+
+    @command('wr')
     def history(self, year=None, show_addresses=False, show_fiat=False):
         """Wallet history. Returns the transaction history of your wallet."""
         kwargs = {'show_addresses': show_addresses}
         if year:
-            import time
             start_date = datetime.datetime(year, 1, 1)
             end_date = datetime.datetime(year+1, 1, 1)
             kwargs['from_timestamp'] = time.mktime(start_date.timetuple())
@@ -512,17 +576,17 @@ class Commands:
         transaction ID"""
         self.wallet.set_label(key, label)
 
-    @command('w')
+    @command('wr')
     def listcontacts(self):
         """Show your list of contacts"""
         return self.wallet.contacts
 
-    @command('w')
+    @command('wr')
     def getalias(self, key):
         """Retrieve alias. Lookup in your list of contacts, and for an OpenAlias DNS record."""
         return self.wallet.contacts.resolve(key)
 
-    @command('w')
+    @command('wr')
     def searchcontacts(self, query):
         """Search through contacts, return matching entries. """
         results = {}
@@ -531,7 +595,7 @@ class Commands:
                 results[key] = value
         return results
 
-    @command('w')
+    @command('wr')
     def listaddresses(self, receiving=False, change=False, labels=False, frozen=False, unused=False, funded=False, balance=False):
         """List wallet addresses. Returns the list of all addresses in your wallet. Use optional arguments to filter the results."""
         out = []
@@ -591,7 +655,7 @@ class Commands:
         out['status'] = pr_str[out.get('status', PR_UNKNOWN)]
         return out
 
-    @command('w')
+    @command('wr')
     def getrequest(self, key):
         """Return a payment request"""
         r = self.wallet.get_payment_request(Address.from_string(key), self.config)
@@ -604,7 +668,7 @@ class Commands:
     #    """<Not implemented>"""
     #    pass
 
-    @command('w')
+    @command('wr')
     def listrequests(self, pending=False, expired=False, paid=False):
         """List the payment requests you made."""
         out = self.wallet.get_sorted_requests(self.config)
@@ -625,7 +689,7 @@ class Commands:
         """Create a new receiving address, beyond the gap limit of the wallet"""
         return self.wallet.create_new_address(False).to_ui_string()
 
-    @command('w')
+    @command('wr')
     def getunusedaddress(self):
         """Returns the first unused address of the wallet, or None if all addresses are used.
         An address is considered as used if it has received a transaction, or if it is used in a payment request."""
@@ -687,7 +751,7 @@ class Commands:
         self.network.send([('blockchain.scripthash.subscribe', [h])], callback)
         return True
 
-    @command('wn')
+    @command('wnr')
     def is_synchronized(self):
         """ return wallet synchronization status """
         return self.wallet.is_up_to_date()
@@ -698,6 +762,15 @@ class Commands:
         to config settings (static/dynamic)"""
         return self.config.fee_per_kb()
 
+    @command('')
+    def getstats(self, prometheus=False):
+        """Return the count and latency percentiles, in seconds, of the
+        commands run, network responses handled and wallet writes since
+        the daemon started, and the bytes sent and received."""
+        if prometheus:
+            return metrics.prometheus()
+        return metrics.stats()
+
     @command('')
     def help(self):
         # for the python console
@@ -719,6 +792,7 @@ param_descriptions = {
     'amount': 'Amount to be sent (in BTC). Type \'!\' to send the maximum available.',
     'requested_amount': 'Requested amount (in BTC).',
     'outputs': 'list of ["address", amount]',
+    'payouts': 'File with a JSON list of ["address", amount], or one address,amount per line',
     'redeem_script': 'redeem script (hexadecimal)',
 }
 
@@ -743,6 +817,7 @@ command_options = {
     'privkey':     (None, "Private key. Set to '?' to get a prompt."),
     'unsigned':    ("-u", "Do not sign transaction"),
     'locktime':    (None, "Set locktime block number"),
+    'max_tx_size': (None, "Largest transaction to create, in bytes"),
     'domain':      ("-D", "List of addresses"),
     'memo':        ("-m", "Description of the request"),
     'expiration':  (None, "Time in seconds"),
@@ -754,12 +829,32 @@ command_options = {
     'show_addresses': (None, "Show input and output addresses"),
     'show_fiat':   (None, "Show fiat value of transactions"),
     'year':        (None, "Show history for a given year"),
+    'prometheus':  (None, "Return the statistics in the Prometheus text format"),
 }
 
 
 # don't use floats because of rounding errors
 from .transaction import tx_from_str
 json_loads = lambda x: json.loads(x, parse_float=lambda x: str(Decimal(x)))
+
+def read_payouts(path):
+    '''Reads a JSON list of ["address", amount] pairs, or CSV rows of
+    address and amount, from a file.'''
+    with open(path) as f:
+        text = f.read()
+    if text.lstrip().startswith('['):
+        return json_loads(text)
+    payouts = []
+    for n, row in enumerate(csv.reader(text.splitlines()), 1):
+        if not row:
+            continue
+        try:
+            address, amount = (x.strip() for x in row)
+            payouts.append([address, str(Decimal(amount))])
+        except Exception:
+            raise BaseException('{}, line {}: expected address,amount'.format(path, n))
+    return payouts
+
 arg_types = {
     'num': int,
     'nbits': int,
@@ -771,6 +866,8 @@ arg_types = {
     'jsontx': json_loads,
     'inputs': json_loads,
     'outputs': json_loads,
+    'payouts': read_payouts,
+    'max_tx_size': int,
     'fee': lambda x: str(Decimal(x)) if x is not None else None,
     'amount': lambda x: str(Decimal(x)) if x != '!' else '!',
     'locktime': int,
@@ -27,7 +27,7 @@ import json
 import traceback
 import sys
 
-from .address import Address
+from .address import Address, AddressError
 from . import dnssec
 from .util import FileImportFailed, FileImportFailedEncrypted
 from .util import print_error
@@ -76,11 +76,13 @@ class Contacts(dict):
             self.save()
 
     def resolve(self, k):
-        if Address.is_valid(k):
+        try:
             return {
                 'address': Address.from_string(k),
                 'type': 'address'
             }
+        except AddressError:
+            pass
         if k in self.keys():
             _type, addr = self[k]
             if _type == 'address':
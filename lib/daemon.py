@@ -24,6 +24,7 @@
 # SOFTWARE.
 import ast
 import os
+import threading
 import time
 
 # from jsonrpc import JSONRPCResponseManager
@@ -32,7 +33,7 @@ from .jsonrpc import VerifyingJSONRPCServer
 
 from .version import PACKAGE_VERSION
 from .network import Network
-from .util import json_decode, DaemonThread
+from .util import json_decode, DaemonThread, RWLock
 from .util import print_error, to_string
 from .wallet import Wallet
 from .storage import WalletStorage
@@ -40,6 +41,9 @@ from .commands import known_commands, Commands
 from .simple_config import SimpleConfig
 from .exchange_rate import FxThread
 
+# Default number of RPC requests handled at once
+DEFAULT_RPC_THREADS = 4
+
 
 def get_lockfile(config):
     return os.path.join(config.path, 'daemon')
@@ -129,6 +133,12 @@ class Daemon(DaemonThread):
             self.network.add_jobs([self.fx])
         self.gui = None
         self.wallets = {}
+        # Commands on a wallet hold its lock: shared if they only read it
+        self.wallet_locks = {}
+        self.lock = threading.RLock()
+        # Held while a wallet loads, which can take a while (decryption,
+        # storage upgrade), so that self.lock is never held that long
+        self.load_lock = threading.Lock()
         # Setup JSONRPC server
         self.init_server(config, fd, is_gui)
 
@@ -139,7 +149,8 @@ class Daemon(DaemonThread):
         rpc_user, rpc_password = get_rpc_credentials(config)
         try:
             server = VerifyingJSONRPCServer((host, port), logRequests=False,
-                                            rpc_user=rpc_user, rpc_password=rpc_password)
+                                            rpc_user=rpc_user, rpc_password=rpc_password,
+                                            max_workers=config.get('rpcthreads', DEFAULT_RPC_THREADS))
         except Exception as e:
             self.print_error('Warning: cannot initialize RPC server on host', host, e)
             self.server = None
@@ -155,10 +166,32 @@ class Daemon(DaemonThread):
         else:
             server.register_function(self.run_daemon, 'daemon')
             self.cmd_runner = Commands(self.config, None, self.network)
-            for cmdname in known_commands:
-                server.register_function(getattr(self.cmd_runner, cmdname), cmdname)
+            for cmdname, cmd in known_commands.items():
+                server.register_function(self.rpc_command(cmd), cmdname)
             server.register_function(self.run_cmdline, 'run_cmdline')
 
+    def rpc_command(self, cmd):
+        def run(*args, **kwargs):
+            return self.run_command(self.cmd_runner, cmd, args, kwargs)
+        return run
+
+    def get_wallet_lock(self, wallet):
+        path = wallet.storage.path
+        with self.lock:
+            lock = self.wallet_locks.get(path)
+            if lock is None:
+                lock = self.wallet_locks[path] = RWLock()
+            return lock
+
+    def run_command(self, cmd_runner, cmd, args, kwargs):
+        func = getattr(cmd_runner, cmd.name)
+        wallet = cmd_runner.wallet
+        if not cmd.requires_wallet or wallet is None:
+            return func(*args, **kwargs)
+        lock = self.get_wallet_lock(wallet)
+        with lock.read_lock() if cmd.read_only else lock.write_lock():
+            return func(*args, **kwargs)
+
     def ping(self):
         return True
 
@@ -196,6 +229,8 @@ class Daemon(DaemonThread):
                                 for k, w in self.wallets.items()},
                     'fee_per_kb': self.config.fee_per_kb(),
                 }
+                if self.network.tx_cache:
+                    response['tx_cache'] = self.network.tx_cache.stats()
             else:
                 response = "Daemon offline"
         elif sub == 'stop':
@@ -218,9 +253,13 @@ class Daemon(DaemonThread):
         return response
 
     def load_wallet(self, path, password):
+        with self.load_lock:
+            return self._load_wallet(path, password)
+
+    def _load_wallet(self, path, password):
         # wizard will be launched if we return
-        if path in self.wallets:
-            wallet = self.wallets[path]
+        wallet = self.wallets.get(path)
+        if wallet is not None:
             return wallet
         storage = WalletStorage(path, manual_upgrades=True)
         if not storage.file_exists():
@@ -237,27 +276,30 @@ class Daemon(DaemonThread):
             return
         wallet = Wallet(storage)
         wallet.start_threads(self.network)
-        self.wallets[path] = wallet
+        self.add_wallet(wallet)
         return wallet
 
     def add_wallet(self, wallet):
         path = wallet.storage.path
-        self.wallets[path] = wallet
+        with self.lock:
+            self.wallets[path] = wallet
 
     def get_wallet(self, path):
         return self.wallets.get(path)
 
     def stop_wallet(self, path):
         # Issue #659 wallet may already be stopped.
-        if path in self.wallets:
-            wallet = self.wallets.pop(path)
+        with self.lock:
+            wallet = self.wallets.pop(path, None)
+        if wallet is not None:
             wallet.stop_threads()
 
     def run_cmdline(self, config_options):
         password = config_options.get('password')
         new_password = config_options.get('new_password')
         config = SimpleConfig(config_options)
-        config.fee_estimates = self.network.config.fee_estimates.copy()
+        if self.network:
+            config.fee_estimates = self.network.config.fee_estimates.copy()
         cmdname = config.get('cmd')
         cmd = known_commands[cmdname]
         if cmd.requires_wallet:
@@ -276,13 +318,13 @@ class Daemon(DaemonThread):
         for x in cmd.options:
             kwargs[x] = (config_options.get(x) if x in ['password', 'new_password'] else config.get(x))
         cmd_runner = Commands(config, wallet, self.network)
-        func = getattr(cmd_runner, cmd.name)
-        result = func(*args, **kwargs)
-        return result
+        return self.run_command(cmd_runner, cmd, args, kwargs)
 
     def run(self):
         while self.is_running():
             self.server.handle_request() if self.server else time.sleep(0.1)
+        if self.server:
+            self.server.server_close()
         for k, wallet in self.wallets.items():
             wallet.stop_threads()
         if self.network:
@@ -81,6 +81,9 @@ def load_library():
         secp256k1.secp256k1_ec_pubkey_tweak_mul.argtypes = [c_void_p, c_char_p, c_char_p]
         secp256k1.secp256k1_ec_pubkey_tweak_mul.restype = c_int
 
+        secp256k1.secp256k1_ec_pubkey_tweak_add.argtypes = [c_void_p, c_char_p, c_char_p]
+        secp256k1.secp256k1_ec_pubkey_tweak_add.restype = c_int
+
         secp256k1.ctx = secp256k1.secp256k1_context_create(SECP256K1_CONTEXT_SIGN | SECP256K1_CONTEXT_VERIFY)
         r = secp256k1.secp256k1_context_randomize(secp256k1.ctx, os.urandom(32))
         if r:
@@ -215,6 +218,25 @@ def is_using_fast_ecc():
     return _patched_functions.monkey_patching_active
 
 
+def pubkey_tweak_add(pubkey_bytes, tweak):
+    '''Return the compressed serialization of the point pubkey_bytes +
+    tweak*G, as used by BIP32 public derivation, or None if libsecp256k1
+    is not in use or the tweak is invalid.'''
+    if not _patched_functions.monkey_patching_active:
+        return None
+    pubkey = create_string_buffer(64)
+    if not _libsecp256k1.secp256k1_ec_pubkey_parse(
+            _libsecp256k1.ctx, pubkey, pubkey_bytes, len(pubkey_bytes)):
+        return None
+    if not _libsecp256k1.secp256k1_ec_pubkey_tweak_add(_libsecp256k1.ctx, pubkey, tweak):
+        return None
+    pubkey_serialized = create_string_buffer(33)
+    pubkey_size = c_size_t(33)
+    _libsecp256k1.secp256k1_ec_pubkey_serialize(
+        _libsecp256k1.ctx, pubkey_serialized, byref(pubkey_size), pubkey, SECP256K1_EC_COMPRESSED)
+    return pubkey_serialized.raw
+
+
 try:
     _libsecp256k1 = load_library()
 except:
@@ -30,6 +30,7 @@ import sys
 import threading
 import time
 import traceback
+from collections import deque
 
 import requests
 
@@ -258,6 +259,19 @@ class Interface(util.PrintError):
     MODE_CATCH_UP = 'catch_up'
     MODE_VERIFICATION = 'verification'
 
+    # Flow control.  The number of requests sent but not yet answered may
+    # grow while the server answers promptly, and is halved when it reports
+    # being busy or its responses start to queue up.
+    INITIAL_WINDOW = 100
+    MIN_WINDOW = 10
+    MAX_WINDOW = 2000
+    LATENCY_TARGET = 1.0        # seconds of queueing at the server
+    BUSY_ERRORS = (-101, -102)  # server busy, excessive resource usage
+    # Requests per JSON-RPC batch, for servers that accept batches
+    BATCH_SIZE = 100
+    # Server software known to accept batches, as named by server.version
+    BATCH_SERVERS = ('ElectrumX', 'Fulcrum')
+
     def __init__(self, server, socket):
         self.server = server
         self.host, self.port, _ = server.rsplit(':', 2)
@@ -269,6 +283,14 @@ class Interface(util.PrintError):
         self.debug = False
         self.unsent_requests = []
         self.unanswered_requests = {}
+        self.send_times = {}
+        self.window = self.INITIAL_WINDOW
+        self.rtt = None
+        self.rtt_min = None
+        self.last_shrink = 0
+        self.batching = False
+        # Wire ids of the batches sent, oldest first, until answered
+        self.sent_batches = deque()
         self.last_send = time.time()
         self.closed_remotely = False
         
@@ -299,6 +321,16 @@ class Interface(util.PrintError):
                 pass
         self.socket.close()
 
+    @classmethod
+    def accepts_batches(cls, version_data):
+        '''Whether a server accepts batches, from its answer to
+        server.version.'''
+        try:
+            software = version_data[0]
+        except (TypeError, IndexError, KeyError):
+            return False
+        return isinstance(software, str) and software.startswith(cls.BATCH_SERVERS)
+
     def queue_request(self, *args):  # method, params, _id
         '''Queue a request, later to be send with send_requests when the
         socket is available for writing.
@@ -307,9 +339,9 @@ class Interface(util.PrintError):
         self.unsent_requests.append(args)
 
     def num_requests(self):
-        '''Keep unanswered requests below 100'''
-        n = 100 - len(self.unanswered_requests)
-        return min(n, len(self.unsent_requests))
+        '''Keep unanswered requests within the window'''
+        n = self.window - len(self.unanswered_requests)
+        return max(0, min(n, len(self.unsent_requests)))
 
     def send_requests(self):
         '''Sends queued requests.  Returns False on failure.'''
@@ -317,18 +349,73 @@ class Interface(util.PrintError):
         make_dict = lambda m, p, i: {'method': m, 'params': p, 'id': i}
         n = self.num_requests()
         wire_requests = self.unsent_requests[0:n]
+        messages = [make_dict(*r) for r in wire_requests]
+        if self.batching and n > 1:
+            messages = [messages[i:i+self.BATCH_SIZE]
+                        for i in range(0, n, self.BATCH_SIZE)]
         try:
-            self.pipe.send_all([make_dict(*r) for r in wire_requests])
+            self.pipe.send_all(messages)
         except (OSError, ssl.SSLError) as e:
             self.print_error("send_requests: {}: {}".format(type(e).__name__, e))
             return False
         self.unsent_requests = self.unsent_requests[n:]
+        if self.batching and n > 1:
+            self.sent_batches.extend([[r['id'] for r in batch] for batch in messages])
         for request in wire_requests:
             if self.debug:
                 self.print_error("-->", request)
             self.unanswered_requests[request[2]] = request
+            self.send_times[request[2]] = self.last_send
         return True
 
+    def requeue_rejected_batch(self):
+        '''A server that does not accept batches answers each with a single
+        error without an id.  Stop sending batches, and send the requests
+        of the oldest unanswered batch again, one by one.  Returns False
+        if no batch was waiting for an answer.'''
+        self.batching = False
+        while self.sent_batches:
+            ids = self.sent_batches.popleft()
+            requests = [self.unanswered_requests.pop(wire_id)
+                        for wire_id in ids if wire_id in self.unanswered_requests]
+            if requests:
+                for wire_id in ids:
+                    self.send_times.pop(wire_id, None)
+                # Ahead of requests sent later, after those of older batches
+                first = requests[0][2]
+                n = next((n for n, r in enumerate(self.unsent_requests) if r[2] > first),
+                         len(self.unsent_requests))
+                self.unsent_requests[n:n] = requests
+                self.print_error("batch rejected, resending {} requests".format(len(requests)))
+                return True
+        return False
+
+    def forget_answered_batches(self):
+        while self.sent_batches and not any(wire_id in self.unanswered_requests
+                                            for wire_id in self.sent_batches[0]):
+            self.sent_batches.popleft()
+
+    def update_window(self, wire_id, response):
+        '''Adjust the window from the round trip time of a request and
+        whether the server answered that it is busy.'''
+        now = time.time()
+        rtt = now - self.send_times.pop(wire_id, now)
+        self.rtt_min = rtt if self.rtt_min is None else min(self.rtt_min, rtt)
+        self.rtt = rtt if self.rtt is None else 0.875 * self.rtt + 0.125 * rtt
+        error = response.get('error')
+        busy = isinstance(error, dict) and error.get('code') in self.BUSY_ERRORS
+        if busy or rtt - self.rtt_min > self.LATENCY_TARGET:
+            # Responses to the requests already sent show the same
+            # congestion, so halve at most once per round trip
+            if now - self.last_shrink > self.rtt:
+                self.window = max(self.MIN_WINDOW, self.window // 2)
+                self.last_shrink = now
+                self.print_error("window", self.window)
+        elif (self.window < self.MAX_WINDOW
+              and len(self.unanswered_requests) >= self.window // 2):
+            # Only grow a window that is being used
+            self.window += 1
+
     def ping_required(self):
         '''Returns True if a ping should be sent.'''
         return time.time() - self.last_send > 300
@@ -354,32 +441,42 @@ class Interface(util.PrintError):
         responses = []
         while True:
             try:
-                response = self.pipe.get()
+                message = self.pipe.get()
             except util.timeout:
                 break
-            if not type(response) is dict:
+            # A batch of requests is answered with an array of responses
+            batch = message if type(message) is list and message else [message]
+            if not all(type(response) is dict for response in batch):
                 responses.append((None, None))
-                if response is None:
+                if message is None:
                     self.closed_remotely = True
                     self.print_error("connection closed remotely")
                 break
-            if self.debug:
-                self.print_error("<--", response)
-            wire_id = response.get('id', None)
-            if wire_id is None:  # Notification
-                responses.append((None, response))
-            else:
+            for response in batch:
+                if self.debug:
+                    self.print_error("<--", response)
+                wire_id = response.get('id', None)
+                if wire_id is None and 'method' not in response:
+                    # An error that answers no request in particular
+                    if not self.requeue_rejected_batch():
+                        self.print_error("error without id", response)
+                    continue
+                if wire_id is None:  # Notification
+                    responses.append((None, response))
+                    continue
                 request = self.unanswered_requests.pop(wire_id, None)
                 if request:
+                    self.update_window(wire_id, response)
                     responses.append((request, response))
                 else:
                     self.print_error("unknown wire ID", wire_id)
                     responses.append((None, None)) # Signal
-                    break
+                    return responses
+            if type(message) is list:
+                self.forget_answered_batches()
 
         return responses
 
-
 def check_cert(host, cert):
     try:
         b = pem.dePem(cert, 'CERTIFICATE')
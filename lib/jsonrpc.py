@@ -25,6 +25,7 @@
 
 from jsonrpclib.SimpleJSONRPCServer import SimpleJSONRPCServer, SimpleJSONRPCRequestHandler
 from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
 import time
 
 from . import util
@@ -47,11 +48,19 @@ class RPCAuthUnsupportedType(Exception):
 
 # based on http://acooke.org/cute/BasicHTTPA0.html by andrew cooke
 class VerifyingJSONRPCServer(SimpleJSONRPCServer):
+    '''With max_workers above 1, requests are handled by a pool of that
+    many threads, and handle_request() returns once a request is
+    accepted.  Otherwise each is handled by handle_request().'''
 
-    def __init__(self, *args, rpc_user, rpc_password, **kargs):
+    # Connections waiting to be accepted, beyond which they are refused
+    # or, on some systems, retried by the client after a second or more
+    request_queue_size = 128
+
+    def __init__(self, *args, rpc_user, rpc_password, max_workers=1, **kargs):
 
         self.rpc_user = rpc_user
         self.rpc_password = rpc_password
+        self.executor = ThreadPoolExecutor(max_workers) if max_workers > 1 else None
 
         class VerifyingRequestHandler(SimpleJSONRPCRequestHandler):
             def parse_request(myself):
@@ -73,6 +82,26 @@ class VerifyingJSONRPCServer(SimpleJSONRPCServer):
         SimpleJSONRPCServer.__init__(
             self, requestHandler=VerifyingRequestHandler, *args, **kargs)
 
+    def process_request(self, request, client_address):
+        if self.executor is None:
+            SimpleJSONRPCServer.process_request(self, request, client_address)
+        else:
+            self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        # As socketserver.ThreadingMixIn does
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        SimpleJSONRPCServer.server_close(self)
+        if self.executor:
+            self.executor.shutdown(wait=False)
+
     def authenticate(self, headers):
         if self.rpc_password == '':
             # RPC authentication is disabled
@@ -255,21 +255,27 @@ class Xpub:
 
     def __init__(self):
         self.xpub = None
-        self.xpub_receive = None
-        self.xpub_change = None
+        # (xpub, for_change) -> (cK, c) of the receiving/change branch
+        self._branch_nodes = {}
 
     def get_master_public_key(self):
         return self.xpub
 
+    def get_branch_node(self, for_change):
+        key = (self.xpub, for_change)
+        node = self._branch_nodes.get(key)
+        if node is None:
+            _, _, _, _, c, cK = deserialize_xpub(self.xpub)
+            node = self._branch_nodes[key] = CKD_pub(cK, c, int(for_change))
+        return node
+
     def derive_pubkey(self, for_change, n):
-        xpub = self.xpub_change if for_change else self.xpub_receive
-        if xpub is None:
-            xpub = bip32_public_derivation(self.xpub, "", "/%d"%for_change)
-            if for_change:
-                self.xpub_change = xpub
-            else:
-                self.xpub_receive = xpub
-        return self.get_pubkey_from_xpub(xpub, (n,))
+        return self.derive_pubkeys(for_change, n, 1)[0]
+
+    def derive_pubkeys(self, for_change, n, count):
+        '''Return the pubkeys of addresses n to n+count-1 of a branch.'''
+        cK, c = self.get_branch_node(for_change)
+        return [bh2u(K) for K in CKD_pub_range(cK, c, n, count)]
 
     @classmethod
     def get_pubkey_from_xpub(self, xpub, sequence):
@@ -459,6 +465,9 @@ class Old_KeyStore(Deterministic_KeyStore):
     def derive_pubkey(self, for_change, n):
         return self.get_pubkey_from_mpk(self.mpk, for_change, n)
 
+    def derive_pubkeys(self, for_change, n, count):
+        return [self.derive_pubkey(for_change, i) for i in range(n, n + count)]
+
     def get_private_key_from_stretched_exponent(self, for_change, n, secexp):
         order = generator_secp256k1.order()
         secexp = (secexp + self.get_sequence(self.mpk, for_change, n)) % order
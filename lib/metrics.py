@@ -0,0 +1,150 @@
+# Electron Cash - lightweight Bitcoin client
+# Copyright (C) 2018 The Electron Cash Developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+'''Timings and counters kept by the process, as returned by the getstats
+command.  Timings are grouped in families, such as 'command' or
+'network_response', and within a family by name, such as the command or
+the method of the response.'''
+
+import re
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Timer(object):
+    '''Counts and sums durations, keeping the most recent for quantiles.'''
+
+    # Quantiles are of the last so many durations
+    samples_kept = 1000
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.samples = deque(maxlen=self.samples_kept)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.samples.append(seconds)
+
+    def quantiles(self):
+        samples = sorted(self.samples)
+        if not samples:
+            return [None] * len(QUANTILES)
+        return [samples[min(len(samples) - 1, int(q * len(samples)))]
+                for q in QUANTILES]
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timers = {}     # family -> name -> Timer
+        self.counters = {}   # name -> int
+
+    def observe(self, family, name, seconds):
+        with self.lock:
+            timers = self.timers.setdefault(family, {})
+            timer = timers.get(name)
+            if timer is None:
+                timer = timers[name] = Timer()
+            timer.observe(seconds)
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def timed(self, family, name=None):
+        '''Decorator timing each call of a function, by default under its
+        name.  Calls that raise are timed too.'''
+        def decorator(func):
+            key = name or func.__name__
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                t0 = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(family, key, time.perf_counter() - t0)
+            return wrapper
+        return decorator
+
+    def reset(self):
+        with self.lock:
+            self.timers.clear()
+            self.counters.clear()
+
+    def stats(self):
+        '''Returns a JSON-serializable dict of the counters, and of every
+        timer's count, total and quantiles in seconds.'''
+        with self.lock:
+            timers = {family: {name: (timer.count, timer.total, timer.quantiles())
+                               for name, timer in timers.items()}
+                      for family, timers in self.timers.items()}
+            counters = dict(self.counters)
+        result = {'counters': counters}
+        for family, timers in timers.items():
+            result[family] = {}
+            for name, (count, total, quantiles) in timers.items():
+                d = {'count': count, 'total': round(total, 6)}
+                for q, value in zip(QUANTILES, quantiles):
+                    d['p%d' % (q * 100)] = None if value is None else round(value, 6)
+                result[family][name] = d
+        return result
+
+    def prometheus(self, prefix='electroncash'):
+        '''Returns the stats in the Prometheus text exposition format: a
+        summary per timer family, labelled by name, and a counter each.'''
+        stats = self.stats()
+        lines = []
+        for name, value in sorted(stats.pop('counters').items()):
+            metric = '%s_%s_total' % (prefix, sanitize(name))
+            lines.append('# TYPE %s counter' % metric)
+            lines.append('%s %d' % (metric, value))
+        for family, timers in sorted(stats.items()):
+            metric = '%s_%s_seconds' % (prefix, sanitize(family))
+            lines.append('# TYPE %s summary' % metric)
+            for name, d in sorted(timers.items()):
+                label = 'name="%s"' % escape_label(name)
+                for q in QUANTILES:
+                    value = d['p%d' % (q * 100)]
+                    if value is not None:
+                        lines.append('%s{%s,quantile="%s"} %r' % (metric, label, q, value))
+                lines.append('%s_sum{%s} %r' % (metric, label, d['total']))
+                lines.append('%s_count{%s} %d' % (metric, label, d['count']))
+        return '\n'.join(lines) + '\n'
+
+
+def sanitize(name):
+    return re.sub('[^a-zA-Z0-9_]', '_', name)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# The registry of the process
+metrics = Metrics()
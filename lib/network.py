@@ -23,14 +23,17 @@
 
 import time
 import queue
+import asyncio
 import os
 import stat
 import errno
 import random
 import re
 import select
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from functools import partial
 import threading
+import multiprocessing
 import socket
 import json
 
@@ -41,13 +44,22 @@ from .bitcoin import *
 from .networks import NetworkConstants
 from .i18n import _
 from .interface import Connection, Interface
+from .metrics import metrics
 from . import blockchain
+from .tx_cache import TxCache, DEFAULT_TX_CACHE_SIZE
 from .version import PACKAGE_VERSION, PROTOCOL_VERSION
 
 
 DEFAULT_AUTO_CONNECT = True
 NODES_RETRY_INTERVAL = 60
 SERVER_RETRY_INTERVAL = 10
+# Requests given to send_distributed are retried on another server when
+# unanswered for this long, and go to the main server after this many tries
+DISTRIBUTED_TIMEOUT = 20
+DISTRIBUTED_TRIES = 3
+# Methods of the notifications sent for our subscriptions
+SUBSCRIPTION_METHODS = ('blockchain.headers.subscribe', 'blockchain.scripthash.subscribe',
+                        'server.peers.subscribe')
 
 
 def parse_servers(result):
@@ -158,7 +170,9 @@ class Network(util.DaemonThread):
     """The Network class manages a set of connections to remote electrum
     servers, each connected socket is handled by an Interface() object.
     Connections are initiated by a Connection() thread which stops once
-    the connection succeeds or fails.
+    the connection succeeds or fails.  The connected sockets are driven
+    from an asyncio event loop in the network thread, or from a select()
+    loop if the 'network_asyncio' config option is off.
 
     Our external API:
 
@@ -189,6 +203,7 @@ class Network(util.DaemonThread):
         self.pending_sends_lock = threading.Lock()
 
         self.pending_sends = []
+        self.pending_distributed = []
         self.message_id = 0
         self.verified_checkpoint = False
         self.verifications_required = 1
@@ -217,9 +232,23 @@ class Network(util.DaemonThread):
             os.chmod(dir_path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
 
         # subscriptions and requests
-        self.subscribed_addresses = set()
+        # Scripthashes subscribed to, in the order they are resubscribed
+        # on reconnection: the most recently notified first, then in the
+        # order they were first subscribed, which the synchronizer sorts
+        # by wallet activity.
+        self.subscribed_addresses = OrderedDict()
         # Requests from client we've not seen a response to
         self.unanswered_requests = {}
+        # Requests spread over all servers with send_distributed:
+        # message id -> (request, server, time sent), oldest first
+        self.distribute = self.config.get('distribute_requests', False)
+        self.distributed_requests = OrderedDict()
+        self.distributed_servers = set()
+        # Raw transactions, shared by all the wallets using this network
+        tx_cache_size = self.config.get('tx_cache_size', DEFAULT_TX_CACHE_SIZE)
+        self.tx_cache = None
+        if self.config.path and tx_cache_size:
+            self.tx_cache = TxCache(os.path.join(self.config.path, 'tx_cache'), tx_cache_size)
         # retry times
         self.server_retry_time = time.time()
         self.nodes_retry_time = time.time()
@@ -231,6 +260,16 @@ class Network(util.DaemonThread):
         self.auto_connect = self.config.get('auto_connect', DEFAULT_AUTO_CONNECT)
         self.connecting = set()
         self.requested_chunks = set()
+        # Header chunks are hashed in a pool of this many processes, so the
+        # network thread only does the checks that need the previous
+        # headers.  0 hashes them in the network thread.
+        self.header_workers = self.config.get('header_workers', 0)
+        self.header_pool = None
+        self.pending_chunks = []    # (hash results, connect_chunk arguments)
+        self.use_asyncio = self.config.get('network_asyncio', True)
+        self.loop = None                        # note: needs self.interface_lock
+        self.watched = {}                       # interface -> (fd, watching for writes)
+        self.pending_closes = []                # note: needs self.interface_lock
         self.socket_queue = queue.Queue()
         self.start_network(deserialize_server(self.default_server)[2], deserialize_proxy(self.config.get('proxy')))
 
@@ -298,7 +337,7 @@ class Network(util.DaemonThread):
         return self.connection_status == 'connecting'
 
     def is_up_to_date(self):
-        return self.unanswered_requests == {}
+        return self.unanswered_requests == {} and not self.distributed_requests
 
     def queue_request(self, method, params, interface=None):
         # If you want to queue a request on any interface it must go
@@ -326,7 +365,7 @@ class Network(util.DaemonThread):
         self.queue_request('server.peers.subscribe', [])
         self.request_fee_estimates()
         self.queue_request('blockchain.relayfee', [])
-        for h in self.subscribed_addresses:
+        for h in list(self.subscribed_addresses):
             self.queue_request('blockchain.scripthash.subscribe', [h])
 
     def request_fee_estimates(self):
@@ -556,10 +595,25 @@ class Network(util.DaemonThread):
 
     def close_interface(self, interface):
         if interface:
-            if interface.server in self.interfaces:
-                self.interfaces.pop(interface.server)
-            if interface.server == self.default_server:
-                self.interface = None
+            with self.interface_lock:
+                if interface.server in self.interfaces:
+                    self.interfaces.pop(interface.server)
+                if interface.server == self.default_server:
+                    self.interface = None
+                if self.loop is not None and threading.current_thread() is not self:
+                    # Only the network thread may touch the event loop, so
+                    # it unregisters and closes the socket for us.
+                    self.pending_closes.append(interface)
+                    self.loop.call_soon_threadsafe(self.close_pending_interfaces)
+                    return
+            self.unwatch_interface(interface)
+            interface.close()
+
+    def close_pending_interfaces(self):
+        with self.interface_lock:
+            interfaces, self.pending_closes = self.pending_closes, []
+        for interface in interfaces:
+            self.unwatch_interface(interface)
             interface.close()
 
     def add_recent_server(self, server):
@@ -571,6 +625,18 @@ class Network(util.DaemonThread):
         self.save_recent_servers()
 
     def process_response(self, interface, request, response, callbacks):
+        t0 = time.perf_counter()
+        try:
+            self._process_response(interface, request, response, callbacks)
+        finally:
+            # Notifications are named by the server, so only those of our
+            # subscriptions get a timer of their own
+            method = response.get('method')
+            if request is None and method not in SUBSCRIPTION_METHODS:
+                method = 'unknown'
+            metrics.observe('network_response', method, time.perf_counter() - t0)
+
+    def _process_response(self, interface, request, response, callbacks):
         if self.debug:
             self.print_error("<--", response)
         error = response.get('error')
@@ -610,6 +676,12 @@ class Network(util.DaemonThread):
             self.on_block_headers(interface, request, response)
         elif method == 'blockchain.block.header':
             self.on_header(interface, request, response)
+        elif method == 'blockchain.transaction.get':
+            if error is None and self.tx_cache and len(params) == 1:
+                try:
+                    self.tx_cache.put(params[0], bfh(result))
+                except (TypeError, ValueError):
+                    pass
 
         for callback in callbacks:
             callback(response)
@@ -628,9 +700,12 @@ class Network(util.DaemonThread):
                 # callback, are only sent to the current interface,
                 # and are placed in the unanswered_requests dictionary
                 client_req = self.unanswered_requests.pop(message_id, None)
+                distributed = self.distributed_requests.pop(message_id, None)
                 if client_req:
                     assert interface == self.interface
                     callbacks = [client_req[2]]
+                elif distributed:
+                    callbacks = [partial(self.on_distributed_response, distributed[0])]
                 else:
                     # fixme: will only work for subscriptions
                     k = self.get_index(method, params)
@@ -642,7 +717,7 @@ class Network(util.DaemonThread):
                 # Only once we've received a response to an addr subscription
                 # add it to the list; avoids double-sends on reconnection
                 if method == 'blockchain.scripthash.subscribe':
-                    self.subscribed_addresses.add(params[0])
+                    self.subscribed_addresses.setdefault(params[0], True)
             else:
                 if not response:  # Closed remotely / misbehaving
                     self.connection_down(interface.server)
@@ -650,6 +725,9 @@ class Network(util.DaemonThread):
                 # Rewrite response shape to match subscription request response
                 method = response.get('method')
                 params = response.get('params')
+                if method is None:
+                    self.print_error("ignoring notification without method", response)
+                    continue
                 k = self.get_index(method, params)
                 if method == 'blockchain.headers.subscribe':
                     response['result'] = params[0]
@@ -657,6 +735,8 @@ class Network(util.DaemonThread):
                 elif method == 'blockchain.scripthash.subscribe':
                     response['params'] = [params[0]]  # addr
                     response['result'] = params[1]
+                    if params[0] in self.subscribed_addresses:
+                        self.subscribed_addresses.move_to_end(params[0], last=False)
                 callbacks = self.subscriptions.get(k, [])
 
             # update cache if it's a subscription
@@ -679,6 +759,78 @@ class Network(util.DaemonThread):
         messages = list(messages)
         with self.pending_sends_lock:
             self.pending_sends.append((messages, callback))
+        self.wakeup()
+
+    def send_distributed(self, messages, callback, check):
+        '''Like send(), for requests any server can answer and whose
+        responses can be checked.  If the 'distribute_requests' config
+        option is set, they are spread over all connected servers rather
+        than all going to the main one, at the cost of those servers
+        learning about the wallet.  check(response) returns whether the
+        result is correct; a request that fails the check, gets an error
+        or times out is retried on another server, and finally on the main
+        server, whose response is passed to the callback unchecked as with
+        send().'''
+        if not self.distribute:
+            self.send(messages, callback)
+            return
+        messages = list(messages)
+        with self.pending_sends_lock:
+            self.pending_distributed.append((messages, callback, check))
+        self.wakeup()
+
+    def dispatch_distributed(self, request):
+        method, params, callback, check, tried = request
+        with self.interface_lock:
+            interfaces = [i for i in self.interfaces.values() if i.server not in tried]
+        if len(tried) >= DISTRIBUTED_TRIES or not interfaces:
+            if self.interface is None:
+                # Wait for a main server, as send() does
+                with self.pending_sends_lock:
+                    self.pending_distributed.append(([(method, params)], callback, check))
+                return
+            message_id = self.queue_request(method, params)
+            self.unanswered_requests[message_id] = method, params, callback
+            return
+        # The server with the shortest queue
+        interface = min(interfaces, key=lambda i: len(i.unsent_requests) + len(i.unanswered_requests))
+        tried.add(interface.server)
+        message_id = self.queue_request(method, params, interface)
+        self.distributed_requests[message_id] = request, interface.server, time.time()
+
+    def on_distributed_response(self, request, response):
+        method, params, callback, check, tried = request
+        if response.get('error') is None and check(response):
+            callback(response)
+        else:
+            self.print_error("retrying {} {}, failed on {}".format(method, params, tried))
+            self.dispatch_distributed(request)
+
+    def maintain_distributed_requests(self):
+        '''Retry requests that timed out, or whose server went away.'''
+        with self.interface_lock:
+            servers = set(self.interfaces)
+        retry = []
+        if servers != self.distributed_servers:
+            self.distributed_servers = servers
+            retry = [message_id for message_id, (request, server, sent_time)
+                     in self.distributed_requests.items() if server not in servers]
+        timeout = time.time() - DISTRIBUTED_TIMEOUT
+        for message_id, (request, server, sent_time) in self.distributed_requests.items():
+            if sent_time > timeout:
+                break
+            retry.append(message_id)
+        for message_id in retry:
+            request, server, sent_time = self.distributed_requests.pop(message_id, (None, None, None))
+            if request:
+                self.dispatch_distributed(request)
+
+    def wakeup(self):
+        '''Have the event loop send pending requests now rather than on its
+        next tick.  Can be called from any thread.'''
+        with self.interface_lock:
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self.flush_sends)
 
     def process_pending_sends(self):
         # Requests needs connectivity.  If we don't have an interface,
@@ -689,12 +841,22 @@ class Network(util.DaemonThread):
         with self.pending_sends_lock:
             sends = self.pending_sends
             self.pending_sends = []
+            distributed = self.pending_distributed
+            self.pending_distributed = []
+
+        for messages, callback, check in distributed:
+            for method, params in messages:
+                r = self.get_cached_response(method, params)
+                if r is not None:
+                    callback(r)
+                else:
+                    self.dispatch_distributed((method, params, callback, check, set()))
 
         for messages, callback in sends:
             for method, params in messages:
                 r = None
+                k = self.get_index(method, params)
                 if method.endswith('.subscribe'):
-                    k = self.get_index(method, params)
                     # add callback to list
                     l = self.subscriptions.get(k, [])
                     if callback not in l:
@@ -702,6 +864,8 @@ class Network(util.DaemonThread):
                     self.subscriptions[k] = l
                     # check cached response for subscriptions
                     r = self.sub_cache.get(k)
+                else:
+                    r = self.get_cached_response(method, params)
                 if r is not None:
                     util.print_error("cache hit", k)
                     callback(r)
@@ -709,6 +873,13 @@ class Network(util.DaemonThread):
                     message_id = self.queue_request(method, params)
                     self.unanswered_requests[message_id] = method, params, callback
 
+    def get_cached_response(self, method, params):
+        '''A response from the transaction cache, or None.'''
+        if self.tx_cache and method == 'blockchain.transaction.get' and len(params) == 1:
+            raw = self.tx_cache.get(params[0])
+            if raw is not None:
+                return {'method': method, 'params': params, 'result': bh2u(raw)}
+
     def unsubscribe(self, callback):
         '''Unsubscribe a callback to free object references to enable GC.'''
         # Note: we can't unsubscribe from the server, so if we receive
@@ -922,7 +1093,65 @@ class Network(util.DaemonThread):
             target_blockchain = interface.blockchain
 
         chunk_data = bfh(hexdata)
-        connect_state = target_blockchain.connect_chunk(request_base_height, chunk_data, proof_was_provided)
+        args = (interface, target_blockchain, request_base_height, actual_header_count, chunk_data,
+                proof_was_provided, was_verification_request, initial_interface_mode)
+        self.hash_and_connect_chunk(args)
+
+    def hash_and_connect_chunk(self, args):
+        '''Connect a chunk now, or once the header pool has hashed it.
+        args are those of connect_chunk.'''
+        chunk_data, proof_was_provided = args[4], args[5]
+        results = None
+        if self.header_workers > 0 and not proof_was_provided:
+            results = self.hash_chunk(chunk_data)
+        if results is not None:
+            self.pending_chunks.append((results, args))
+        else:
+            self.connect_chunk(*args)
+
+    def hash_chunk(self, chunk_data):
+        '''Start hashing the headers of chunk_data in the header pool, one
+        piece per worker.  Returns None, and stops using the pool, if it
+        cannot be started (e.g. no multiprocessing on the platform).'''
+        try:
+            if self.header_pool is None:
+                # spawn, as forking a threaded process is unsafe
+                context = multiprocessing.get_context('spawn')
+                self.header_pool = context.Pool(self.header_workers)
+            count = len(chunk_data) // blockchain.HEADER_SIZE
+            step = max(1, -(-count // self.header_workers)) * blockchain.HEADER_SIZE
+            return [self.header_pool.apply_async(blockchain.hash_headers, (chunk_data[i:i + step],))
+                    for i in range(0, len(chunk_data), step)]
+        except Exception as e:
+            self.print_error("cannot use a header pool, hashing in-thread: {}".format(e))
+            self.header_workers = 0
+            if self.header_pool is not None:
+                self.header_pool.terminate()
+                self.header_pool = None
+            return None
+
+    def process_pending_chunks(self):
+        '''Connect the header chunks whose hashes are ready, in the order
+        they were received.'''
+        while self.pending_chunks:
+            results, args = self.pending_chunks[0]
+            if not all(r.ready() for r in results):
+                break
+            self.pending_chunks.pop(0)
+            try:
+                hashes = [h for r in results for h in r.get()]
+            except Exception as e:
+                self.print_error("header pool failed, hashing in-thread: {}".format(e))
+                hashes = None
+            self.connect_chunk(*args, hashes=hashes)
+
+    def connect_chunk(self, interface, target_blockchain, request_base_height, actual_header_count, chunk_data,
+                      proof_was_provided, was_verification_request, initial_interface_mode, hashes=None):
+        '''Second half of on_block_headers(): verify and store the chunk.'''
+        if self.interfaces.get(interface.server) is not interface:
+            # the connection went down while the chunk was being hashed
+            return
+        connect_state = target_blockchain.connect_chunk(request_base_height, chunk_data, proof_was_provided, hashes)
         if connect_state == blockchain.CHUNK_ACCEPTED:
             interface.print_error("connected chunk, height={} count={} proof_was_provided={}".format(request_base_height, actual_header_count, proof_was_provided))
         elif connect_state == blockchain.CHUNK_FORKS:
@@ -1144,6 +1373,7 @@ class Network(util.DaemonThread):
                 interface.print_error("blockchain request timed out")
                 self.connection_down(interface.server)
                 continue
+        self.maintain_distributed_requests()
 
     def wait_on_sockets(self):
         # Python docs say Windows doesn't like empty selects.
@@ -1169,6 +1399,85 @@ class Network(util.DaemonThread):
         for interface in rout:
             self.process_responses(interface)
 
+    def run_event_loop(self):
+        '''Drive the interfaces from an asyncio event loop until the network
+        is stopped.  A response is processed as soon as its socket becomes
+        readable, and send() wakes the loop, so neither waits for the next
+        pass of a polling loop.  The housekeeping done on every pass of the
+        select() loop runs from a periodic tick instead.'''
+        loop = asyncio.new_event_loop()
+        errors = []
+        def on_error(loop, context):
+            # Let an exception end the thread, as it would the select() loop
+            errors.append(context.get('exception') or Exception(context['message']))
+            loop.stop()
+        loop.set_exception_handler(on_error)
+        with self.interface_lock:
+            self.loop = loop
+        loop.call_soon(self.loop_tick)
+        try:
+            loop.run_forever()
+            if errors:
+                raise errors[0]
+        finally:
+            with self.interface_lock:
+                self.close_pending_interfaces()
+                for interface in list(self.watched):
+                    self.unwatch_interface(interface)
+                self.loop = None
+            loop.close()
+
+    def loop_tick(self):
+        if not self.is_running():
+            self.loop.stop()
+            return
+        self.maintain_sockets()
+        self.process_pending_chunks()
+        self.maintain_requests()
+        if self.verified_checkpoint:
+            self.run_jobs()    # Synchronizer and Verifier and Fx
+        self.flush_sends()
+        self.loop.call_later(0.1, self.loop_tick)
+
+    def flush_sends(self):
+        self.process_pending_sends()
+        self.update_watchers()
+
+    def update_watchers(self):
+        '''Register the sockets of new interfaces with the event loop, and
+        watch an interface for writability only while it has requests to
+        send.'''
+        with self.interface_lock:
+            interfaces = list(self.interfaces.values())
+        for interface in interfaces:
+            fd, writing = self.watched.get(interface, (None, False))
+            if fd is None:
+                fd = interface.fileno()
+                self.loop.add_reader(fd, self.on_readable, interface)
+            wants_write = interface.num_requests() > 0
+            if wants_write and not writing:
+                self.loop.add_writer(fd, self.on_writable, interface)
+            elif writing and not wants_write:
+                self.loop.remove_writer(fd)
+            self.watched[interface] = fd, wants_write
+
+    def unwatch_interface(self, interface):
+        '''Must be called before the interface's socket is closed, as the
+        descriptor could otherwise be reused while still registered.'''
+        fd, writing = self.watched.pop(interface, (None, False))
+        if fd is not None:
+            self.loop.remove_reader(fd)
+            if writing:
+                self.loop.remove_writer(fd)
+
+    def on_readable(self, interface):
+        self.process_responses(interface)
+        self.flush_sends()
+
+    def on_writable(self, interface):
+        interface.send_requests()
+        self.update_watchers()
+
     def init_headers_file(self):
         b = self.blockchains[0]
         filename = b.path()
@@ -1191,18 +1500,27 @@ class Network(util.DaemonThread):
         if header is not None:
             self.verified_checkpoint = True
 
-        while self.is_running():
-            self.maintain_sockets()
-            self.wait_on_sockets()
-            self.maintain_requests()
-            if self.verified_checkpoint:
-                self.run_jobs()    # Synchronizer and Verifier and Fx
-            self.process_pending_sends()
+        if self.use_asyncio:
+            self.run_event_loop()
+        else:
+            while self.is_running():
+                self.maintain_sockets()
+                self.wait_on_sockets()
+                self.process_pending_chunks()
+                self.maintain_requests()
+                if self.verified_checkpoint:
+                    self.run_jobs()    # Synchronizer and Verifier and Fx
+                self.process_pending_sends()
         self.stop_network()
+        if self.header_pool is not None:
+            self.header_pool.terminate()
         self.on_stop()
 
     def on_server_version(self, interface, version_data):
         interface.server_version = version_data
+        # JSON-RPC batches, for server software known to accept them
+        interface.batching = (self.config.get('rpc_batching', True)
+                              and Interface.accepts_batches(version_data))
 
     def on_notify_header(self, interface, header_dict):
         '''
@@ -28,15 +28,18 @@ import threading
 import json
 import copy
 import re
+import shutil
 import stat
 import hmac, hashlib
 import base64
+import time
 import zlib
 
 from .address import Address
 from .util import PrintError, profiler
 from .plugins import run_hook, plugin_loaders
 from .keystore import bip44_derivation
+from .metrics import metrics
 from . import bitcoin
 
 
@@ -47,6 +50,13 @@ NEW_SEED_VERSION = 11       # electrum versions >= 2.0
 FINAL_SEED_VERSION = 17     # electrum >= 2.7 will set this to prevent
                             # old versions from overwriting new format
 
+# Changes made since the last full write of the wallet file are appended to
+# this sidecar file, one record per write().  The wallet file itself always
+# stays in the historical single-JSON-document format.
+JOURNAL_SUFFIX = '.journal'
+# rewrite the wallet file once the journal grows past this fraction of it
+JOURNAL_MAX_RATIO = 0.5
+JOURNAL_MIN_SIZE = 1024 * 1024
 
 
 def multisig_type(wallet_type):
@@ -60,6 +70,18 @@ def multisig_type(wallet_type):
     return match
 
 
+def json_equal(a, b):
+    '''Whether a and b serialize to the same JSON, tuples being written
+    as lists.'''
+    if a == b:
+        return True
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        return len(a) == len(b) and all(map(json_equal, a, b))
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(json_equal(v, b[k]) for k, v in a.items())
+    return False
+
+
 class WalletStorage(PrintError):
 
     def __init__(self, path, manual_upgrades=False):
@@ -70,6 +92,12 @@ class WalletStorage(PrintError):
         self.path = path
         self.modified = False
         self.pubkey = None
+        self.raw = None
+        # key -> None (whole value changed) or set of changed subkeys,
+        # for everything modified since the last write()
+        self._pending = {}
+        self._full_write = False
+        self._journal_size = None
         if self.file_exists():
             try:
                 with open(self.path, "r", encoding='utf-8') as f:
@@ -82,7 +110,43 @@ class WalletStorage(PrintError):
             # avoid new wallets getting 'upgraded'
             self.put('seed_version', FINAL_SEED_VERSION)
 
-    def load_data(self, s):
+    @property
+    def journal_path(self):
+        return self.path + JOURNAL_SUFFIX
+
+    @staticmethod
+    def delete_files(path):
+        '''Remove a wallet file along with its journal, which may hold
+        wallet data in the clear.'''
+        os.remove(path)
+        if os.path.exists(path + JOURNAL_SUFFIX):
+            os.remove(path + JOURNAL_SUFFIX)
+
+    @staticmethod
+    def rename_files(path, new_path):
+        '''Rename a wallet file along with its journal.  A journal left at
+        the new name by some other wallet is removed.'''
+        os.rename(path, new_path)
+        if os.path.exists(path + JOURNAL_SUFFIX):
+            os.replace(path + JOURNAL_SUFFIX, new_path + JOURNAL_SUFFIX)
+        elif os.path.exists(new_path + JOURNAL_SUFFIX):
+            os.remove(new_path + JOURNAL_SUFFIX)
+
+    def backup(self, new_path):
+        '''Copy the wallet to new_path as a single file.  The journal is
+        folded back into the wallet file first, so the copy has every
+        change.'''
+        with self.lock:
+            self.compact()
+            shutil.copyfile(self.path, new_path)
+        # Copy file attributes if possible
+        # (not supported on targets like Flatpak documents)
+        try:
+            shutil.copystat(self.path, new_path)
+        except (IOError, os.error):
+            pass
+
+    def load_data(self, s, ec_key=None):
         try:
             self.data = json.loads(s)
         except:
@@ -101,6 +165,8 @@ class WalletStorage(PrintError):
                     continue
                 self.data[key] = value
 
+        self._replay_journal(ec_key)
+
         # check here if I need to load a plugin
         t = self.get('wallet_type')
         l = plugin_loaders.get(t)
@@ -131,7 +197,7 @@ class WalletStorage(PrintError):
         s = zlib.decompress(ec_key.decrypt_message(self.raw)) if self.raw else None
         self.pubkey = ec_key.get_public_key()
         s = s.decode('utf8')
-        self.load_data(s)
+        self.load_data(s, ec_key)
 
     def set_password(self, password, encrypt):
         self.put('use_encryption', bool(password))
@@ -140,6 +206,60 @@ class WalletStorage(PrintError):
             self.pubkey = ec_key.get_public_key()
         else:
             self.pubkey = None
+        # the journal is encrypted with the old key (or not at all)
+        with self.lock:
+            self._full_write = True
+            self.modified = True
+
+    def _snapshot_id(self):
+        return hashlib.sha256(self.raw.encode('utf8')).hexdigest()
+
+    def _replay_journal(self, ec_key):
+        '''Apply the changes recorded in the journal on top of the data
+        loaded from the wallet file.  A journal left behind by another
+        version of the wallet file is ignored, and so is a trailing record
+        cut short by a crash.'''
+        self._journal_size = 0
+        try:
+            with open(self.journal_path, "rb") as f:
+                header = f.readline()
+                try:
+                    if json.loads(header.decode('utf8')).get('snapshot') != self._snapshot_id():
+                        raise ValueError('stale journal')
+                except Exception:
+                    self.print_error("ignoring journal", self.journal_path)
+                    return
+                size = len(header)
+                count = 0
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        s = line.decode('utf8')
+                        if ec_key:
+                            s = zlib.decompress(ec_key.decrypt_message(s.strip())).decode('utf8')
+                        record = json.loads(s)
+                    except Exception:
+                        break
+                    self._apply_record(record)
+                    size += len(line)
+                    count += 1
+        except FileNotFoundError:
+            return
+        self._journal_size = size
+        self.print_error("replayed %d journal records" % count)
+
+    def _apply_record(self, record):
+        for key, value in record.get('set', {}).items():
+            self.data[key] = value
+        for key, items in record.get('patch', {}).items():
+            self.data.setdefault(key, {}).update(items)
+        for key, subkeys in record.get('unset', {}).items():
+            d = self.data.get(key, {})
+            for subkey in subkeys:
+                d.pop(subkey, None)
+        for key in record.get('del', []):
+            self.data.pop(key, None)
 
     def get(self, key, default=None):
         with self.lock:
@@ -150,6 +270,32 @@ class WalletStorage(PrintError):
                 v = copy.deepcopy(v)
         return v
 
+    def get_nocopy(self, key, default=None):
+        '''Like get(), but return the stored value itself rather than a
+        copy.  Meant for the large keys ('transactions', 'txi', ...) read
+        once when a wallet is loaded.  The caller must not modify the
+        result.'''
+        with self.lock:
+            v = self.data.get(key)
+        return default if v is None else v
+
+    def put_nocopy(self, key, value):
+        '''Like put(), but take ownership of value instead of validating
+        and copying it.  value must be JSON serializable, and the caller
+        must not modify it (or anything it contains) afterwards; build a
+        new container for the next put_nocopy() instead.'''
+        with self.lock:
+            if value is not None:
+                old = self.data.get(key)
+                if old != value:
+                    if self._mark_pending(key, old, value):
+                        self.modified = True
+                    self.data[key] = value
+            elif key in self.data:
+                self.modified = True
+                self._pending[key] = None
+                self.data.pop(key)
+
     def put(self, key, value):
         try:
             json.dumps(key)
@@ -159,24 +305,117 @@ class WalletStorage(PrintError):
             return
         with self.lock:
             if value is not None:
-                if self.data.get(key) != value:
-                    self.modified = True
+                old = self.data.get(key)
+                if old != value:
+                    if self._mark_pending(key, old, value):
+                        self.modified = True
                     self.data[key] = copy.deepcopy(value)
             elif key in self.data:
                 self.modified = True
+                self._pending[key] = None
                 self.data.pop(key)
 
+    def _mark_pending(self, key, old, value):
+        '''Remember what changed under key.  For dict values only the
+        changed subkeys are recorded, so that e.g. adding a transaction
+        journals that transaction rather than the whole 'transactions'
+        dict.  Values equal once serialized, such as a tuple and the list
+        it was loaded back as, are not changes.  Returns whether anything
+        changed.'''
+        if (isinstance(old, dict) and isinstance(value, dict)
+                and self._pending.get(key, ()) is not None):
+            changed = set(k for k, v in value.items()
+                          if k not in old or not json_equal(old[k], v))
+            changed.update(k for k in old if k not in value)
+            if changed:
+                self._pending.setdefault(key, set()).update(changed)
+            return bool(changed)
+        if old is not None and json_equal(old, value):
+            return False
+        self._pending[key] = None
+        return True
+
     @profiler
-    def write(self):
+    def write(self, compact=False):
+        '''Save changes.  Normally only the changes since the last write
+        are appended to the journal; with compact=True, or once the
+        journal gets large, the whole wallet file is rewritten instead.'''
         with self.lock:
-            self._write()
+            self._write(compact)
+
+    def compact(self):
+        '''Fold the journal back into the wallet file, leaving a single
+        file readable by versions that do not know about the journal.'''
+        with self.lock:
+            if self._journal_size:
+                self.modified = True
+            self._write(True)
 
-    def _write(self):
+    def _write(self, compact=False):
         if threading.currentThread().isDaemon():
             self.print_error('warning: daemon thread cannot write wallet')
             return
         if not self.modified:
             return
+        t0 = time.perf_counter()
+        if compact or self._needs_full_write():
+            self._write_file()
+            metrics.observe('storage_write', 'file', time.perf_counter() - t0)
+        else:
+            self._append_journal()
+            metrics.observe('storage_write', 'journal', time.perf_counter() - t0)
+        self.modified = False
+
+    def _needs_full_write(self):
+        if self._full_write or self.raw is None or self._journal_size is None:
+            return True
+        if not os.path.exists(self.path):
+            return True
+        return self._journal_size > max(JOURNAL_MIN_SIZE, len(self.raw) * JOURNAL_MAX_RATIO)
+
+    def _journal_record(self):
+        record = {}
+        for key, subkeys in self._pending.items():
+            if key not in self.data:
+                record.setdefault('del', []).append(key)
+            elif subkeys is None:
+                record.setdefault('set', {})[key] = self.data[key]
+            else:
+                value = self.data[key]
+                for subkey in subkeys:
+                    if subkey in value:
+                        record.setdefault('patch', {}).setdefault(key, {})[subkey] = value[subkey]
+                    else:
+                        record.setdefault('unset', {}).setdefault(key, []).append(subkey)
+        return record
+
+    def _append_journal(self):
+        s = json.dumps(self._journal_record(), sort_keys=True)
+        if self.pubkey:
+            c = zlib.compress(bytes(s, 'utf8'))
+            s = bitcoin.encrypt_message(c, self.pubkey).decode('utf8')
+        s = s + '\n'
+        if self._journal_size == 0:
+            # (re)start the journal, tied to the current wallet file
+            s = json.dumps({'snapshot': self._snapshot_id()}) + '\n' + s
+            mode = os.stat(self.path).st_mode
+            fd = os.open(self.journal_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, stat.S_IMODE(mode))
+        else:
+            fd = os.open(self.journal_path, os.O_WRONLY)
+            # drop a partially written record, if any
+            os.ftruncate(fd, self._journal_size)
+            os.lseek(fd, self._journal_size, os.SEEK_SET)
+        with open(fd, "w", encoding='utf-8') as f:
+            f.write(s)
+            f.flush()
+            os.fsync(f.fileno())
+        size = len(s.encode('utf8'))
+        self._journal_size += size
+        metrics.incr('storage_bytes_written', size)
+        self._pending.clear()
+        self.print_error("appended %d bytes to" % len(s), self.journal_path)
+
+    def _write_file(self):
         s = json.dumps(self.data, indent=4, sort_keys=True)
         if self.pubkey:
             s = bytes(s, 'utf8')
@@ -199,8 +438,14 @@ class WalletStorage(PrintError):
             os.rename(temp_path, self.path)
         os.chmod(self.path, mode)
         self.raw = s
+        metrics.incr('storage_bytes_written', len(s.encode('utf8')))
+        # the journal no longer matches the wallet file; remove it
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self._journal_size = 0
+        self._pending.clear()
+        self._full_write = False
         self.print_error("saved", self.path)
-        self.modified = False
 
     def requires_split(self):
         d = self.get('accounts', {})
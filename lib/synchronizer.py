@@ -27,8 +27,10 @@ from threading import Lock
 import hashlib
 import traceback
 
+from .bitcoin import Hash, hash_encode
+from .metrics import metrics
 from .transaction import Transaction
-from .util import ThreadJob, bh2u
+from .util import ThreadJob, bh2u, bfh
 
 
 class Synchronizer(ThreadJob):
@@ -73,20 +75,23 @@ class Synchronizer(ThreadJob):
             self.new_addresses.add(address)
 
     def subscribe_to_addresses(self, addresses):
+        # Most recently active first: they are the likeliest to have changed
+        addresses = sorted(addresses, key=self.wallet.get_address_activity,
+                           reverse=True)
         hashes = [addr.to_scripthash_hex() for addr in addresses]
         # Keep a hash -> address mapping
         self.h2addr.update({h:addr for h, addr in zip(hashes, addresses)})
         self.network.subscribe_to_scripthashes(hashes, self.on_address_status)
         self.requested_hashes |= set(hashes)
 
-    def get_status(self, h):
+    @staticmethod
+    def get_status(h):
         if not h:
             return None
-        status = ''
-        for tx_hash, height in h:
-            status += tx_hash + ':%d:' % height
+        status = ''.join(tx_hash + ':%d:' % height for tx_hash, height in h)
         return bh2u(hashlib.sha256(status.encode('ascii')).digest())
 
+    @metrics.timed('synchronizer')
     def on_address_status(self, response):
         params, result = self.parse_response(response)
         if not params:
@@ -95,15 +100,27 @@ class Synchronizer(ThreadJob):
         addr = self.h2addr.get(scripthash, None)
         if not addr:
             return  # Bad server response?
-        history = self.wallet.get_address_history(addr)
-        if self.get_status(history) != result:
+        if self.wallet.get_address_status(addr) != result:
             if self.requested_histories.get(scripthash) is None:
                 self.requested_histories[scripthash] = result
-                self.network.request_scripthash_history(scripthash,
-                                                        self.on_address_history)
+                self.network.send_distributed(
+                    [('blockchain.scripthash.get_history', [scripthash])],
+                    self.on_address_history, self.check_history)
         # remove addr from list only after it is added to requested_histories
         self.requested_hashes.discard(scripthash)  # Notifications won't be in
 
+    def check_history(self, response):
+        '''Whether a history matches the status we asked for it with'''
+        scripthash = response['params'][0]
+        if scripthash not in self.requested_histories:
+            return True  # Handled by on_address_history
+        try:
+            hist = [(item['tx_hash'], item['height']) for item in response['result']]
+        except Exception:
+            return False
+        return self.get_status(hist) == self.requested_histories[scripthash]
+
+    @metrics.timed('synchronizer')
     def on_address_history(self, response):
         params, result = self.parse_response(response)
         if not params:
@@ -132,16 +149,16 @@ class Synchronizer(ThreadJob):
             self.print_error("error: status mismatch: {}".format(addr))
         else:
             # Store received history
-            self.wallet.receive_history_callback(addr, hist, tx_fees)
+            self.wallet.receive_history_callback(addr, hist, tx_fees, server_status)
             # Request transactions we don't have
             self.request_missing_txs(hist)
 
+    @metrics.timed('synchronizer')
     def tx_response(self, response):
         params, result = self.parse_response(response)
         if not params:
             return
         tx_hash = params[0]
-        #assert tx_hash == hash_encode(Hash(bytes.fromhex(result)))
         tx = Transaction(result)
         try:
             tx.deserialize()
@@ -159,6 +176,13 @@ class Synchronizer(ThreadJob):
             self.network.trigger_callback('updated')
 
 
+    def check_tx(self, response):
+        '''Whether a transaction hashes to the id we asked for'''
+        try:
+            return hash_encode(Hash(bfh(response['result']))) == response['params'][0]
+        except Exception:
+            return False
+
     def request_missing_txs(self, hist):
         # "hist" is a list of [tx_hash, tx_height] lists
         requests = []
@@ -169,7 +193,7 @@ class Synchronizer(ThreadJob):
                 continue
             requests.append(('blockchain.transaction.get', [tx_hash]))
             self.requested_tx[tx_hash] = tx_height
-        self.network.send(requests, self.tx_response)
+        self.network.send_distributed(requests, self.tx_response, self.check_tx)
 
 
     def initialize(self):
@@ -185,6 +209,7 @@ class Synchronizer(ThreadJob):
             self.print_error("missing tx", self.requested_tx)
         self.subscribe_to_addresses(self.wallet.get_addresses())
 
+    @metrics.timed('synchronizer')
     def run(self):
         '''Called from the network proxy thread main loop.'''
         # 1. Create new addresses
@@ -1,3 +1,6 @@
+import random
+import shutil
+import tempfile
 import unittest
 from .. import blockchain as bc
 
@@ -74,3 +77,135 @@ class TestBlockchain(unittest.TestCase):
         # MTP(1010) is TimeStamp(1005), MTP(1004) is TimeStamp(999)
         hdr = {'block_height': block['block_height'] + 1}
         self.assertEqual(chain.get_bits(hdr, chunk), 0x1801b553)
+
+
+class Config(object):
+
+    def __init__(self, path):
+        self.path = path
+
+
+class TestHeaderStore(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.chain = bc.Blockchain(Config(self.path), 0, None)
+        open(self.chain.path(), 'w+').close()
+
+    def tearDown(self):
+        self.chain._close_mmap()
+        shutil.rmtree(self.path)
+
+    def make_valid_headers(self, count):
+        '''Headers with irregular spacing whose bits follow the difficulty
+        rules, as computed without a HeaderWindow, crossing from the EDA
+        into the November 2017 DAA.'''
+        rng = random.Random(1)
+        headers = []
+        data = b''
+        timestamp = 1510600000 - 250 * 2000
+        for height in range(count):
+            timestamp += rng.choice([1, 300, 600, 900, 2400, 13 * 3600 // 6])
+            header = {
+                'version': 4,
+                'prev_block_hash': bc.hash_header(headers[-1]) if headers else '00' * 32,
+                'merkle_root': '%064x' % height,
+                'timestamp': timestamp,
+                'nonce': 0,
+                'block_height': height,
+            }
+            header['bits'] = (self.chain.get_bits(header, bc.HeaderChunk(0, data))
+                              if height else 0x18015ddc)
+            headers.append(header)
+            data += bytes.fromhex(bc.serialize_header(header))
+        return headers, data
+
+    def test_header_window(self):
+        headers, data = self.make_valid_headers(500)
+        self.assertNotEqual(headers[100]['bits'], headers[0]['bits'])
+        verify_header = self.chain.verify_header
+        def check_bits(header, prev_header, bits, *hashes):
+            # synthetic headers have no proof of work
+            if bits != header['bits']:
+                raise bc.VerifyError('bits mismatch')
+            return verify_header(header, prev_header, None, *hashes)
+        self.chain.verify_header = check_bits
+        bits = []
+        self.chain.get_bits = lambda header, chunk=None, window=None: bits.append(
+            (header['block_height'], window)) or bc.Blockchain.get_bits(self.chain, header, chunk, window)
+
+        # a chunk, verified with a window seeded from the stored headers
+        self.write(headers[:200])
+        self.assertLess(self.chain.get_median_time_past(199), 1510600000)
+        self.chain.verify_chunk(200, data[200 * bc.HEADER_SIZE:400 * bc.HEADER_SIZE])
+        self.assertTrue(all(window is not None for height, window in bits))
+        self.write(headers[200:400], 200)
+
+        # with hashes computed ahead, which must match the chunk
+        chunk_data = data[400 * bc.HEADER_SIZE:450 * bc.HEADER_SIZE]
+        hashes = bc.hash_headers(chunk_data)
+        self.assertEqual([bc.hash_header(h) for h in headers[400:450]], hashes)
+        self.chain.verify_chunk(400, chunk_data, hashes)
+        hashes[10] = hashes[11]
+        self.assertRaises(bc.VerifyError, self.chain.verify_chunk, 400, chunk_data, hashes)
+        del bits[200:]
+
+        # header by header, extending the window of the tip
+        for header in headers[400:]:
+            self.assertTrue(self.chain.can_connect(header))
+            self.chain.save_header(header)
+        self.assertEqual(499, self.chain._window.top)
+        self.assertEqual(len(bits), 300)
+        self.assertGreater(self.chain.get_median_time_past(499), 1510600000)
+
+        # a wrong bits value is still caught
+        header = dict(headers[-1], block_height=500, bits=headers[-1]['bits'] + 1,
+                      prev_block_hash=bc.hash_header(headers[-1]))
+        self.assertFalse(self.chain.can_connect(header))
+
+    def make_headers(self, count, nonce=0):
+        z = '00' * 32
+        headers = []
+        for height in range(count):
+            headers.append({
+                'version': 4,
+                'prev_block_hash': bc.hash_header(headers[-1]) if headers else z,
+                'merkle_root': z,
+                'timestamp': 1269211443 + 600 * height,
+                'bits': 0x18015ddc,
+                'nonce': nonce,
+                'block_height': height,
+            })
+        return headers
+
+    def write(self, headers, offset=0):
+        data = b''.join(bytes.fromhex(bc.serialize_header(h)) for h in headers)
+        self.chain.write(data, offset * bc.HEADER_SIZE)
+
+    def test_read_after_write(self):
+        headers = self.make_headers(10)
+        self.write(headers[:5])
+        self.assertEqual(headers[4], self.chain.read_header(4))
+        self.assertIsNone(self.chain.read_header(5))
+
+        # appending remaps the grown file
+        self.write(headers[5:], 5)
+        self.assertEqual(9, self.chain.height())
+        self.assertEqual(headers[9], self.chain.read_header(9))
+
+        # overwriting and truncating drops the cached headers
+        others = self.make_headers(8, nonce=1)
+        self.write(others[6:], 6)
+        self.assertEqual(7, self.chain.height())
+        self.assertEqual(headers[4], self.chain.read_header(4))
+        self.assertEqual(others[7], self.chain.read_header(7))
+        self.assertIsNone(self.chain.read_header(9))
+
+    def test_cache_size(self):
+        count = bc.HEADER_CACHE_SIZE + 10
+        headers = self.make_headers(count)
+        self.write(headers)
+        for height in range(count):
+            self.assertEqual(headers[height], self.chain.read_header(height))
+        self.assertEqual(bc.HEADER_CACHE_SIZE, len(self.chain._header_cache))
+        self.assertNotIn(0, self.chain._header_cache)
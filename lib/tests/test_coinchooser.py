@@ -0,0 +1,72 @@
+import unittest
+
+from ..address import Address
+from ..bitcoin import TYPE_ADDRESS
+from ..coinchooser import CoinChooserBranchAndBound, CoinChooserPrivacy, input_size_key
+from ..transaction import Transaction
+from ..util import NotEnoughFunds
+
+
+def address(i):
+    return Address.from_P2PKH_hash(i.to_bytes(20, 'big'))
+
+
+def make_coins(values):
+    return [{'type': 'p2pkh', 'address': address(i + 1), 'value': value,
+             'prevout_hash': '%064x' % (i + 1), 'prevout_n': 0,
+             'x_pubkeys': ['02' + '00' * 32], 'signatures': [None], 'num_sig': 1}
+            for i, value in enumerate(values)]
+
+
+def fee_estimator(size):
+    return size
+
+
+class TestCoinChooserBranchAndBound(unittest.TestCase):
+
+    def setUp(self):
+        self.chooser = CoinChooserBranchAndBound()
+        self.payee = address(1000)
+        self.change = address(1001)
+        self.coins = make_coins([200000, 50000, 30000, 20000, 9000])
+        self.input_size = Transaction.estimated_input_size(self.coins[0])
+        self.base_size = Transaction.from_io([], [(TYPE_ADDRESS, self.payee, 0)]).estimated_size()
+
+    def make_tx(self, coins, amount):
+        return self.chooser.make_tx(coins, [(TYPE_ADDRESS, self.payee, amount)],
+                                    [self.change], fee_estimator, 546)
+
+    def test_input_sizes(self):
+        coin = dict(self.coins[0], x_pubkeys=['04' + '00' * 64])
+        self.assertNotEqual(input_size_key(coin), input_size_key(self.coins[0]))
+        for c in (self.coins[0], coin):
+            self.assertEqual(Transaction.estimated_input_size(c),
+                             self.chooser.estimated_input_size(c))
+
+    def test_changeless(self):
+        # 50000 + 30000 pays it with 100 sats too much for a change output
+        amount = 80000 - (self.base_size + 2 * self.input_size) - 100
+        tx = self.make_tx(self.coins, amount)
+        self.assertEqual([50000, 30000], sorted((c['value'] for c in tx.inputs()), reverse=True))
+        self.assertEqual([amount], [o[2] for o in tx.outputs()])
+        # less the fee of the change output not made
+        self.assertEqual(100 - 34, tx.ephemeral['dust_to_fee'])
+        # The privacy chooser makes change
+        self.chooser = CoinChooserPrivacy()
+        self.assertEqual(2, len(self.make_tx(self.coins, amount).outputs()))
+
+    def test_with_change(self):
+        tx = self.make_tx(self.coins[:1], 10000)
+        self.assertEqual(2, len(tx.outputs()))
+        self.assertEqual(tx.input_value(), tx.output_value() + tx.get_fee())
+        self.assertGreaterEqual(tx.get_fee(), tx.estimated_size())
+
+    def test_not_enough_funds(self):
+        with self.assertRaises(NotEnoughFunds):
+            self.make_tx(self.coins, sum(c['value'] for c in self.coins))
+
+    def test_many_coins(self):
+        coins = make_coins([1000 + (i * 7919) % 50000 for i in range(3000)])
+        tx = self.make_tx(coins, 123456)
+        self.assertGreaterEqual(tx.input_value() - tx.output_value(), tx.estimated_size())
+        self.assertEqual(1, len(tx.outputs()))
@@ -1,7 +1,9 @@
+import os
+import tempfile
 import unittest
 from decimal import Decimal
 
-from ..commands import Commands
+from ..commands import Commands, read_payouts
 
 
 class TestCommands(unittest.TestCase):
@@ -31,3 +33,24 @@ class TestCommands(unittest.TestCase):
         self.assertEqual("2asd", Commands._setconfig_normalize_value('rpcpassword', '2asd'))
         self.assertEqual("['file:///var/www/','https://electrum.org']",
             Commands._setconfig_normalize_value('rpcpassword', "['file:///var/www/','https://electrum.org']"))
+
+    def test_read_payouts(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            with open(path, 'w') as f:
+                f.write('1NNkttn1YvVGdqBW4PR6zvc3Zx3H5owKRf, 0.001\n\n'
+                        'qqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqq,1\n')
+            self.assertEqual([['1NNkttn1YvVGdqBW4PR6zvc3Zx3H5owKRf', '0.001'],
+                              ['qqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqq', '1']],
+                             read_payouts(path))
+            with open(path, 'w') as f:
+                f.write(' [["1NNkttn1YvVGdqBW4PR6zvc3Zx3H5owKRf", 0.1], ["x", 2]]')
+            self.assertEqual([['1NNkttn1YvVGdqBW4PR6zvc3Zx3H5owKRf', '0.1'], ['x', 2]],
+                             read_payouts(path))
+            with open(path, 'w') as f:
+                f.write('address,amount\n')
+            with self.assertRaises(BaseException):
+                read_payouts(path)
+        finally:
+            os.unlink(path)
@@ -1,3 +1,5 @@
+import json
+import socket
 import unittest
 
 from .. import interface
@@ -24,3 +26,78 @@ class TestInterface(unittest.TestCase):
         self.assertTrue(i.check_host_name(
             peercert={'subject': [('commonName', 'foo.bar.com')]},
             name='foo.bar.com'))
+
+
+class TestInterfaceFlowControl(unittest.TestCase):
+
+    def setUp(self):
+        self.sock, self.remote = socket.socketpair()
+        self.interface = interface.Interface('localhost:1:t', self.sock)
+        self.remote.settimeout(1)
+
+    def tearDown(self):
+        self.interface.close()
+        self.remote.close()
+
+    def read_messages(self, count):
+        data = b''
+        while data.count(b'\n') < count:
+            data += self.remote.recv(65536)
+        return [json.loads(line) for line in data.decode().splitlines()]
+
+    def test_batches(self):
+        i = self.interface
+        i.batching = True
+        for n in range(250):
+            i.queue_request('server.ping', [], n)
+        self.assertEqual(i.INITIAL_WINDOW, i.num_requests())
+        self.assertTrue(i.send_requests())
+        batches = self.read_messages(1)
+        self.assertEqual([i.BATCH_SIZE], [len(b) for b in batches])
+        self.assertEqual(list(range(100)), [r['id'] for r in batches[0]])
+        # Answer in one array; the window grows as it is being used
+        self.remote.sendall(json.dumps([{'id': r['id'], 'result': None}
+                                        for r in batches[0]]).encode() + b'\n')
+        responses = i.get_responses()
+        self.assertEqual(list(range(100)), [r['id'] for _, r in responses])
+        self.assertEqual(list(range(100)), [q[2] for q, _ in responses])
+        self.assertGreater(i.window, i.INITIAL_WINDOW)
+        self.assertEqual(i.window, i.num_requests())
+
+    def test_batch_rejected(self):
+        i = self.interface
+        i.batching = True
+        i.window = 150
+        for n in range(150):
+            i.queue_request('server.ping', [], n)
+        self.assertTrue(i.send_requests())
+        self.assertEqual([100, 50], [len(b) for b in self.read_messages(2)])
+        # Each batch is answered with a single error without an id
+        rejection = b'{"jsonrpc": "2.0", "id": null, "error": {"code": -32600, "message": "bad"}}\n'
+        self.remote.sendall(rejection * 2)
+        self.assertEqual([], i.get_responses())
+        self.assertFalse(i.batching)
+        self.assertEqual({}, i.unanswered_requests)
+        self.assertEqual(list(range(150)), [r[2] for r in i.unsent_requests])
+        # Sent again one by one
+        self.assertTrue(i.send_requests())
+        messages = self.read_messages(150)
+        self.assertEqual(list(range(150)), [r['id'] for r in messages])
+
+    def test_accepts_batches(self):
+        Interface = interface.Interface
+        self.assertTrue(Interface.accepts_batches(['ElectrumX 1.8.7', '1.4']))
+        self.assertTrue(Interface.accepts_batches(['Fulcrum 1.0.3', '1.4']))
+        self.assertFalse(Interface.accepts_batches([]))
+        self.assertFalse(Interface.accepts_batches(['electrum-cash-server 0.2', '1.4']))
+        self.assertFalse(Interface.accepts_batches(None))
+
+    def test_busy_server(self):
+        i = self.interface
+        for n in range(10):
+            i.queue_request('server.ping', [], n)
+        self.assertTrue(i.send_requests())
+        self.assertEqual(10, len(self.read_messages(10)))
+        self.remote.sendall(b'{"id": 0, "error": {"code": -101, "message": "busy"}}\n')
+        self.assertEqual(1, len(i.get_responses()))
+        self.assertEqual(i.INITIAL_WINDOW // 2, i.window)
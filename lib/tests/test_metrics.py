@@ -0,0 +1,54 @@
+import json
+import unittest
+
+from ..metrics import Metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_stats(self):
+        metrics = Metrics()
+        for i in range(1, 101):
+            metrics.observe('command', 'getbalance', i / 1000)
+        metrics.incr('network_bytes_sent', 10)
+        metrics.incr('network_bytes_sent', 5)
+        stats = metrics.stats()
+        self.assertEqual({'network_bytes_sent': 15}, stats['counters'])
+        d = stats['command']['getbalance']
+        self.assertEqual(100, d['count'])
+        self.assertAlmostEqual(5.05, d['total'])
+        self.assertEqual((0.051, 0.096, 0.1), (d['p50'], d['p95'], d['p99']))
+        json.dumps(stats)
+
+    def test_recent_samples(self):
+        metrics = Metrics()
+        for i in range(3000):
+            metrics.observe('command', 'history', 1.0 if i < 2000 else 0.0)
+        d = metrics.stats()['command']['history']
+        # Quantiles are of the recent calls, counts of every call
+        self.assertEqual(3000, d['count'])
+        self.assertEqual(0.0, d['p99'])
+
+    def test_timed(self):
+        metrics = Metrics()
+        @metrics.timed('synchronizer')
+        def on_status(fail):
+            if fail:
+                raise ValueError
+            return 1
+        self.assertEqual(1, on_status(False))
+        self.assertRaises(ValueError, on_status, True)
+        self.assertEqual(2, metrics.stats()['synchronizer']['on_status']['count'])
+
+    def test_prometheus(self):
+        metrics = Metrics()
+        metrics.observe('network_response', 'blockchain.scripthash.subscribe', 0.25)
+        metrics.incr('storage_bytes_written', 100)
+        lines = metrics.prometheus().splitlines()
+        self.assertIn('# TYPE electroncash_storage_bytes_written_total counter', lines)
+        self.assertIn('electroncash_storage_bytes_written_total 100', lines)
+        self.assertIn('# TYPE electroncash_network_response_seconds summary', lines)
+        label = 'name="blockchain.scripthash.subscribe"'
+        self.assertIn('electroncash_network_response_seconds{%s,quantile="0.5"} 0.25' % label, lines)
+        self.assertIn('electroncash_network_response_seconds_sum{%s} 0.25' % label, lines)
+        self.assertIn('electroncash_network_response_seconds_count{%s} 1' % label, lines)
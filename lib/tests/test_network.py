@@ -0,0 +1,72 @@
+import unittest
+from unittest import mock
+
+from .. import network
+from ..metrics import Metrics
+from ..network import Network
+
+
+class FakeNetwork:
+    hash_chunk = Network.hash_chunk
+    hash_and_connect_chunk = Network.hash_and_connect_chunk
+
+    def __init__(self, header_workers):
+        self.header_workers = header_workers
+        self.header_pool = None
+        self.pending_chunks = []
+        self.connected = []
+        self.errors = []
+
+    def connect_chunk(self, *args, hashes=None):
+        self.connected.append(args)
+
+    def print_error(self, *msg):
+        self.errors.append(msg)
+
+
+class TestHeaderPool(unittest.TestCase):
+
+    def test_pool_unavailable(self):
+        n = FakeNetwork(2)
+        args = ('interface', 'blockchain', 0, 10, bytes(80 * 10), False, False, None)
+        with mock.patch.object(network.multiprocessing, 'get_context',
+                               side_effect=OSError('no sem_open')) as get_context:
+            n.hash_and_connect_chunk(args)
+            # The chunk is connected in the network thread instead
+            self.assertEqual([args], n.connected)
+            self.assertEqual([], n.pending_chunks)
+            self.assertEqual(0, n.header_workers)
+            self.assertIsNone(n.header_pool)
+            # and the pool is not tried again
+            n.hash_and_connect_chunk(args)
+            self.assertEqual(1, get_context.call_count)
+        self.assertEqual([args, args], n.connected)
+        self.assertEqual(1, len(n.errors))
+
+
+class ResponseNetwork:
+    process_response = Network.process_response
+
+    def _process_response(self, interface, request, response, callbacks):
+        if 'error' in response:
+            raise ValueError(response['error'])
+
+
+class TestResponseTimers(unittest.TestCase):
+
+    def test_timers(self):
+        n = ResponseNetwork()
+        with mock.patch.object(network, 'metrics', Metrics()) as metrics:
+            request = ('blockchain.transaction.get', ['00'], 1)
+            n.process_response(None, request, {'method': request[0], 'result': ''}, [])
+            with self.assertRaises(ValueError):
+                n.process_response(None, request, {'method': request[0], 'error': 'x'}, [])
+            for method in ('blockchain.scripthash.subscribe', 'spam.1', 'spam.2'):
+                n.process_response(None, None, {'method': method, 'params': []}, [])
+            timers = metrics.stats()['network_response']
+        # Responses whose handler raises are counted, and notifications
+        # we did not subscribe to share one timer
+        self.assertEqual({'blockchain.transaction.get': 2,
+                          'blockchain.scripthash.subscribe': 1,
+                          'unknown': 2},
+                         {method: d['count'] for method, d in timers.items()})
@@ -1,8 +1,10 @@
+import os
+import random
 import unittest
 from pprint import pprint
 
 from .. import transaction
-from ..address import Address
+from ..address import Address, PublicKey, ScriptOutput
 from ..bitcoin import TYPE_ADDRESS
 
 from ..keystore import xpubkey_to_address
@@ -131,6 +133,95 @@ class TestTransaction(unittest.TestCase):
 
         self.assertEqual(tx.estimated_size(), 191)
 
+    def test_lazy_inputs_outputs(self):
+        tx = transaction.Transaction(unsigned_blob)
+        self.assertEqual(tx.outputs(), [(TYPE_ADDRESS, Address.from_string('1MYXdf4moacvaEKZ57ozerpJ3t9xSeN6LK'), 20112408)])
+        self.assertIsNone(tx._inputs)
+        self.assertEqual(tx.locktime, 507231)
+        # the partial tx carries the value of its incomplete input
+        self.assertEqual(tx.inputs()[0]['value'], 20112600)
+        self.assertEqual(tx.serialize(), unsigned_blob)
+
+    def test_deserialize_bytes(self):
+        self.assertEqual(transaction.deserialize(bytes.fromhex(signed_blob)),
+                         transaction.deserialize(signed_blob))
+        with self.assertRaises(transaction.SerializationError):
+            transaction.deserialize(signed_blob[:-10])
+
+    def test_sighash_midstate_invalidation(self):
+        tx = transaction.Transaction(unsigned_blob)
+        preimage = tx.serialize_preimage(0)
+        self.assertEqual(preimage, tx.serialize_preimage(0))
+
+        def fresh_preimage():
+            fresh = transaction.Transaction.from_io(tx.inputs(), tx.outputs(), tx.locktime)
+            return fresh.serialize_preimage(0)
+
+        tx.add_outputs([(TYPE_ADDRESS, Address.from_string('13Vp8Y3hD5Cb6sERfpxePz5vGJizXbWciN'), 1000)])
+        self.assertNotEqual(preimage, tx.serialize_preimage(0))
+        self.assertEqual(fresh_preimage(), tx.serialize_preimage(0))
+        preimage = tx.serialize_preimage(0)
+        tx.BIP_LI01_sort()
+        self.assertNotEqual(preimage, tx.serialize_preimage(0))
+        self.assertEqual(fresh_preimage(), tx.serialize_preimage(0))
+
+    def test_estimated_size_matches_serialization(self):
+        r = random.Random(1)
+        prefixes = ['02', '03', '04', 'fe', 'ff', 'fd']
+
+        def x_pubkey():
+            return r.choice(prefixes) + os.urandom(r.choice((32, 64, 78))).hex()
+
+        def txin():
+            d = {'prevout_hash': os.urandom(32).hex(), 'prevout_n': r.randrange(300),
+                 'value': r.randrange(10**8)}
+            _type = r.choice(('p2pkh', 'p2sh', 'p2pk', 'unknown'))
+            if _type == 'unknown':
+                d['scriptSig'] = os.urandom(r.choice((0, 10, 300))).hex()
+                num_sig = 0
+            elif _type == 'p2sh':
+                n = r.randint(1, 15)
+                num_sig = r.randint(1, n)
+                d['x_pubkeys'] = [x_pubkey() for i in range(n)]
+            else:
+                num_sig = 1
+                d['x_pubkeys'] = [x_pubkey()]
+            d.update(type=_type, num_sig=num_sig, signatures=[None] * num_sig)
+            return d
+
+        def output():
+            kind = r.randrange(4)
+            if kind == 0:
+                addr = Address.from_P2PKH_hash(os.urandom(20))
+            elif kind == 1:
+                addr = Address.from_P2SH_hash(os.urandom(20))
+            elif kind == 2:
+                addr = PublicKey.from_pubkey(bytes([2]) + os.urandom(32))
+            else:
+                addr = ScriptOutput(os.urandom(r.choice((0, 1, 80, 252, 253, 70000))))
+            return (TYPE_ADDRESS, addr, r.randrange(10**8))
+
+        for n_inputs, n_outputs in ((1, 1), (3, 2), (20, 20), (253, 1), (1, 253)):
+            inputs = [txin() for i in range(n_inputs)]
+            outputs = [output() for i in range(n_outputs)]
+            tx = transaction.Transaction.from_io(inputs, outputs)
+            self.assertEqual(len(tx.serialize(True)) // 2, tx.estimated_size())
+            for d in inputs:
+                script = tx.input_script(d, True)
+                self.assertEqual(len(tx.serialize_input(d, script, True)) // 2,
+                                 tx.estimated_input_size(d))
+            for o in outputs:
+                self.assertEqual(len(tx.serialize_output(o)) // 2,
+                                 tx.estimated_output_size(o))
+
+    def test_no_signature_pushes(self):
+        # Every way of pushing the one byte placeholder
+        for push in ('01ff', '4c01ff', '4d0100ff', '4e01000000ff'):
+            script = bytes.fromhex('00' + push + '21' + '02' * 33)
+            self.assertTrue(any(p in script for p in transaction.NO_SIGNATURE_PUSHES), push)
+        script = bytes.fromhex('00' + '4730' + '01' * 70 + '21' + '02' * 33)
+        self.assertFalse(any(p in script for p in transaction.NO_SIGNATURE_PUSHES))
+
     def test_errors(self):
         with self.assertRaises(TypeError):
             transaction.Transaction.pay_script(output_type=None, addr='')
@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ..tx_cache import TxCache
+
+
+class TestTxCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.txs = [os.urandom(100) for i in range(5)]
+        self.txids = [TxCache.txid(raw) for raw in self.txs]
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_get_put(self):
+        cache = TxCache(self.path)
+        self.assertIsNone(cache.get(self.txids[0]))
+        self.assertTrue(cache.put(self.txids[0], self.txs[0]))
+        self.assertFalse(cache.put(self.txids[1], self.txs[0]))
+        self.assertEqual(self.txs[0], cache.get(self.txids[0]))
+        self.assertIsNone(cache.get(self.txids[1]))
+        stats = cache.stats()
+        self.assertEqual((1, 2, 1, 1), (stats['hits'], stats['misses'],
+                                        stats['stores'], stats['rejected']))
+        # Shared on disk
+        self.assertEqual(self.txs[0], TxCache(self.path).get(self.txids[0]))
+
+    def test_eviction(self):
+        cache = TxCache(self.path, max_size=300)
+        for txid, raw in zip(self.txids[:3], self.txs[:3]):
+            cache.put(txid, raw)
+        cache.get(self.txids[0])
+        cache.put(self.txids[3], self.txs[3])
+        # The least recently used is evicted
+        self.assertIsNone(cache.get(self.txids[1]))
+        self.assertEqual(1, cache.stats()['evictions'])
+        self.assertEqual(300, cache.size)
+        self.assertEqual(3, sum(len(files) for _, _, files in os.walk(self.path)))
+        cache = TxCache(self.path, max_size=300)
+        self.assertEqual({self.txids[0], self.txids[2], self.txids[3]}, set(cache.entries))
+
+    def test_corrupt_file(self):
+        cache = TxCache(self.path)
+        cache.put(self.txids[0], self.txs[0])
+        with open(cache.file_path(self.txids[0]), 'wb') as f:
+            f.write(self.txs[1])
+        self.assertIsNone(cache.get(self.txids[0]))
+        self.assertFalse(os.path.exists(cache.file_path(self.txids[0])))
+        self.assertEqual(0, cache.size)
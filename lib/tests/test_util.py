@@ -1,5 +1,9 @@
+import json
+import socket
+import threading
+import time
 import unittest
-from ..util import format_satoshis
+from ..util import format_satoshis, SocketPipe, timeout, RWLock
 from ..web import parse_URI
 
 class TestUtil(unittest.TestCase):
@@ -110,3 +114,64 @@ class TestUtil(unittest.TestCase):
 
     def test_parse_URI_parameter_polution(self):
         self.assertRaises(Exception, parse_URI, 'bitcoincash:15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma?amount=0.0003&label=test&amount=30.0')
+
+
+class TestSocketPipe(unittest.TestCase):
+
+    def setUp(self):
+        self.sock, self.remote = socket.socketpair()
+        self.pipe = SocketPipe(self.sock)
+        self.pipe.set_timeout(0.0)
+
+    def tearDown(self):
+        self.sock.close()
+        self.remote.close()
+
+    def test_get(self):
+        big = {'id': 1, 'result': {'hex': '00' * 20000}}
+        data = (json.dumps(big) + '\n{"id": 2}\nnot json\n{"id": 3}\n{"id"').encode()
+        # Split across sends, including one in the middle of a message
+        self.remote.sendall(data[:1000])
+        self.assertRaises(timeout, self.pipe.get)
+        self.remote.sendall(data[1000:])
+        self.assertEqual(big, self.pipe.get())
+        self.assertEqual({'id': 2}, self.pipe.get())
+        self.assertEqual({'id': 3}, self.pipe.get())
+        self.assertRaises(timeout, self.pipe.get)
+        self.remote.sendall(b': 4}\n')
+        self.assertEqual({'id': 4}, self.pipe.get())
+        self.remote.close()
+        self.assertIsNone(self.pipe.get())
+
+
+class TestRWLock(unittest.TestCase):
+
+    def test_readers_and_writer(self):
+        lock = RWLock()
+        events = []
+
+        def write():
+            with lock.write_lock():
+                events.append('write')
+
+        def late_read():
+            with lock.read_lock():
+                events.append('late read')
+
+        with lock.read_lock():
+            # Readers share the lock
+            with lock.read_lock():
+                pass
+            writer = threading.Thread(target=write)
+            writer.start()
+            while not lock.writers_waiting:
+                time.sleep(0.01)
+            events.append('read')
+            # A reader arriving after the writer waits for it
+            reader = threading.Thread(target=late_read)
+            reader.start()
+            reader.join(0.1)
+            self.assertTrue(reader.is_alive())
+        writer.join()
+        reader.join()
+        self.assertEqual(['read', 'write', 'late read'], events)
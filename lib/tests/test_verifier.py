@@ -0,0 +1,169 @@
+import threading
+import unittest
+
+from ..bitcoin import Hash, hash_encode, hash_decode
+from ..verifier import SPV
+from ..wallet import Abstract_Wallet
+
+
+def make_block(txids):
+    '''Returns the merkle root of a block of two transactions, and their
+    merkle branches.'''
+    a, b = (hash_decode(txid) for txid in txids)
+    return hash_encode(Hash(a + b)), [[txids[1]], [txids[0]]]
+
+
+class FakeBlockchain:
+
+    def __init__(self, headers):
+        self.headers = headers
+
+    def read_header(self, height):
+        return self.headers.get(height)
+
+
+class FakeInterface:
+
+    def __init__(self, blockchain):
+        self.blockchain = blockchain
+
+
+class FakeNetwork:
+
+    def __init__(self, blockchain):
+        self.interface = FakeInterface(blockchain)
+        self.sent = []
+
+    def blockchain(self):
+        return self.interface.blockchain
+
+    def get_local_height(self):
+        return max(self.interface.blockchain.headers)
+
+    def send(self, messages, callback):
+        self.sent.append(list(messages))
+
+
+class FakeWallet:
+    get_spv_proof = Abstract_Wallet.get_spv_proof
+    add_spv_proof = Abstract_Wallet.add_spv_proof
+    _remove_spv_proof = Abstract_Wallet._remove_spv_proof
+
+    def __init__(self, unverified):
+        self.lock = threading.RLock()
+        self.spv_proofs = {}
+        self.spv_proof_roots = {}
+        self.unverified_tx = dict(unverified)
+        self.verified_tx = {}
+        self.saved = 0
+
+    def get_unverified_txs(self):
+        return self.unverified_tx
+
+    def add_verified_tx(self, tx_hash, info):
+        self.unverified_tx.pop(tx_hash)
+        self.verified_tx[tx_hash] = info
+
+    def is_up_to_date(self):
+        return True
+
+    def save_verified_tx(self, write=False):
+        self.saved += 1
+
+
+class TestSPV(unittest.TestCase):
+
+    def setUp(self):
+        self.txids = [hash_encode(Hash(bytes([i]))) for i in range(6)]
+        self.headers = {}
+        self.branches = {}
+        for height in (100, 101, 102):
+            txids = self.txids[2 * (height - 100):2 * (height - 100) + 2]
+            merkle_root, branches = make_block(txids)
+            self.headers[height] = {'merkle_root': merkle_root, 'timestamp': height}
+            for pos, (txid, branch) in enumerate(zip(txids, branches)):
+                self.branches[txid] = {'block_height': height, 'pos': pos, 'merkle': branch}
+        self.unverified = {txid: self.branches[txid]['block_height'] for txid in self.txids}
+
+    def make_spv(self, wallet):
+        network = FakeNetwork(FakeBlockchain(self.headers))
+        spv = SPV(network, wallet)
+        wallet.verifier = spv
+        return spv, network
+
+    def answer(self, spv, messages):
+        for method, params in messages:
+            spv.verify_merkle({'params': params, 'result': self.branches[params[0]]})
+
+    def test_requests_capped(self):
+        wallet = FakeWallet(self.unverified)
+        spv, network = self.make_spv(wallet)
+        spv.MAX_REQUESTED_MERKLE = 4
+        spv.run()
+        self.assertEqual(1, len(network.sent))
+        self.assertEqual(self.txids[:4], [params[0] for method, params in network.sent[0]])
+        spv.run()
+        self.assertEqual(1, len(network.sent))
+        self.answer(spv, network.sent[0])
+        spv.run()
+        self.assertEqual(self.txids[4:], [params[0] for method, params in network.sent[1]])
+        self.answer(spv, network.sent[1])
+        self.assertEqual({}, wallet.unverified_tx)
+        self.assertEqual((101, 101, 1), wallet.verified_tx[self.txids[3]])
+
+    def test_failures_retried(self):
+        wallet = FakeWallet(self.unverified)
+        spv, network = self.make_spv(wallet)
+        spv.MAX_REQUESTED_MERKLE = 4
+        spv.run()
+        sent = network.sent[0]
+        spv.verify_merkle({'params': sent[0][1], 'error': 'no such tx'})
+        bad = dict(self.branches[sent[1][1][0]], merkle=[self.txids[5]])
+        spv.verify_merkle({'params': sent[1][1], 'result': bad})
+        self.assertEqual(set(self.txids[2:4]), spv.requested_merkle)
+        # The failed proofs no longer count toward the cap, but are not
+        # requested again straight away
+        spv.run()
+        self.assertEqual(self.txids[4:], [params[0] for method, params in network.sent[1]])
+        spv.run()
+        self.assertEqual(2, len(network.sent))
+        self.answer(spv, network.sent[1])
+        self.answer(spv, sent[2:])
+        # Once their delay has passed
+        delays = [spv.retry_after[txid][1] for txid in self.txids[:2]]
+        self.assertEqual([spv.RETRY_DELAY] * 2, delays)
+        for txid in self.txids[:2]:
+            spv.retry_after[txid] = (0, spv.RETRY_DELAY)
+        spv.run()
+        self.assertEqual(self.txids[:2], [params[0] for method, params in network.sent[2]])
+        self.answer(spv, network.sent[2])
+        self.assertEqual({}, wallet.unverified_tx)
+        self.assertEqual({}, spv.retry_after)
+
+    def test_verify_from_saved_proofs(self):
+        wallet = FakeWallet(self.unverified)
+        spv, network = self.make_spv(wallet)
+        spv.run()
+        self.answer(spv, network.sent[0])
+        self.assertEqual(3, len(wallet.spv_proofs))
+        # A restart, and block 101 replaced by a reorg
+        proofs = wallet.spv_proofs
+        wallet = FakeWallet(self.unverified)
+        wallet.spv_proofs = proofs
+        wallet.spv_proof_roots = {txid: root for root, txs in proofs.items() for txid in txs}
+        txids = [self.txids[3], self.txids[2]]
+        merkle_root, branches = make_block(txids)
+        self.headers[101] = {'merkle_root': merkle_root, 'timestamp': 0}
+        for pos, (txid, branch) in enumerate(zip(txids, branches)):
+            self.branches[txid] = {'block_height': 101, 'pos': pos, 'merkle': branch}
+        spv, network = self.make_spv(wallet)
+        spv.run()
+        self.assertEqual([self.txids[2], self.txids[3]],
+                         [params[0] for method, params in network.sent[0]])
+        self.assertEqual(set(self.txids) - set(self.txids[2:4]), set(wallet.verified_tx))
+        self.assertEqual(0, wallet.saved)
+        self.answer(spv, network.sent[0])
+        self.assertEqual({}, wallet.unverified_tx)
+        self.assertEqual((101, 0, 0), wallet.verified_tx[self.txids[3]])
+        self.assertEqual({self.txids[3]: 0, self.txids[2]: 1}, wallet.spv_proofs[merkle_root])
+        self.assertEqual(1, wallet.saved)
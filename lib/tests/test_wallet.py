@@ -6,7 +6,7 @@ import os
 import json
 
 from io import StringIO
-from ..storage import WalletStorage, FINAL_SEED_VERSION
+from ..storage import WalletStorage, FINAL_SEED_VERSION, JOURNAL_SUFFIX
 from .. import wallet
 
 
@@ -68,3 +68,458 @@ class TestWalletStorage(WalletTestCase):
         with open(self.wallet_path, "r") as f:
             contents = f.read()
         self.assertEqual(some_dict, json.loads(contents))
+
+    def test_journal(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('transactions', {'a': '00', 'b': '01'})
+        storage.put('labels', {'x': 'y'})
+        storage.write()
+        journal_path = self.wallet_path + JOURNAL_SUFFIX
+        self.assertFalse(os.path.exists(journal_path))
+        with open(self.wallet_path, "r") as f:
+            snapshot = f.read()
+
+        # only the changed subkeys are appended
+        storage.put('transactions', {'a': '00', 'c': '02'})
+        storage.put('labels', None)
+        storage.put('stored_height', 10)
+        storage.write()
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual(snapshot, f.read())
+        with open(journal_path, "r") as f:
+            lines = f.read().splitlines()
+        self.assertEqual(2, len(lines))
+        self.assertEqual({'del': ['labels'],
+                          'patch': {'transactions': {'c': '02'}},
+                          'set': {'stored_height': 10},
+                          'unset': {'transactions': ['b']}},
+                         json.loads(lines[1]))
+
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual({'a': '00', 'c': '02'}, storage.get('transactions'))
+        self.assertEqual(None, storage.get('labels'))
+        self.assertEqual(10, storage.get('stored_height'))
+
+        # a record cut short by a crash is dropped, and overwritten next time
+        with open(journal_path, "a") as f:
+            f.write('{"set": {"stored_he')
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual(10, storage.get('stored_height'))
+        storage.put('stored_height', 11)
+        storage.write()
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual(11, storage.get('stored_height'))
+
+        # compaction leaves a single file in the old format
+        storage.compact()
+        self.assertFalse(os.path.exists(journal_path))
+        with open(self.wallet_path, "r") as f:
+            data = json.loads(f.read())
+        self.assertEqual({'a': '00', 'c': '02'}, data['transactions'])
+        self.assertEqual(11, data['stored_height'])
+
+    def test_backup(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('labels', {'x': 'y'})
+        storage.write()
+        storage.put('labels', {'x': 'y', 'z': 'w'})
+        storage.write()
+        self.assertTrue(os.path.exists(self.wallet_path + JOURNAL_SUFFIX))
+        storage.put('stored_height', 10)
+
+        backup_path = os.path.join(self.user_dir, "backup")
+        storage.backup(backup_path)
+        self.assertFalse(os.path.exists(backup_path + JOURNAL_SUFFIX))
+        backup = WalletStorage(backup_path, manual_upgrades=True)
+        self.assertEqual({'x': 'y', 'z': 'w'}, backup.get('labels'))
+        self.assertEqual(10, backup.get('stored_height'))
+
+    def test_rename_and_delete_files(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('a', 1)
+        storage.write()
+        storage.put('a', 2)
+        storage.write()
+        new_path = os.path.join(self.user_dir, "renamed")
+        # a journal left behind by an older wallet of that name
+        with open(new_path + JOURNAL_SUFFIX, "w") as f:
+            f.write('{"snapshot": "00"}\n')
+
+        WalletStorage.rename_files(self.wallet_path, new_path)
+        self.assertFalse(os.path.exists(self.wallet_path + JOURNAL_SUFFIX))
+        self.assertEqual(2, WalletStorage(new_path, manual_upgrades=True).get('a'))
+
+        WalletStorage.delete_files(new_path)
+        self.assertEqual([], os.listdir(self.user_dir))
+
+    def test_nocopy(self):
+        storage = WalletStorage(self.wallet_path)
+        txs = {'a': '00', 'b': '01'}
+        storage.put_nocopy('transactions', txs)
+        self.assertIs(txs, storage.get_nocopy('transactions'))
+        self.assertIsNot(txs, storage.get('transactions'))
+        storage.write()
+
+        storage.put_nocopy('transactions', dict(txs, c='02'))
+        storage.write()
+        with open(self.wallet_path + JOURNAL_SUFFIX, "r") as f:
+            record = json.loads(f.read().splitlines()[1])
+        self.assertEqual({'patch': {'transactions': {'c': '02'}}}, record)
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual({'a': '00', 'b': '01', 'c': '02'},
+                         storage.get_nocopy('transactions'))
+
+    def test_journal_tuples(self):
+        # Values the wallet holds as tuples are loaded back as lists
+        storage = WalletStorage(self.wallet_path)
+        txi = {'a': {'addr': [('00:0', 5)]}, 'b': {'addr': [('01:1', 6)]}}
+        storage.put_nocopy('txi', txi)
+        storage.put_nocopy('verified_tx3', {'a': (100, 1000, 1)})
+        storage.write()
+
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        storage.put_nocopy('txi', dict(txi))
+        storage.put_nocopy('verified_tx3', {'a': (100, 1000, 1)})
+        storage.write()
+        self.assertFalse(os.path.exists(self.wallet_path + JOURNAL_SUFFIX))
+        storage.put_nocopy('txi', dict(txi, c={'addr': [('02:0', 7)]}))
+        storage.put_nocopy('verified_tx3', {'a': (100, 1000, 1), 'c': (101, 1001, 0)})
+        storage.write()
+        with open(self.wallet_path + JOURNAL_SUFFIX, "r") as f:
+            lines = f.read().splitlines()
+        self.assertEqual(2, len(lines))
+        self.assertEqual({'patch': {'txi': {'c': {'addr': [['02:0', 7]]}},
+                                    'verified_tx3': {'c': [101, 1001, 0]}}},
+                         json.loads(lines[1]))
+
+    def test_journal_ignored_if_stale(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('a', 1)
+        storage.write()
+        storage.put('a', 2)
+        storage.write()
+        # the wallet file is replaced by something unaware of the journal
+        with open(self.wallet_path, "w") as f:
+            f.write(json.dumps({'a': 3, 'seed_version': FINAL_SEED_VERSION}))
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual(3, storage.get('a'))
+        storage.put('b', 4)
+        storage.write()
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual(3, storage.get('a'))
+        self.assertEqual(4, storage.get('b'))
+
+    def test_journal_encrypted(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('a', 1)
+        storage.set_password('secret', True)
+        storage.write()
+        storage.put('transactions', {'t': 'ff'})
+        storage.write()
+        with open(self.wallet_path + JOURNAL_SUFFIX, "r") as f:
+            self.assertNotIn('transactions', f.read())
+
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertTrue(storage.is_encrypted())
+        storage.decrypt('secret')
+        self.assertEqual(1, storage.get('a'))
+        self.assertEqual({'t': 'ff'}, storage.get('transactions'))
+
+        # removing the password rewrites everything in the clear
+        storage.set_password(None, False)
+        storage.write()
+        self.assertFalse(os.path.exists(self.wallet_path + JOURNAL_SUFFIX))
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertFalse(storage.is_encrypted())
+        self.assertEqual({'t': 'ff'}, storage.get('transactions'))
+
+
+class FakeTransaction(object):
+
+    def __init__(self, inputs, outputs):
+        self._inputs = inputs
+        self._outputs = outputs
+
+    def inputs(self):
+        return self._inputs
+
+    def outputs(self):
+        return self._outputs
+
+
+def fake_txid(i):
+    return '%064x' % i
+
+
+class ImportedWalletTestCase(WalletTestCase):
+
+    def setUp(self):
+        super(ImportedWalletTestCase, self).setUp()
+        storage = WalletStorage(self.wallet_path)
+        self.wallet = wallet.ImportedAddressWallet(storage)
+        self.addrs = [wallet.Address.from_P2PKH_hash(bytes([i]) * 20)
+                      for i in range(1, 4)]
+        for addr in self.addrs:
+            self.wallet.import_address(addr)
+        self.foreign = wallet.Address.from_P2PKH_hash(bytes(20))
+
+    def receive(self, txid, height, outputs, inputs=None):
+        w = self.wallet
+        if inputs is None:
+            inputs = [{'type': 'p2pkh', 'address': self.foreign,
+                       'prevout_hash': fake_txid(0), 'prevout_n': 0}]
+        tx = FakeTransaction(inputs, [(0, addr, v) for addr, v in outputs])
+        addrs = set(addr for addr, v in outputs) | set(
+            i['address'] for i in inputs if w.is_mine(i['address']))
+        for addr in addrs:
+            hist = [h for h in w.get_address_history(addr) if h[0] != txid]
+            w.receive_history_callback(addr, hist + [(txid, height)], {})
+        w.receive_tx_callback(txid, tx, height)
+
+    def spend(self, txid, height, prevouts, outputs):
+        inputs = [{'type': 'p2pkh', 'address': addr,
+                   'prevout_hash': prevout_hash, 'prevout_n': n}
+                  for addr, prevout_hash, n in prevouts]
+        self.receive(txid, height, outputs, inputs)
+
+
+class TestWalletBalanceCache(ImportedWalletTestCase):
+
+    def slow_balance(self, addr, exclude_frozen_coins=False):
+        ''' Reference implementation walking the address history. '''
+        w = self.wallet
+        received = {}
+        sent = {}
+        for tx_hash, height in w.get_address_history(addr):
+            for n, v, is_cb in w.txo.get(tx_hash, {}).get(addr, []):
+                received[(tx_hash, n)] = (height, v)
+            for txi, v in w.txi.get(tx_hash, {}).get(addr, []):
+                sent[txi] = height
+        c = u = 0
+        for txo, (height, v) in received.items():
+            if exclude_frozen_coins and txo in w.frozen_coins:
+                continue
+            if height > 0:
+                c += v
+            else:
+                u += v
+            if txo in sent:
+                if sent[txo] > 0:
+                    c -= v
+                else:
+                    u -= v
+        return c, u, 0
+
+    def check_consistency(self):
+        w = self.wallet
+        total = [0, 0, 0]
+        for addr in self.addrs:
+            bal = self.slow_balance(addr)
+            self.assertEqual(bal, w.get_addr_balance(addr))
+            total = [a + b for a, b in zip(total, bal)]
+        self.assertEqual(tuple(total), w.get_balance())
+        self.assertEqual(sum(total), sum(x['value'] for x in w.get_utxos()))
+        self.check_spend_index()
+
+    def check_spend_index(self):
+        w = self.wallet
+        spenders, pruned = w.txi_spenders, w.pruned_spends
+        w._build_spend_index()
+        self.assertEqual(w.txi_spenders, spenders)
+        self.assertEqual(w.pruned_spends, pruned)
+
+    def test_receive_and_spend(self):
+        w = self.wallet
+        a, b, c = self.addrs
+        self.receive(fake_txid(1), 100, [(a, 5000), (b, 7000)])
+        self.check_consistency()
+        self.assertEqual((12000, 0, 0), w.get_balance())
+        self.receive(fake_txid(2), 0, [(c, 1000)])
+        self.check_consistency()
+        self.assertEqual((12000, 1000, 0), w.get_balance())
+        self.spend(fake_txid(3), 0, [(a, fake_txid(1), 0)], [(c, 4000)])
+        self.check_consistency()
+        # the confirmed coin is spent by an unconfirmed tx
+        self.assertEqual((5000, -5000, 0), w.get_addr_balance(a))
+        self.assertEqual((12000, 0, 0), w.get_balance())
+        self.assertEqual({c}, set(x['address'] for x in w.get_utxos([a, c])))
+        # confirmation moves the balance from unconfirmed to confirmed
+        self.receive(fake_txid(2), 101, [(c, 1000)])
+        self.check_consistency()
+
+    def test_remove_transaction(self):
+        w = self.wallet
+        a, b, c = self.addrs
+        self.receive(fake_txid(1), 100, [(a, 5000)])
+        self.spend(fake_txid(2), 101, [(a, fake_txid(1), 0)], [(b, 4000)])
+        self.check_consistency()
+        self.assertEqual((4000, 0, 0), w.get_balance())
+        w.add_spv_proof(fake_txid(2), 'ab' * 32, 1)
+        # reorg the spend out of the history of both addresses
+        w.receive_history_callback(a, [(fake_txid(1), 100)], {})
+        w.receive_history_callback(b, [], {})
+        self.check_consistency()
+        self.assertEqual((5000, 0, 0), w.get_balance())
+        self.assertEqual([fake_txid(1)], [x['prevout_hash'] for x in w.get_utxos()])
+        self.assertIsNone(w.get_spv_proof(fake_txid(2)))
+        self.assertEqual({}, w.spv_proofs)
+
+    def test_undo_verifications(self):
+        w = self.wallet
+        self.receive(fake_txid(1), 100, [(self.addrs[0], 5000)])
+        self.receive(fake_txid(2), 90, [(self.addrs[1], 5000)])
+        w.verified_tx[fake_txid(1)] = (100, 1000, 1)
+        w.verified_tx[fake_txid(2)] = (90, 900, 1)
+        w.add_spv_proof(fake_txid(1), 'ab' * 32, 1)
+        w.add_spv_proof(fake_txid(2), 'cd' * 32, 1)
+        class Blockchain:
+            def read_header(self, height):
+                return None
+        self.assertEqual({fake_txid(1)}, w.undo_verifications(Blockchain(), 95))
+        self.assertIsNone(w.get_spv_proof(fake_txid(1)))
+        self.assertEqual(('cd' * 32, 1), w.get_spv_proof(fake_txid(2)))
+
+    def test_frozen_coins(self):
+        w = self.wallet
+        a, b, c = self.addrs
+        self.receive(fake_txid(1), 100, [(a, 5000), (b, 7000)])
+        self.receive(fake_txid(2), 0, [(a, 300)])
+        w.set_frozen_coin_state([fake_txid(1) + ':1'], True)
+        self.assertEqual(self.slow_balance(b, True), w.get_addr_balance(b, True))
+        self.assertEqual((5000, 300, 0), w.get_balance(exclude_frozen_coins=True))
+        self.assertEqual((7000, 0, 0), w.get_frozen_balance())
+        w.set_frozen_state([a], True)
+        self.assertEqual((0, 0, 0), w.get_balance(exclude_frozen_coins=True,
+                                                   exclude_frozen_addresses=True))
+        self.assertEqual((12000, 300, 0), w.get_frozen_balance())
+        self.assertEqual([], w.get_utxos(exclude_frozen=True))
+
+    def check_history(self):
+        w = self.wallet
+        expected = w._get_domain_history(w.get_addresses())
+        self.assertEqual(expected, w.get_history())
+        self.assertEqual(len(expected), w.get_history_len())
+        self.assertEqual(expected[1:3], w.get_history(offset=1, limit=2))
+
+    def test_history_index(self):
+        w = self.wallet
+        a, b, c = self.addrs
+        self.receive(fake_txid(1), 100, [(a, 5000), (b, 7000)])
+        self.receive(fake_txid(2), 102, [(c, 1000)])
+        self.spend(fake_txid(3), 0, [(a, fake_txid(1), 0)], [(c, 4000)])
+        self.check_history()
+        self.assertEqual([fake_txid(1), fake_txid(2), fake_txid(3)],
+                         [h[0] for h in w.get_history()])
+        self.assertEqual(12000, w.get_history()[-1][5])
+        # tx 2 is reorged below tx 1
+        self.receive(fake_txid(2), 99, [(c, 1000)])
+        self.check_history()
+        self.assertEqual([fake_txid(2), fake_txid(1), fake_txid(3)],
+                         [h[0] for h in w.get_history()])
+        self.assertEqual([1000, 13000, 12000], [h[5] for h in w.get_history()])
+        # reorg tx 1 out, its spend is now pruned
+        for addr in (a, b):
+            w.receive_history_callback(addr, [h for h in w.get_address_history(addr)
+                                              if h[0] != fake_txid(1)], {})
+        self.check_history()
+        self.assertEqual([fake_txid(2), fake_txid(3)], [h[0] for h in w.get_history()])
+        self.assertEqual({(fake_txid(1), 0): fake_txid(3)}, w.pruned_txo)
+        self.check_spend_index()
+        # and back in, the spend is matched again
+        self.receive(fake_txid(1), 100, [(a, 5000), (b, 7000)])
+        self.assertEqual({}, w.pruned_txo)
+        self.check_consistency()
+
+    def test_address_status(self):
+        w = self.wallet
+        a, b, c = self.addrs
+        self.assertIsNone(w.get_address_status(a))
+        self.receive(fake_txid(1), 100, [(a, 5000)])
+        self.receive(fake_txid(2), 0, [(b, 1000)])
+        status = wallet.Synchronizer.get_status(w.get_address_history(a))
+        self.assertEqual(status, w.get_address_status(a))
+        # Given by the synchronizer once checked against the history
+        w.receive_history_callback(c, [(fake_txid(3), 101)], {}, 'ff' * 32)
+        self.assertEqual('ff' * 32, w.get_address_status(c))
+        self.assertEqual([b, c, a], sorted(self.addrs, key=w.get_address_activity,
+                                           reverse=True))
+        w.save_transactions(write=True)
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual({a.to_string(wallet.Address.FMT_LEGACY): status,
+                          c.to_string(wallet.Address.FMT_LEGACY): 'ff' * 32},
+                         storage.get('addr_status'))
+        w.receive_history_callback(c, [], {})
+        self.assertIsNone(w.get_address_status(c))
+
+    def test_outpoints_saved_as_strings(self):
+        w = self.wallet
+        a, b, c = self.addrs
+        self.receive(fake_txid(1), 100, [(a, 5000)])
+        self.spend(fake_txid(2), 101, [(a, fake_txid(1), 0)], [(b, 4000)])
+        self.spend(fake_txid(3), 102, [(c, fake_txid(9), 0)], [(b, 100)])
+        w.set_frozen_coin_state([fake_txid(2) + ':0'], True)
+        self.assertTrue(w.is_frozen_coin((fake_txid(2), 0)))
+        w.save_transactions(write=True)
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual({a.to_string(wallet.Address.FMT_LEGACY): [[fake_txid(1) + ':0', 5000]]},
+                         storage.get('txi')[fake_txid(2)])
+        self.assertEqual({fake_txid(9) + ':0': fake_txid(3)}, storage.get('pruned_txo'))
+        self.assertEqual([fake_txid(2) + ':0'], storage.get('frozen_coins'))
+        w2 = wallet.ImportedAddressWallet(storage)
+        self.assertEqual(w.txi, w2.txi)
+        self.assertEqual(w.pruned_txo, w2.pruned_txo)
+        self.assertEqual(w.frozen_coins, w2.frozen_coins)
+        self.assertTrue(w2.is_frozen_coin(fake_txid(2) + ':0'))
+
+
+class TestPayoutTransactions(ImportedWalletTestCase):
+
+    def make_payouts(self, amount):
+        w = self.wallet
+        # Coins on separate addresses, which are spent together
+        addrs = [wallet.Address.from_P2PKH_hash(bytes([i]) * 20) for i in range(10, 22)]
+        for addr in addrs:
+            w.import_address(addr)
+        self.receive(fake_txid(1), 100, [(addr, 100000) for addr in addrs])
+        # Change addresses with no history yet
+        change = [wallet.Address.from_P2PKH_hash(bytes([i]) * 20) for i in range(30, 40)]
+        for addr in change:
+            w.import_address(addr)
+        w.get_change_addresses = lambda: change
+        payouts = [(0, wallet.Address.from_P2PKH_hash(i.to_bytes(20, 'big')), amount)
+                   for i in range(1000, 1300)]
+        config = {}
+        txs = w.make_payout_transactions(w.get_spendable_coins(None, config),
+                                         iter(payouts), config, 500, max_size=3000)
+        return payouts, change, txs
+
+    def test_payout_transactions(self):
+        w = self.wallet
+        payouts, change, txs = self.make_payouts(1000)
+        txs = list(txs)
+        self.assertLess(1, len(txs))
+        paid = []
+        spent = []
+        change_addrs = []
+        for tx, n in txs:
+            self.assertLessEqual(tx.estimated_size(), 3000)
+            self.assertEqual(500, tx.get_fee())
+            outputs = [o for o in tx.outputs() if not w.is_mine(o[1])]
+            self.assertEqual(n, len(outputs))
+            paid += outputs
+            change_addrs += [o[1] for o in tx.outputs() if o[1] in change]
+            spent += [(txin['prevout_hash'], txin['prevout_n']) for txin in tx.inputs()]
+        self.assertEqual(sorted(payouts), sorted(paid))
+        # No coin is spent twice, and no change address reused
+        self.assertEqual(len(spent), len(set(spent)))
+        self.assertEqual(len(txs), len(set(change_addrs)))
+
+    def test_payout_transactions_not_enough_funds(self):
+        payouts, change, txs = self.make_payouts(5000)
+        made = []
+        with self.assertRaises(wallet.NotEnoughFunds):
+            for tx, n in txs:
+                made.append(n)
+        # What the coins could pay for was made first
+        self.assertLess(0, len(made))
+        self.assertLess(sum(made), len(payouts))
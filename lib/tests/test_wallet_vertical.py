@@ -62,6 +62,41 @@ class TestWalletKeystoreAddressIntegrity(unittest.TestCase):
         self.assertEqual(w.get_change_addresses()[0],
                          Address.from_string('1KSezYMhAJMWqFbVFB2JshYg69UpmEXR4D'))
 
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_batch_derivation(self, mock_write):
+        ks = keystore.from_master_key('xpub661MyMwAqRbcFWohJWt7PHsFEJfZAvw9ZxwQoDa4SoMgsDDM1T7WK3u9E4edkC4ugRnZ8E4xDZRpk8Rnts3Nbt97dPwT52CwBdDWroaZf8U')
+        self.assertEqual(ks.derive_pubkeys(False, 3, 4),
+                         [ks.get_pubkey_from_xpub(ks.xpub, (0, i)) for i in range(3, 7)])
+        self.assertEqual(ks.derive_pubkey(True, 2),
+                         ks.get_pubkey_from_xpub(ks.xpub, (1, 2)))
+
+        store = storage.WalletStorage('if_this_exists_mocking_failed_648151893')
+        store.put('keystore', ks.dump())
+        store.put('gap_limit', 5)
+        store.put('stored_height', 1000)
+        w = wallet.Standard_Wallet(store)
+        w.synchronize()
+        addresses = list(w.get_receiving_addresses())
+        self.assertEqual(5, len(addresses))
+        self.assertEqual(6, len(w.get_change_addresses()))
+        self.assertEqual(addresses[0], Address.from_string('1NNkttn1YvVGdqBW4PR6zvc3Zx3H5owKRf'))
+        self.assertEqual(addresses[3], Address.from_pubkey(ks.derive_pubkey(False, 3)))
+
+        # using the 4th address extends the gap past it, a recent use does not
+        w._history[addresses[3]] = [('00' * 32, 900)]
+        w._history[addresses[4]] = [('11' * 32, 999)]
+        w.synchronize()
+        self.assertEqual(9, len(w.get_receiving_addresses()))
+        self.assertEqual(addresses, w.get_receiving_addresses()[:5])
+        self.assertEqual(w.get_receiving_addresses()[8], Address.from_pubkey(ks.derive_pubkey(False, 8)))
+        # the address index follows the derived addresses
+        change = w.get_change_addresses()[2]
+        self.assertEqual((False, 8), w.get_address_index(w.get_receiving_addresses()[8]))
+        self.assertEqual((True, 2), w.get_address_index(change))
+        self.assertTrue(w.is_change(change))
+        self.assertEqual(15, len(w.get_address_set()))
+        self.assertFalse(w.is_mine(Address.from_pubkey(ks.derive_pubkey(False, 9))))
+
     @mock.patch.object(storage.WalletStorage, '_write')
     def test_electrum_seed_old(self, mock_write):
         seed_words = 'powerful random nobody notice nothing important anyway look away hidden message over'
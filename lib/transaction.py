@@ -27,11 +27,12 @@
 
 # Note: The deserialization code originally comes from ABE.
 
-from .util import print_error, profiler
+from .util import print_error
 
 from .bitcoin import *
 from .address import (PublicKey, Address, Script, ScriptOutput, hash160,
                       UnknownAddress, OpCodes as opcodes)
+import copy
 import struct
 
 #
@@ -41,6 +42,9 @@ from .keystore import xpubkey_to_address, xpubkey_to_pubkey
 
 NO_SIGNATURE = 'ff'
 
+# Larger transactions are not relayed by nodes
+MAX_STANDARD_TX_SIZE = 100000
+
 
 class SerializationError(Exception):
     """ Thrown when there's a problem deserializing or serializing """
@@ -321,63 +325,182 @@ def get_address_from_output_script(_bytes):
     return TYPE_SCRIPT, ScriptOutput(bytes(_bytes))
 
 
-def parse_input(vds):
+def _read_compact_size(buf, pos):
+    try:
+        size = buf[pos]
+        pos += 1
+        if size == 253:
+            size = struct.unpack_from('<H', buf, pos)[0]
+            pos += 2
+        elif size == 254:
+            size = struct.unpack_from('<I', buf, pos)[0]
+            pos += 4
+        elif size == 255:
+            size = struct.unpack_from('<Q', buf, pos)[0]
+            pos += 8
+        return size, pos
+    except (IndexError, struct.error):
+        raise SerializationError("attempt to read past end of buffer")
+
+
+def _read_num(format, buf, pos):
+    try:
+        (i,) = struct.unpack_from(format, buf, pos)
+    except struct.error as e:
+        raise SerializationError(e)
+    return i, pos + struct.calcsize(format)
+
+
+def _read_span(buf, pos, length):
+    end = pos + length
+    if end > len(buf):
+        raise SerializationError("attempt to read past end of buffer")
+    return end
+
+
+# Pushes of a NO_SIGNATURE placeholder, which mark the inputs of a partial
+# transaction (those are followed by their value): a direct push, which is
+# also the tail of a PUSHDATA1 (4c01ff), then PUSHDATA2 and PUSHDATA4.
+NO_SIGNATURE_PUSHES = (b'\x01\xff', b'\x4d\x01\x00\xff', b'\x4e\x01\x00\x00\x00\xff')
+COINBASE_PREVOUT_HASH = bytes(32)
+
+
+def _parse_scriptSig_if_partial(buf, start, script_start, script_end):
+    '''Returns the parsed scriptSig fields of an input that may be
+    incomplete, or None if the input is known to be complete.'''
+    if buf[start:start+32] == COINBASE_PREVOUT_HASH:
+        return None
+    if not any(buf.find(push, script_start, script_end) != -1
+               for push in NO_SIGNATURE_PUSHES):
+        # no signature is missing, the input is complete
+        return None
     d = {}
-    prevout_hash = hash_encode(vds.read_bytes(32))
-    prevout_n = vds.read_uint32()
-    scriptSig = vds.read_bytes(vds.read_compact_size())
-    sequence = vds.read_uint32()
-    d['prevout_hash'] = prevout_hash
+    _parse_scriptSig_fields(d, bytes(buf[script_start:script_end]))
+    return d
+
+
+def tx_layout(raw):
+    '''Walks a serialized transaction without decoding its scripts.
+    raw is a hex string or a bytes-like object.  Returns (buf, version,
+    inputs, outputs, locktime), where the inputs and outputs are tuples
+    of offsets into buf to be decoded by parse_input() and parse_output().'''
+    buf = bfh(raw) if isinstance(raw, str) else bytes(raw)
+    version, pos = _read_num('<i', buf, 0)
+    n_vin, pos = _read_compact_size(buf, pos)
+    assert n_vin != 0
+    inputs = []
+    for i in range(n_vin):
+        start = pos
+        pos = _read_span(buf, pos, 36)
+        script_len, script_start = _read_compact_size(buf, pos)
+        script_end = _read_span(buf, script_start, script_len)
+        pos = _read_span(buf, script_end, 4)
+        # scriptSigs of partial txs have to be parsed here to know if the
+        # input value follows, keep them for parse_input()
+        parsed = _parse_scriptSig_if_partial(buf, start, script_start, script_end)
+        has_value = parsed is not None and not Transaction.is_txin_complete(parsed)
+        if has_value:
+            pos = _read_span(buf, pos, 8)
+        inputs.append((start, script_start, script_end, has_value, parsed))
+    n_vout, pos = _read_compact_size(buf, pos)
+    outputs = []
+    for i in range(n_vout):
+        start = pos
+        script_len, script_start = _read_compact_size(buf, _read_span(buf, pos, 8))
+        pos = script_end = _read_span(buf, script_start, script_len)
+        outputs.append((start, script_start, script_end))
+    locktime, pos = _read_num('<I', buf, pos)
+    return buf, version, inputs, outputs, locktime
+
+
+def _parse_scriptSig_fields(d, scriptSig):
+    d['x_pubkeys'] = []
+    d['pubkeys'] = []
+    d['signatures'] = {}
+    d['address'] = None
+    d['type'] = 'unknown'
+    d['num_sig'] = 0
+    d['scriptSig'] = bh2u(scriptSig)
+    parse_scriptSig(d, scriptSig)
+
+
+def parse_input(buf, span):
+    start, script_start, script_end, has_value, parsed = span
+    prevout_hash = buf[start:start+32]
+    prevout_n = struct.unpack_from('<I', buf, start + 32)[0]
+    scriptSig = bytes(buf[script_start:script_end])
+    sequence = struct.unpack_from('<I', buf, script_end)[0]
+    d = {}
+    d['prevout_hash'] = hash_encode(prevout_hash)
     d['prevout_n'] = prevout_n
     d['sequence'] = sequence
     d['address'] = UnknownAddress()
-    if prevout_hash == '00'*32:
+    if prevout_hash == COINBASE_PREVOUT_HASH:
         d['type'] = 'coinbase'
         d['scriptSig'] = bh2u(scriptSig)
+    elif parsed is not None:
+        # the lists may be modified when signing
+        d.update((k, copy.copy(v)) for k, v in parsed.items())
+        if has_value:
+            d['value'] = struct.unpack_from('<Q', buf, script_end + 4)[0]
     else:
-        d['x_pubkeys'] = []
-        d['pubkeys'] = []
-        d['signatures'] = {}
-        d['address'] = None
-        d['type'] = 'unknown'
-        d['num_sig'] = 0
-        d['scriptSig'] = bh2u(scriptSig)
-        parse_scriptSig(d, scriptSig)
-
-        if not Transaction.is_txin_complete(d):
-            d['value'] = vds.read_uint64()
+        _parse_scriptSig_fields(d, scriptSig)
     return d
 
 
-def parse_output(vds, i):
+def parse_output(buf, span, i):
+    start, script_start, script_end = span
+    scriptPubKey = bytes(buf[script_start:script_end])
     d = {}
-    d['value'] = vds.read_int64()
-    scriptPubKey = vds.read_bytes(vds.read_compact_size())
+    d['value'] = struct.unpack_from('<q', buf, start)[0]
     d['type'], d['address'] = get_address_from_output_script(scriptPubKey)
     d['scriptPubKey'] = bh2u(scriptPubKey)
     d['prevout_n'] = i
     return d
 
 
-def deserialize(raw):
-    vds = BCDataStream()
-    vds.write(bfh(raw))
+def deserialize_layout(layout):
+    buf, version, inputs, outputs, locktime = layout
     d = {}
-    start = vds.read_cursor
-    d['version'] = vds.read_int32()
-    n_vin = vds.read_compact_size()
-    assert n_vin != 0
-    d['inputs'] = [parse_input(vds) for i in range(n_vin)]
-    n_vout = vds.read_compact_size()
-    d['outputs'] = [parse_output(vds, i) for i in range(n_vout)]
-    d['lockTime'] = vds.read_uint32()
+    d['version'] = version
+    d['inputs'] = [parse_input(buf, span) for span in inputs]
+    d['outputs'] = [parse_output(buf, span, i) for i, span in enumerate(outputs)]
+    d['lockTime'] = locktime
     return d
 
 
+def deserialize(raw):
+    return deserialize_layout(tx_layout(raw))
+
+
 # pay & redeem scripts
 
 
 
+def var_int_size(i):
+    '''The size in bytes of var_int(i).'''
+    if i < 0xfd:
+        return 1
+    elif i <= 0xffff:
+        return 3
+    elif i <= 0xffffffff:
+        return 5
+    else:
+        return 9
+
+
+def op_push_size(i):
+    '''The size in bytes of op_push(i).'''
+    if i < 0x4c:
+        return 1
+    elif i < 0xff:
+        return 2
+    elif i < 0xffff:
+        return 3
+    else:
+        return 5
+
+
 def multisig_script(public_keys, m):
     n = len(public_keys)
     assert n <= 15
@@ -411,6 +534,12 @@ class Transaction:
             raise BaseException("cannot initialize transaction", raw)
         self._inputs = None
         self._outputs = None
+        # (raw, tx_layout(raw)), inputs and outputs are decoded on demand
+        self._layout = None
+        # BIP143 hashPrevouts, hashSequence and hashOutputs, see serialize_preimage
+        self._sighash_midstate = None
+        # The outputs serialized, without their count
+        self._serialized_outputs = None
         self.locktime = 0
         self.version = 1
         
@@ -423,18 +552,37 @@ class Transaction:
     def update(self, raw):
         self.raw = raw
         self._inputs = None
+        self._outputs = None
+        self._sighash_midstate = None
+        self._serialized_outputs = None
         self.deserialize()
 
+    def _get_layout(self):
+        if self._layout is None or self._layout[0] is not self.raw:
+            layout = tx_layout(self.raw)
+            self._layout = (self.raw, layout)
+            buf, self.version, inputs, outputs, self.locktime = layout
+        return self._layout[1]
+
     def inputs(self):
-        if self._inputs is None:
-            self.deserialize()
+        if self._inputs is None and self.raw is not None:
+            buf, version, inputs, outputs, locktime = self._get_layout()
+            self._inputs = [parse_input(buf, span) for span in inputs]
+            self._sighash_midstate = None
         return self._inputs
 
     def outputs(self):
-        if self._outputs is None:
-            self.deserialize()
+        if self._outputs is None and self.raw is not None:
+            buf, version, inputs, outputs, locktime = self._get_layout()
+            self._outputs = [self._output_tuple(parse_output(buf, span, i))
+                             for i, span in enumerate(outputs)]
+            self._sighash_midstate = None
         return self._outputs
 
+    @staticmethod
+    def _output_tuple(x):
+        return x['type'], x['address'], x['value']
+
     @classmethod
     def get_sorted_pubkeys(self, txin):
         # sort pubkeys and x_pubkeys, using the order of pubkeys
@@ -480,9 +628,11 @@ class Transaction:
             return
         if self._inputs is not None:
             return
-        d = deserialize(self.raw)
+        d = deserialize_layout(self._get_layout())
         self._inputs = d['inputs']
-        self._outputs = [(x['type'], x['address'], x['value']) for x in d['outputs']]
+        self._outputs = [self._output_tuple(x) for x in d['outputs']]
+        self._sighash_midstate = None
+        self._serialized_outputs = None
         assert all(isinstance(output[1], (PublicKey, Address, ScriptOutput))
                    for output in self._outputs)
         self.locktime = d['lockTime']
@@ -617,7 +767,9 @@ class Transaction:
     def BIP_LI01_sort(self):
         # See https://github.com/kristovatlas/rfc/blob/master/bips/bip-li01.mediawiki
         self._inputs.sort(key = lambda i: (i['prevout_hash'], i['prevout_n']))
-        self._outputs.sort(key = lambda o: (o[2], self.pay_script(o[1])))
+        self._outputs.sort(key = lambda o: (o[2], o[1].to_script()))
+        self._sighash_midstate = None
+        self._serialized_outputs = None
 
     def serialize_output(self, output):
         output_type, addr, amount = output
@@ -627,22 +779,41 @@ class Transaction:
         s += script
         return s
 
+    def serialize_outputs(self):
+        '''The outputs serialized one after the other, kept until they
+        change: the same hex is hashed for every signature and written
+        by serialize().'''
+        if self._serialized_outputs is None:
+            self._serialized_outputs = ''.join(self.serialize_output(o)
+                                               for o in self.outputs())
+        return self._serialized_outputs
+
     @classmethod
     def nHashType(cls):
         '''Hash type in hex.'''
         return 0x01 | (cls.SIGHASH_FORKID + (cls.FORKID << 8))
 
+    def get_sighash_midstate(self):
+        '''Returns (hashPrevouts, hashSequence, hashOutputs) in hex.  They
+        are the same for every input, so they are computed once and kept
+        until the inputs or outputs change.'''
+        if self._sighash_midstate is None:
+            inputs = self.inputs()
+            hashPrevouts = bh2u(Hash(bfh(''.join(self.serialize_outpoint(txin) for txin in inputs))))
+            hashSequence = bh2u(Hash(bfh(''.join(int_to_hex(txin.get('sequence', 0xffffffff - 1), 4) for txin in inputs))))
+            hashOutputs = bh2u(Hash(bfh(self.serialize_outputs())))
+            self._sighash_midstate = (hashPrevouts, hashSequence, hashOutputs)
+        return self._sighash_midstate
+
     def serialize_preimage(self, i):
+        # deserialize first, it sets version and locktime
+        inputs = self.inputs()
         nVersion = int_to_hex(self.version, 4)
         nHashType = int_to_hex(self.nHashType(), 4)
         nLocktime = int_to_hex(self.locktime, 4)
-        inputs = self.inputs()
-        outputs = self.outputs()
         txin = inputs[i]
 
-        hashPrevouts = bh2u(Hash(bfh(''.join(self.serialize_outpoint(txin) for txin in inputs))))
-        hashSequence = bh2u(Hash(bfh(''.join(int_to_hex(txin.get('sequence', 0xffffffff - 1), 4) for txin in inputs))))
-        hashOutputs = bh2u(Hash(bfh(''.join(self.serialize_output(o) for o in outputs))))
+        hashPrevouts, hashSequence, hashOutputs = self.get_sighash_midstate()
         outpoint = self.serialize_outpoint(txin)
         preimage_script = self.get_preimage_script(txin)
         scriptCode = var_int(len(preimage_script) // 2) + preimage_script
@@ -655,12 +826,13 @@ class Transaction:
         return preimage
 
     def serialize(self, estimate_size=False):
-        nVersion = int_to_hex(self.version, 4)
-        nLocktime = int_to_hex(self.locktime, 4)
+        # deserialize first, it sets version and locktime
         inputs = self.inputs()
         outputs = self.outputs()
+        nVersion = int_to_hex(self.version, 4)
+        nLocktime = int_to_hex(self.locktime, 4)
         txins = var_int(len(inputs)) + ''.join(self.serialize_input(txin, self.input_script(txin, estimate_size), estimate_size) for txin in inputs)
-        txouts = var_int(len(outputs)) + ''.join(self.serialize_output(o) for o in outputs)
+        txouts = var_int(len(outputs)) + self.serialize_outputs()
         return nVersion + txins + txouts + nLocktime
 
     def hash(self):
@@ -676,12 +848,15 @@ class Transaction:
     def add_inputs(self, inputs):
         self._inputs.extend(inputs)
         self.raw = None
+        self._sighash_midstate = None
 
     def add_outputs(self, outputs):
         assert all(isinstance(output[1], (PublicKey, Address, ScriptOutput))
                    for output in outputs)
         self._outputs.extend(outputs)
         self.raw = None
+        self._sighash_midstate = None
+        self._serialized_outputs = None
 
     def input_value(self):
         return sum(x['value'] for x in self.inputs())
@@ -692,17 +867,49 @@ class Transaction:
     def get_fee(self):
         return self.input_value() - self.output_value()
 
-    @profiler
     def estimated_size(self):
-        '''Return an estimated tx size in bytes.'''
-        return (len(self.serialize(True)) // 2 if not self.is_complete() or self.raw is None
-                else len(self.raw) // 2)  # ASCII hex string
+        '''Return an estimated tx size in bytes.  Incomplete transactions
+        are sized with estimated_input_size() and estimated_output_size(),
+        which agree byte for byte with serialize(estimate_size=True).'''
+        if self.is_complete() and self.raw is not None:
+            return len(self.raw) // 2  # ASCII hex string
+        inputs = self.inputs()
+        outputs = self.outputs()
+        return (8 + var_int_size(len(inputs)) + var_int_size(len(outputs))
+                + sum(self.estimated_input_size(txin) for txin in inputs)
+                + sum(self.estimated_output_size(o) for o in outputs))
+
+    @classmethod
+    def estimated_input_script_size(self, txin):
+        '''The size in bytes of input_script(txin, estimate_size=True).'''
+        _type = txin['type']
+        if _type in ('coinbase', 'unknown'):
+            return len(txin['scriptSig']) // 2
+        # Dummy signatures are 0x48 bytes, and each has a one byte push
+        size = 0x49 * txin.get('num_sig', 1)
+        if _type == 'p2pkh':
+            pubkey_size = self.estimate_pubkey_size_for_txin(txin)
+            size += op_push_size(pubkey_size) + pubkey_size
+        elif _type == 'p2sh':
+            pubkey_size = self.estimate_pubkey_size_for_txin(txin)
+            n = len(txin.get('x_pubkeys', [None]))
+            # OP_m <pubkey>... OP_n OP_CHECKMULTISIG, after an OP_0
+            redeem_script_size = 3 + n * (op_push_size(pubkey_size) + pubkey_size)
+            size += 1 + op_push_size(redeem_script_size) + redeem_script_size
+        return size
 
     @classmethod
     def estimated_input_size(self, txin):
         '''Return an estimated of serialized input size in bytes.'''
-        script = self.input_script(txin, True)
-        return len(self.serialize_input(txin, script, True)) // 2  # ASCII hex string
+        script_size = self.estimated_input_script_size(txin)
+        # Outpoint, script length and script, sequence
+        return 36 + var_int_size(script_size) + script_size + 4
+
+    @classmethod
+    def estimated_output_size(self, output):
+        '''Return the serialized size of an output in bytes.'''
+        script_size = len(output[1].to_script())
+        return 8 + var_int_size(script_size) + script_size
 
     def signature_count(self):
         r = 0
@@ -0,0 +1,168 @@
+# Electron Cash - lightweight Bitcoin client
+# Copyright (C) 2018 The Electron Cash Developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import os
+import threading
+from collections import OrderedDict
+
+from .bitcoin import Hash, hash_encode
+from .util import PrintError
+
+DEFAULT_TX_CACHE_SIZE = 64 * 1024 * 1024
+
+
+class TxCache(PrintError):
+    '''Raw transactions on disk, one file per txid, shared by everything
+    using a Network: every wallet loaded in the daemon, and requests made
+    directly to the network.  Transactions are checked against their id
+    when stored and again when read back.  The least recently used are
+    deleted to keep the total size under max_size bytes.'''
+
+    def __init__(self, path, max_size=DEFAULT_TX_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # txid -> size, least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.rejected = 0
+        self.load()
+
+    def load(self):
+        os.makedirs(self.path, exist_ok=True)
+        found = []
+        for shard in os.listdir(self.path):
+            shard_path = os.path.join(self.path, shard)
+            if not os.path.isdir(shard_path):
+                continue
+            for txid in os.listdir(shard_path):
+                if len(txid) != 64:
+                    continue    # Left by an interrupted write
+                try:
+                    st = os.stat(os.path.join(shard_path, txid))
+                except OSError:
+                    continue
+                found.append((st.st_mtime, txid, st.st_size))
+        # Files are touched when read, so their times give the LRU order
+        for mtime, txid, size in sorted(found):
+            self.entries[txid] = size
+            self.size += size
+        with self.lock:
+            self.evict()
+        self.print_error("{} transactions, {} bytes".format(len(self.entries), self.size))
+
+    def file_path(self, txid):
+        return os.path.join(self.path, txid[:2], txid)
+
+    @staticmethod
+    def txid(raw):
+        return hash_encode(Hash(raw))
+
+    def get(self, txid):
+        '''Returns the raw transaction as bytes, or None.'''
+        with self.lock:
+            if txid not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(txid)
+        path = self.file_path(txid)
+        try:
+            with open(path, 'rb') as f:
+                raw = f.read()
+            os.utime(path)
+        except OSError:
+            raw = None
+        if raw is None or self.txid(raw) != txid:
+            self.print_error("dropping unreadable transaction", txid)
+            self.remove(txid)
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return raw
+
+    def put(self, txid, raw):
+        '''Stores a raw transaction.  Returns False if it does not hash
+        to txid.'''
+        if self.txid(raw) != txid:
+            with self.lock:
+                self.rejected += 1
+            return False
+        with self.lock:
+            if txid in self.entries:
+                self.entries.move_to_end(txid)
+                return True
+        path = self.file_path(txid)
+        temp_path = "%s.tmp.%s" % (path, threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temp_path, 'wb') as f:
+                f.write(raw)
+            os.replace(temp_path, path)
+        except OSError as e:
+            self.print_error("cannot store transaction", txid, e)
+            return False
+        with self.lock:
+            if txid not in self.entries:
+                self.entries[txid] = len(raw)
+                self.size += len(raw)
+                self.stores += 1
+                self.evict()
+        return True
+
+    def remove(self, txid):
+        with self.lock:
+            size = self.entries.pop(txid, None)
+            if size is not None:
+                self.size -= size
+        try:
+            os.unlink(self.file_path(txid))
+        except OSError:
+            pass
+
+    def evict(self):
+        '''Must be called with the lock held.'''
+        while self.size > self.max_size and self.entries:
+            txid, size = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            try:
+                os.unlink(self.file_path(txid))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {
+                'transactions': len(self.entries),
+                'size': self.size,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'rejected': self.rejected,
+            }
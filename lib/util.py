@@ -28,10 +28,12 @@ from datetime import datetime
 from decimal import Decimal
 import traceback
 import threading
+from contextlib import contextmanager
 import hmac
 import stat
 
 from .i18n import _
+from .metrics import metrics
 
 import queue
 
@@ -183,6 +185,47 @@ class DaemonThread(threading.Thread, PrintError):
         self.print_error("stopped")
 
 
+class RWLock(object):
+    '''A lock held by any number of readers at once, or by one writer.
+    A waiting writer keeps new readers out, so that a stream of reads
+    cannot starve it.  Not reentrant.'''
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+
+    @contextmanager
+    def read_lock(self):
+        with self.cond:
+            while self.writer or self.writers_waiting:
+                self.cond.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.readers -= 1
+                if not self.readers:
+                    self.cond.notify_all()
+
+    @contextmanager
+    def write_lock(self):
+        with self.cond:
+            self.writers_waiting += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.writers_waiting -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.writer = False
+                self.cond.notify_all()
+
+
 # TODO: disable
 is_verbose = True
 def set_verbosity(b):
@@ -242,10 +285,11 @@ def constant_time_compare(val1, val2):
 def profiler(func):
     def do_profile(func, args, kw_args):
         n = func.__name__
-        t0 = time.time()
+        t0 = time.perf_counter()
         o = func(*args, **kw_args)
-        t = time.time() - t0
+        t = time.perf_counter() - t0
         print_error("[profiler]", n, "%.4f"%t)
+        metrics.observe('profiler', n, t)
         return o
     return lambda *args, **kw_args: do_profile(func, args, kw_args)
 
@@ -502,6 +546,23 @@ builtin_raw_input = builtins.input
 builtins.input = raw_input
 
 
+# orjson and ujson parse server responses several times faster than the
+# json module and are used when installed.
+try:
+    from orjson import loads as fast_json_loads
+except ImportError:
+    try:
+        from ujson import loads as fast_json_loads
+    except ImportError:
+        fast_json_loads = None
+
+def json_loads(data):
+    '''Parse a bytes-like UTF-8 JSON document.'''
+    if fast_json_loads is not None:
+        return fast_json_loads(bytes(data))
+    return json.loads(data.decode('utf8'))
+
+
 def parse_json(message):
     # TODO: check \r\n pattern
     n = message.find(b'\n')
@@ -526,9 +587,15 @@ import time
 
 
 class SocketPipe(PrintError):
+    # Large enough that a chunk of 2016 headers takes a few reads
+    recv_size = 65536
+
     def __init__(self, socket):
         self.socket = socket
-        self.message = b''
+        # Received data not yet returned by get(), and how far into it
+        # we have already looked for a newline.
+        self.buffer = bytearray()
+        self.scanned = 0
         self.set_timeout(0.1)
         self.recv_time = time.time()
 
@@ -540,15 +607,30 @@ class SocketPipe(PrintError):
 
     def get(self):
         while True:
-            response, self.message = parse_json(self.message)
-            if response is not None:
-                return response
+            n = self.buffer.find(b'\n', self.scanned)
+            if n != -1:
+                line = self.buffer[:n]
+                # Deleting from the front of a bytearray does not move the
+                # rest of it, so consuming messages one at a time is linear
+                del self.buffer[:n+1]
+                self.scanned = 0
+                try:
+                    response = json_loads(line)
+                except Exception:
+                    response = None
+                if response is not None:
+                    return response
+                continue
+            self.scanned = len(self.buffer)
             try:
-                data = self.socket.recv(1024)
+                data = self.socket.recv(self.recv_size)
             except socket.timeout:
                 raise timeout
             except ssl.SSLError:
                 raise timeout
+            except BlockingIOError:
+                # Non-blocking socket with nothing more to read
+                raise timeout
             except socket.error as err:
                 if err.errno == 60:
                     raise timeout
@@ -565,8 +647,9 @@ class SocketPipe(PrintError):
 
             if not data:  # Connection closed remotely
                 return None
-            self.message += data
+            self.buffer += data
             self.recv_time = time.time()
+            metrics.incr('network_bytes_received', len(data))
 
     def send(self, request):
         out = json.dumps(request) + '\n'
@@ -581,6 +664,7 @@ class SocketPipe(PrintError):
         while out:
             sent = self.socket.send(out)
             out = out[sent:]
+            metrics.incr('network_bytes_sent', sent)
 
 
 def setup_thread_excepthook():
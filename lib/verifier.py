@@ -20,6 +20,9 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import time
+from collections import defaultdict
+
 from .util import ThreadJob, bh2u
 from .bitcoin import Hash, hash_decode, hash_encode, NetworkConstants
 from .transaction import Transaction
@@ -29,12 +32,20 @@ class InnerNodeOfSpvProofIsValidTx(Exception): pass
 class SPV(ThreadJob):
     """ Simple Payment Verification """
 
+    # Merkle branches requested and not yet received, at most
+    MAX_REQUESTED_MERKLE = 1000
+    # A proof that fails is requested again after this many seconds,
+    # doubling with each further failure up to MAX_RETRY_DELAY
+    RETRY_DELAY = 10
+    MAX_RETRY_DELAY = 600
+
     def __init__(self, network, wallet):
         self.wallet = wallet
         self.network = network
         self.blockchain = network.blockchain()
         self.merkle_roots = {}  # txid -> merkle root (once it has been verified)
         self.requested_merkle = set()  # txid set of pending requests
+        self.retry_after = {}  # txid -> (time of next request, delay), for failed proofs
 
     def run(self):
         interface = self.network.interface
@@ -47,16 +58,34 @@ class SPV(ThreadJob):
             self.print_error("v.no blockchain", interface.server)
             return
 
+        if len(self.requested_merkle) < self.MAX_REQUESTED_MERKLE:
+            self.request_merkle(interface, blockchain)
+
+        if self.network.blockchain() != self.blockchain:
+            self.blockchain = self.network.blockchain()
+            self.undo_verifications()
+
+    def request_merkle(self, interface, blockchain):
         local_height = self.network.get_local_height()
         unverified = self.wallet.get_unverified_txs()
-        for tx_hash, tx_height in unverified.items():
+        by_height = defaultdict(list)
+        now = time.time()
+        for tx_hash, tx_height in list(unverified.items()):
             # do not request merkle branch if we already requested it
             if tx_hash in self.requested_merkle or tx_hash in self.merkle_roots:
                 continue
+            # nor too soon after it failed
+            if tx_hash in self.retry_after and now < self.retry_after[tx_hash][0]:
+                continue
             # or before headers are available
             if tx_height <= 0 or tx_height > local_height:
                 continue
+            by_height[tx_height].append(tx_hash)
 
+        # Each block's header is read once for all its transactions
+        requests = []
+        verified = False
+        for tx_height, tx_hashes in sorted(by_height.items()):
             # if it's in the checkpoint region, we still might not have the header
             header = blockchain.read_header(tx_height)
             if header is None:
@@ -68,29 +97,40 @@ class SPV(ThreadJob):
                     if self.network.request_chunk(interface, index):
                         interface.print_error("verifier requesting chunk {} for height {}".format(index, tx_height))
                 continue
-            # request now
-            self.network.get_merkle_for_transaction(
-                    tx_hash,
-                    tx_height,
-                    self.verify_merkle)
-            self.print_error('requested merkle', tx_hash)
-            self.requested_merkle.add(tx_hash)
-
-        if self.network.blockchain() != self.blockchain:
-            self.blockchain = self.network.blockchain()
-            self.undo_verifications()
+            for tx_hash in tx_hashes:
+                # A proof we already checked, to a block we still have
+                proof = self.wallet.get_spv_proof(tx_hash)
+                if proof and proof[0] == header.get('merkle_root'):
+                    self.add_verified(tx_hash, tx_height, header, *proof)
+                    verified = True
+                    continue
+                if len(self.requested_merkle) >= self.MAX_REQUESTED_MERKLE:
+                    continue
+                requests.append(('blockchain.transaction.get_merkle', [tx_hash, tx_height]))
+                self.requested_merkle.add(tx_hash)
+        # request now, in one go
+        if requests:
+            self.network.send(requests, self.verify_merkle)
+            self.print_error('requested {} merkle branches'.format(len(requests)))
+        if verified and self.is_up_to_date() and self.wallet.is_up_to_date():
+            self.wallet.save_verified_tx(write=True)
         
     def verify_merkle(self, response):
         if self.wallet.verifier is None:
             return  # we have been killed, this was just an orphan callback
+        params = response.get('params') or [None]
+        tx_hash = params[0]
+        # Whatever the outcome, the request is no longer pending.  A proof
+        # that fails is requested again later, rather than holding on to a
+        # slot under MAX_REQUESTED_MERKLE for good.
+        self.requested_merkle.discard(tx_hash)
         if response.get('error'):
             self.print_error('received an error:', response)
+            self.retry_later(tx_hash)
             return
-        params = response['params']
         merkle = response['result']
         # Verify the hash of the server-provided merkle branch to a
         # transaction matches the merkle root of its block
-        tx_hash = params[0]
         tx_height = merkle.get('block_height')
         pos = merkle.get('pos')
         try:
@@ -98,6 +138,7 @@ class SPV(ThreadJob):
         except InnerNodeOfSpvProofIsValidTx:
             self.print_error("merkle verification failed for {} (inner node looks like tx)"
                              .format(tx_hash))
+            self.retry_later(tx_hash)
             return
             
         header = self.network.blockchain().read_header(tx_height)
@@ -108,24 +149,32 @@ class SPV(ThreadJob):
             self.print_error(
                 "merkle verification failed for {} (missing header {})"
                 .format(tx_hash, tx_height))
+            self.retry_later(tx_hash)
             return
         if header.get('merkle_root') != merkle_root:
             self.print_error(
                 "merkle verification failed for {} (merkle root mismatch {} != {})"
                 .format(tx_hash, header.get('merkle_root'), merkle_root))
+            self.retry_later(tx_hash)
             return
         # we passed all the tests
+        self.retry_after.pop(tx_hash, None)
+        self.wallet.add_spv_proof(tx_hash, merkle_root, pos)
+        self.add_verified(tx_hash, tx_height, header, merkle_root, pos)
+        if self.is_up_to_date() and self.wallet.is_up_to_date():
+            self.wallet.save_verified_tx(write=True)
+
+    def retry_later(self, tx_hash):
+        if tx_hash is None:
+            return
+        _, delay = self.retry_after.get(tx_hash, (None, self.RETRY_DELAY / 2))
+        delay = min(delay * 2, self.MAX_RETRY_DELAY)
+        self.retry_after[tx_hash] = (time.time() + delay, delay)
+
+    def add_verified(self, tx_hash, tx_height, header, merkle_root, pos):
         self.merkle_roots[tx_hash] = merkle_root
-        try:
-            # note: we could pop in the beginning, but then we would request
-            # this proof again in case of verification failure from the same server
-            self.requested_merkle.remove(tx_hash)
-        except KeyError:
-            pass
         self.print_error("verified %s" % tx_hash)
         self.wallet.add_verified_tx(tx_hash, (tx_height, header.get('timestamp'), pos))
-        if self.is_up_to_date() and self.wallet.is_up_to_date():
-            self.wallet.save_verified_tx(write=True)
 
     @classmethod
     def hash_merkle_root(cls, merkle_s, target_hash, pos):
@@ -158,6 +207,7 @@ class SPV(ThreadJob):
             
     def remove_spv_proof_for_tx(self, tx_hash):
         self.merkle_roots.pop(tx_hash, None)
+        self.retry_after.pop(tx_hash, None)
         try:
             self.requested_merkle.remove(tx_hash)
         except KeyError:
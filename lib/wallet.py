@@ -29,13 +29,15 @@
 
 
 import os
+import sys
+import bisect
 import threading
 import random
 import time
 import json
 import copy
 import errno
-from collections import defaultdict
+from collections import defaultdict, deque
 from decimal import Decimal
 from functools import partial
 
@@ -71,6 +73,21 @@ TX_STATUS = [
 
 
 
+# Coins are keyed in the wallet on outpoints: (tx_hash, n) tuples, which
+# are cheaper to build and hash than the "tx_hash:n" strings they are
+# saved as, and need no parsing.  They are plain tuples because a
+# namedtuple or any tuple subclass is several times slower to build.
+
+def outpoint_from_string(text):
+    tx_hash, n = text.split(':')
+    # Interned so the coins of a transaction share its hash
+    return sys.intern(tx_hash), int(n)
+
+
+def outpoint_to_string(txo):
+    return '%s:%d' % txo
+
+
 def relayfee(network):
     RELAY_FEE = 5000
     MAX_RELAY_FEE = 50000
@@ -166,6 +183,9 @@ class Abstract_Wallet(PrintError):
         # verifier (SPV) and synchronizer are started in start_threads
         self.synchronizer = None
         self.verifier = None
+        # locks: if you need to take multiple ones, acquire them in the order they are defined here!
+        self.lock = threading.RLock()
+        self.transaction_lock = threading.RLock()
 
         self.gap_limit_for_change = 6 # constant
         # saved fields
@@ -179,15 +199,25 @@ class Abstract_Wallet(PrintError):
         # Frozen coins (UTXOs) -- note that we have 2 independent levels of "freezing": address-level and coin-level.
         # The two types of freezing are flagged independently of each other and 'spendable' is defined as a coin that satisfies
         # BOTH levels of freezing.
-        self.frozen_coins = set(storage.get('frozen_coins', []))
+        self.frozen_coins = set(outpoint_from_string(ser)
+                                for ser in storage.get('frozen_coins', []))
         # address -> list(txid, height)
-        history = storage.get('addr_history',{})
+        history = storage.get_nocopy('addr_history',{})
         self._history = self.to_Address_dict(history)
+        # address -> status hash of its history, as announced by servers,
+        # so a reconnect does not rehash every history, see
+        # get_address_status()
+        self._status = self.to_Address_dict(storage.get_nocopy('addr_status', {}))
+        # per-address balance and UTXO cache, see _get_addr_cache()
+        self._reset_addr_cache()
 
         self.load_keystore()
         self.load_addresses()
+        self._build_address_index()
         self.load_transactions()
         self.build_reverse_history()
+        # whole wallet history, see get_history()
+        self._reset_history_index()
 
         # load requests
         requests = self.storage.get('payment_requests', {})
@@ -201,16 +231,23 @@ class Abstract_Wallet(PrintError):
         self.unverified_tx = defaultdict(int)
 
         # Verified transactions.  Each value is a (height, timestamp, block_pos) tuple.  Access with self.lock.
-        self.verified_tx = storage.get('verified_tx3', {})
+        self.verified_tx = dict(storage.get_nocopy('verified_tx3', {}))
+
+        # The merkle roots transactions were proven to, by block: merkle root
+        # -> {tx_hash: block_pos}.  A transaction whose block is seen again,
+        # e.g. after a restart or a reorg, is verified again from these
+        # without asking the server.  Access with self.lock; the inner
+        # dicts are replaced rather than modified, as they are saved
+        # without copying.
+        self.spv_proofs = dict(storage.get_nocopy('spv_proofs', {}))
+        self.spv_proof_roots = {tx_hash: merkle_root
+                                for merkle_root, txs in self.spv_proofs.items()
+                                for tx_hash in txs}
 
         # there is a difference between wallet.up_to_date and interface.is_up_to_date()
         # interface.is_up_to_date() returns true when all requests have been answered and processed
         # wallet.up_to_date is true when the wallet is synchronized (stronger requirement)
         self.up_to_date = False
-        # locks: if you need to take multiple ones, acquire them in the order they are defined here!
-        self.lock = threading.RLock()
-        self.transaction_lock = threading.RLock()
-
         self.check_history()
 
         # save wallet type the first time
@@ -241,48 +278,121 @@ class Abstract_Wallet(PrintError):
     def get_master_public_key(self):
         return None
 
+    @classmethod
+    def to_Address_lists(cls, d):
+        '''Convert a {tx_hash: {address string: list}} dict as stored for
+        'txo' to Address keys.  The lists are copied, as the
+        wallet modifies them in place.'''
+        return {tx_hash: {Address.from_string(text): list(l)
+                          for text, l in value.items()}
+                for tx_hash, value in d.items()}
+
+    @classmethod
+    def from_Address_lists(cls, d):
+        '''Inverse of to_Address_lists().'''
+        return {tx_hash: {addr.to_string(Address.FMT_LEGACY): list(l)
+                          for addr, l in value.items()}
+                for tx_hash, value in d.items()}
+
+    @classmethod
+    def to_outpoint_txi(cls, d):
+        '''Convert 'txi' as stored, {tx_hash: {address string: [[ser, v]]}},
+        to Address keys and outpoints.'''
+        return {tx_hash: {Address.from_string(text): [(outpoint_from_string(ser), v) for ser, v in l]
+                          for text, l in value.items()}
+                for tx_hash, value in d.items()}
+
+    @classmethod
+    def from_outpoint_txi(cls, d):
+        '''Inverse of to_outpoint_txi().'''
+        return {tx_hash: {addr.to_string(Address.FMT_LEGACY): [(outpoint_to_string(txo), v) for txo, v in l]
+                          for addr, l in value.items()}
+                for tx_hash, value in d.items()}
+
     @profiler
     def load_transactions(self):
-        txi = self.storage.get('txi', {})
-        self.txi = {tx_hash: self.to_Address_dict(value)
-                    for tx_hash, value in txi.items()}
-        txo = self.storage.get('txo', {})
-        self.txo = {tx_hash: self.to_Address_dict(value)
-                    for tx_hash, value in txo.items()}
-        self.tx_fees = self.storage.get('tx_fees', {})
-        self.pruned_txo = self.storage.get('pruned_txo', {})
-        tx_list = self.storage.get('transactions', {})
+        # the large keys are read without copying, see get_nocopy()
+        self.txi = self.to_outpoint_txi(self.storage.get_nocopy('txi', {}))
+        self.txo = self.to_Address_lists(self.storage.get_nocopy('txo', {}))
+        self.tx_fees = dict(self.storage.get_nocopy('tx_fees', {}))
+        self.pruned_txo = {outpoint_from_string(ser): tx_hash for ser, tx_hash
+                           in self.storage.get_nocopy('pruned_txo', {}).items()}
+        self._build_spend_index()
+        tx_list = self.storage.get_nocopy('transactions', {})
         self.transactions = {}
         for tx_hash, raw in tx_list.items():
             tx = Transaction(raw)
             self.transactions[tx_hash] = tx
-            if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None and (tx_hash not in self.pruned_txo.values()):
+            if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None and (tx_hash not in self.pruned_spends):
                 self.print_error("removing unreferenced tx", tx_hash)
                 self.transactions.pop(tx_hash)
 
+    def _build_spend_index(self):
+        '''Reverse indexes of txi and pruned_txo, so that adding or removing
+        a transaction takes time proportional to its own inputs and
+        outputs rather than to the size of the wallet.
+
+        txi_spenders: prevout tx hash -> set of hashes of the transactions
+        whose txi spend its outputs.
+        pruned_spends: tx hash -> set of the outpoints in pruned_txo it
+        spends.'''
+        self.txi_spenders = {}
+        for tx_hash, d in self.txi.items():
+            for l in d.values():
+                for (prevout_hash, n), v in l:
+                    self.txi_spenders.setdefault(prevout_hash, set()).add(tx_hash)
+        self.pruned_spends = {}
+        for ser, tx_hash in self.pruned_txo.items():
+            self.pruned_spends.setdefault(tx_hash, set()).add(ser)
+
+    def _add_pruned_txo(self, txo, tx_hash):
+        self._pop_pruned_txo(txo)
+        self.pruned_txo[txo] = tx_hash
+        self.pruned_spends.setdefault(tx_hash, set()).add(txo)
+
+    def _pop_pruned_txo(self, txo):
+        tx_hash = self.pruned_txo.pop(txo, None)
+        if tx_hash is not None:
+            spends = self.pruned_spends[tx_hash]
+            spends.discard(txo)
+            if not spends:
+                del self.pruned_spends[tx_hash]
+        return tx_hash
+
+    def _discard_txi_spender(self, tx_hash, d):
+        for l in d.values():
+            for (prevout_hash, n), v in l:
+                spenders = self.txi_spenders.get(prevout_hash)
+                if spenders is not None:
+                    spenders.discard(tx_hash)
+                    if not spenders:
+                        del self.txi_spenders[prevout_hash]
+
     @profiler
     def save_transactions(self, write=False):
         with self.transaction_lock:
+            # Hand freshly built containers over to the storage instead of
+            # having it validate and deep copy them; the values they hold
+            # (strings, ints, tuples) are never modified in place.
             tx = {}
             for k,v in self.transactions.items():
                 tx[k] = str(v)
-            self.storage.put('transactions', tx)
-            txi = {tx_hash: self.from_Address_dict(value)
-                   for tx_hash, value in self.txi.items()}
-            txo = {tx_hash: self.from_Address_dict(value)
-                   for tx_hash, value in self.txo.items()}
-            self.storage.put('txi', txi)
-            self.storage.put('txo', txo)
-            self.storage.put('tx_fees', self.tx_fees)
-            self.storage.put('pruned_txo', self.pruned_txo)
+            self.storage.put_nocopy('transactions', tx)
+            self.storage.put_nocopy('txi', self.from_outpoint_txi(self.txi))
+            self.storage.put_nocopy('txo', self.from_Address_lists(self.txo))
+            self.storage.put_nocopy('tx_fees', dict(self.tx_fees))
+            self.storage.put_nocopy('pruned_txo', {outpoint_to_string(txo): tx_hash for txo, tx_hash
+                                                   in self.pruned_txo.items()})
             history = self.from_Address_dict(self._history)
-            self.storage.put('addr_history', history)
+            self.storage.put_nocopy('addr_history', history)
+            self.storage.put_nocopy('addr_status', self.from_Address_dict(self._status))
             if write:
                 self.storage.write()
 
     def save_verified_tx(self, write=False):
         with self.lock:
-            self.storage.put('verified_tx3', self.verified_tx)
+            self.storage.put_nocopy('verified_tx3', dict(self.verified_tx))
+            self.storage.put_nocopy('spv_proofs', dict(self.spv_proofs))
             if write:
                 self.storage.write()
                 
@@ -292,10 +402,14 @@ class Abstract_Wallet(PrintError):
             self.txo = {}
             self.tx_fees = {}
             self.pruned_txo = {}
+            self._build_spend_index()
         self.save_transactions()
         with self.lock:
             self._history = {}
+            self._status = {}
             self.tx_addr_hist = {}
+            self._reset_addr_cache()
+            self._reset_history_index()
 
     @profiler
     def build_reverse_history(self):
@@ -313,13 +427,14 @@ class Abstract_Wallet(PrintError):
 
         for addr in set(self._history) - set(my_addrs):
             self._history.pop(addr)
+            self._status.pop(addr, None)
             save = True
 
         for addr in my_addrs:
             hist = self._history[addr]
 
             for tx_hash, tx_height in hist:
-                if tx_hash in self.pruned_txo.values() or self.txi.get(tx_hash) or self.txo.get(tx_hash):
+                if tx_hash in self.pruned_spends or self.txi.get(tx_hash) or self.txo.get(tx_hash):
                     continue
                 tx = self.transactions.get(tx_hash)
                 if tx is not None:
@@ -387,25 +502,36 @@ class Abstract_Wallet(PrintError):
 
         return changed
 
+    def _build_address_index(self):
+        '''address -> (is_change, index) for every address of the wallet.
+        Its keys are the set is_mine() tests, so adding or removing an
+        address must update it.  Imported wallets number their addresses
+        in no particular order.'''
+        index = {addr: (False, i)
+                 for i, addr in enumerate(self.get_receiving_addresses())}
+        index.update((addr, (True, i))
+                     for i, addr in enumerate(self.get_change_addresses()))
+        self._addr_index = index
+
+    def get_address_set(self):
+        '''A read-only set view of the wallet addresses.'''
+        return self._addr_index.keys()
+
     def is_mine(self, address):
         assert not isinstance(address, str)
-        return address in self.get_addresses()
+        return address in self._addr_index
 
     def is_change(self, address):
         assert not isinstance(address, str)
-        return address in self.change_addresses
+        index = self._addr_index.get(address)
+        return index is not None and index[0]
 
     def get_address_index(self, address):
-        try:
-            return False, self.receiving_addresses.index(address)
-        except ValueError:
-            pass
-        try:
-            return True, self.change_addresses.index(address)
-        except ValueError:
-            pass
         assert not isinstance(address, str)
-        raise Exception("Address {} not found".format(address))
+        index = self._addr_index.get(address)
+        if index is None:
+            raise Exception("Address {} not found".format(address))
+        return index
 
     def export_private_key(self, address, password):
         """ extended WIF format """
@@ -424,9 +550,12 @@ class Abstract_Wallet(PrintError):
             self.verified_tx.pop(tx_hash)
             if self.verifier:
                 self.verifier.merkle_roots.pop(tx_hash, None)
+            self._invalidate_history((tx_hash,))
 
         # tx will be verified only if height > 0
         if tx_hash not in self.verified_tx:
+            if self.unverified_tx.get(tx_hash) != tx_height:
+                self._invalidate_history((tx_hash,))
             self.unverified_tx[tx_hash] = tx_height
 
     def add_verified_tx(self, tx_hash, info):
@@ -434,9 +563,36 @@ class Abstract_Wallet(PrintError):
         self.unverified_tx.pop(tx_hash, None)
         with self.lock:
             self.verified_tx[tx_hash] = info  # (tx_height, timestamp, pos)
+            self._invalidate_addr_cache(self.tx_addr_hist.get(tx_hash, ()))
+            self._invalidate_history((tx_hash,))
         height, conf, timestamp = self.get_tx_height(tx_hash)
         self.network.trigger_callback('verified', tx_hash, height, conf, timestamp)
 
+    def get_spv_proof(self, tx_hash):
+        '''The (merkle root, block pos) a transaction was last proven to,
+        or None.'''
+        with self.lock:
+            merkle_root = self.spv_proof_roots.get(tx_hash)
+            if merkle_root is not None:
+                return merkle_root, self.spv_proofs[merkle_root][tx_hash]
+
+    def add_spv_proof(self, tx_hash, merkle_root, pos):
+        with self.lock:
+            self._remove_spv_proof(tx_hash)
+            txs = dict(self.spv_proofs.get(merkle_root, {}))
+            txs[tx_hash] = pos
+            self.spv_proofs[merkle_root] = txs
+            self.spv_proof_roots[tx_hash] = merkle_root
+
+    def _remove_spv_proof(self, tx_hash):
+        merkle_root = self.spv_proof_roots.pop(tx_hash, None)
+        if merkle_root is not None:
+            txs = {k: v for k, v in self.spv_proofs[merkle_root].items() if k != tx_hash}
+            if txs:
+                self.spv_proofs[merkle_root] = txs
+            else:
+                del self.spv_proofs[merkle_root]
+
     def get_unverified_txs(self):
         '''Returns a map from tx hash to transaction height'''
         return self.unverified_tx
@@ -452,7 +608,9 @@ class Abstract_Wallet(PrintError):
                     # fixme: use block hash, not timestamp
                     if not header or header.get('timestamp') != timestamp:
                         self.verified_tx.pop(tx_hash, None)
+                        self._remove_spv_proof(tx_hash)
                         txs.add(tx_hash)
+            self._invalidate_history(txs)
         return txs
 
     def get_local_height(self):
@@ -493,7 +651,7 @@ class Abstract_Wallet(PrintError):
         assert isinstance(address, Address)
         "effect of tx on address"
         # pruned
-        if tx_hash in self.pruned_txo.values():
+        if tx_hash in self.pruned_spends:
             return None
         delta = 0
         # substract the value of coins sent from address
@@ -508,7 +666,7 @@ class Abstract_Wallet(PrintError):
 
     def get_wallet_delta(self, tx):
         """ effect of tx on wallet """
-        addresses = self.get_addresses()
+        addresses = self.get_address_set()
         is_relevant = False
         is_mine = False
         is_pruned = False
@@ -603,35 +761,108 @@ class Abstract_Wallet(PrintError):
 
         return tx_hash, status, label, can_broadcast, amount, fee, height, conf, timestamp, exp_n
 
-    def get_addr_io(self, address):
+    def _reset_addr_cache(self):
+        with self.transaction_lock:
+            # address -> (received, sent, utxos, confirmed, unconfirmed, coinbase)
+            self._addr_cache = {}
+            # addresses with history that have no cache entry yet
+            self._addr_cache_dirty = set(self._history)
+            # address -> coinbase items, their maturity depends on local height
+            self._addr_cache_cb = {}
+            # sum of the confirmed/unconfirmed values of all cache entries
+            self._addr_cache_totals = [0, 0]
+
+    def _invalidate_addr_cache(self, addresses):
+        '''Drop the cache entries of addresses whose history, txi or txo
+        changed.  They are rebuilt on the next query.'''
+        with self.transaction_lock:
+            for address in addresses:
+                entry = self._addr_cache.pop(address, None)
+                if entry is not None:
+                    self._addr_cache_totals[0] -= entry[3]
+                    self._addr_cache_totals[1] -= entry[4]
+                    self._addr_cache_cb.pop(address, None)
+                self._addr_cache_dirty.add(address)
+
+    @staticmethod
+    def _coin_balance(tx_height, v, is_cb, spent_height, local_height):
+        '''Contribution of a received coin to the (confirmed, unconfirmed,
+        unmatured) balance of its address.'''
+        c = u = x = 0
+        if is_cb and tx_height + COINBASE_MATURITY > local_height:
+            x += v
+        elif tx_height > 0:
+            c += v
+        else:
+            u += v
+        if spent_height is not None:
+            if spent_height > 0:
+                c -= v
+            else:
+                u -= v
+        return c, u, x
+
+    def _build_addr_cache(self, address):
         h = self.get_address_history(address)
         received = {}
         sent = {}
         for tx_hash, height in h:
             l = self.txo.get(tx_hash, {}).get(address, [])
             for n, v, is_cb in l:
-                received[tx_hash + ':%d'%n] = (height, v, is_cb)
+                received[(tx_hash, n)] = (height, v, is_cb)
         for tx_hash, height in h:
             l = self.txi.get(tx_hash, {}).get(address, [])
             for txi, v in l:
                 sent[txi] = height
-        return received, sent
+                if txi in self.frozen_coins:
+                    # cleanup/detect if the 'frozen coin' was spent and remove it from the frozen coin set
+                    self.frozen_coins.discard(txi)
+        utxos = {}
+        c = u = 0
+        cb = []
+        for txo, item in received.items():
+            tx_height, v, is_cb = item
+            spent_height = sent.get(txo)
+            if spent_height is None:
+                utxos[txo] = item
+            if is_cb:
+                # evaluated at query time against the local height
+                cb.append((tx_height, v, is_cb, spent_height))
+            else:
+                dc, du, dx = self._coin_balance(tx_height, v, is_cb, spent_height, 0)
+                c += dc
+                u += du
+        return received, sent, utxos, c, u, tuple(cb)
+
+    def _get_addr_cache(self, address):
+        '''Returns the cache entry of address, building it if needed.  The
+        returned dicts are shared and must not be modified.'''
+        with self.transaction_lock:
+            entry = self._addr_cache.get(address)
+            if entry is None:
+                entry = self._build_addr_cache(address)
+                self._addr_cache[address] = entry
+                self._addr_cache_dirty.discard(address)
+                self._addr_cache_totals[0] += entry[3]
+                self._addr_cache_totals[1] += entry[4]
+                if entry[5]:
+                    self._addr_cache_cb[address] = entry[5]
+            return entry
+
+    def get_addr_io(self, address):
+        received, sent, utxos, c, u, cb = self._get_addr_cache(address)
+        return dict(received), dict(sent)
 
     def get_addr_utxo(self, address):
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
-            if txi in self.frozen_coins:
-                # cleanup/detect if the 'frozen coin' was spent and remove it from the frozen coin set
-                self.frozen_coins.remove(txi)
+        received, sent, utxos, c, u, cb = self._get_addr_cache(address)
         out = {}
-        for txo, v in coins.items():
+        for txo, v in utxos.items():
             tx_height, value, is_cb = v
-            prevout_hash, prevout_n = txo.split(':')
+            prevout_hash, prevout_n = txo
             x = {
                 'address':address,
                 'value':value,
-                'prevout_n':int(prevout_n),
+                'prevout_n':prevout_n,
                 'prevout_hash':prevout_hash,
                 'height':tx_height,
                 'coinbase':is_cb,
@@ -642,29 +873,52 @@ class Abstract_Wallet(PrintError):
 
     # return the total amount ever received by an address
     def get_addr_received(self, address):
-        received, sent = self.get_addr_io(address)
+        received, sent, utxos, c, u, cb = self._get_addr_cache(address)
         return sum([v for height, v, is_cb in received.values()])
 
+    def _frozen_coins_balance(self, local_height, domain=None):
+        '''Balance held in frozen coins of the addresses in domain (a set),
+        or of all addresses if domain is None.'''
+        cc = uu = xx = 0
+        for txo in list(self.frozen_coins):
+            prevout_hash, prevout_n = txo
+            for addr, l in self.txo.get(prevout_hash, {}).items():
+                if domain is not None and addr not in domain:
+                    continue
+                if any(n == prevout_n for n, v, is_cb in l):
+                    break
+            else:
+                continue
+            received, sent, utxos, c, u, cb = self._get_addr_cache(addr)
+            item = received.get(txo)
+            if item is None:
+                continue
+            c, u, x = self._coin_balance(*item, sent.get(txo), local_height)
+            cc += c
+            uu += u
+            xx += x
+        return cc, uu, xx
+
     # return the balance of a bitcoin address: confirmed and matured, unconfirmed, unmatured
     # Note that 'exclude_frozen_coins = True' only checks for coin-level freezing, not address-level.
     def get_addr_balance(self, address, exclude_frozen_coins = False):
         assert isinstance(address, Address)
-        received, sent = self.get_addr_io(address)
-        c = u = x = 0
-        for txo, (tx_height, v, is_cb) in received.items():
-            if exclude_frozen_coins and txo in self.frozen_coins:
-                continue
-            if is_cb and tx_height + COINBASE_MATURITY > self.get_local_height():
-                x += v
-            elif tx_height > 0:
-                c += v
-            else:
-                u += v
-            if txo in sent:
-                if sent[txo] > 0:
-                    c -= v
-                else:
-                    u -= v
+        local_height = self.get_local_height()
+        received, sent, utxos, c, u, cb = self._get_addr_cache(address)
+        x = 0
+        for item in cb:
+            dc, du, dx = self._coin_balance(*item, local_height)
+            c += dc
+            u += du
+            x += dx
+        if exclude_frozen_coins and self.frozen_coins:
+            for txo in list(self.frozen_coins):
+                item = received.get(txo)
+                if item is not None:
+                    dc, du, dx = self._coin_balance(*item, sent.get(txo), local_height)
+                    c -= dc
+                    u -= du
+                    x -= dx
         return c, u, x
 
     def get_spendable_coins(self, domain, config, isInvoice = False):
@@ -681,6 +935,8 @@ class Abstract_Wallet(PrintError):
         if exclude_frozen:
             domain = set(domain) - self.frozen_addresses
         for addr in domain:
+            if not self._get_addr_cache(addr)[2]:
+                continue
             utxos = self.get_addr_utxo(addr)
             for x in utxos.values():
                 if exclude_frozen and x['is_frozen_coin']:
@@ -709,33 +965,86 @@ class Abstract_Wallet(PrintError):
         return (cc_all-cc_no_f), (uu_all-uu_no_f), (xx_all-xx_no_f)
 
     def get_balance(self, domain=None, exclude_frozen_coins=False, exclude_frozen_addresses=False):
-        if domain is None:
-            domain = self.get_addresses()
-        if exclude_frozen_addresses:
-            domain = set(domain) - self.frozen_addresses
-        cc = uu = xx = 0
-        for addr in domain:
-            c, u, x = self.get_addr_balance(addr, exclude_frozen_coins)
-            cc += c
-            uu += u
-            xx += x
+        if domain is not None:
+            if exclude_frozen_addresses:
+                domain = set(domain) - self.frozen_addresses
+            cc = uu = xx = 0
+            for addr in domain:
+                c, u, x = self.get_addr_balance(addr, exclude_frozen_coins)
+                cc += c
+                uu += u
+                xx += x
+            return cc, uu, xx
+        # Whole wallet: use the running totals, only the addresses that
+        # changed since the last query need to be rebuilt.
+        local_height = self.get_local_height()
+        with self.transaction_lock:
+            for addr in list(self._addr_cache_dirty):
+                self._get_addr_cache(addr)
+            cc, uu = self._addr_cache_totals
+            xx = 0
+            for cb in self._addr_cache_cb.values():
+                for item in cb:
+                    c, u, x = self._coin_balance(*item, local_height)
+                    cc += c
+                    uu += u
+                    xx += x
+            if exclude_frozen_addresses:
+                for addr in self.frozen_addresses:
+                    c, u, x = self.get_addr_balance(addr)
+                    cc -= c
+                    uu -= u
+                    xx -= x
+            if exclude_frozen_coins and self.frozen_coins:
+                if exclude_frozen_addresses:
+                    domain = set(self._addr_cache) - self.frozen_addresses
+                c, u, x = self._frozen_coins_balance(local_height, domain)
+                cc -= c
+                uu -= u
+                xx -= x
         return cc, uu, xx
 
     def get_address_history(self, address):
         assert isinstance(address, Address)
         return self._history.get(address, [])
 
+    def get_address_status(self, address):
+        '''The status hash of the address history, as a server announces
+        it, or None if the history is empty.  Computed once and then kept
+        until the history changes.'''
+        with self.lock:
+            status = self._status.get(address)
+            if status is None and address in self._history:
+                status = Synchronizer.get_status(self._history[address])
+                if status is not None:
+                    self._status[address] = status
+            return status
+
+    def get_address_activity(self, address):
+        '''The height of the last transaction of the address, for the
+        most recently active addresses to be synchronized first.
+        Unconfirmed transactions count as the most recent; an address
+        without history sorts last.'''
+        hist = self._history.get(address)
+        if not hist:
+            return -1
+        height = hist[-1][1]
+        return height if height > 0 else float('inf')
+
     def add_transaction(self, tx_hash, tx):
         is_coinbase = tx.inputs()[0]['type'] == 'coinbase'
         with self.transaction_lock:
+            # addresses whose balance may change
+            touched = set(self.txi.get(tx_hash, ())) | set(self.txo.get(tx_hash, ()))
             # add inputs
+            self._discard_txi_spender(tx_hash, self.txi.get(tx_hash, {}))
             self.txi[tx_hash] = d = {}
             for txi in tx.inputs():
                 addr = txi.get('address')
                 if txi['type'] != 'coinbase':
                     prevout_hash = txi['prevout_hash']
                     prevout_n = txi['prevout_n']
-                    ser = prevout_hash + ':%d'%prevout_n
+                    ser = (prevout_hash, prevout_n)
                 # find value from prev output
                 if self.is_mine(addr):
                     dd = self.txo.get(prevout_hash, {})
@@ -744,27 +1053,34 @@ class Abstract_Wallet(PrintError):
                             if d.get(addr) is None:
                                 d[addr] = []
                             d[addr].append((ser, v))
+                            self.txi_spenders.setdefault(prevout_hash, set()).add(tx_hash)
                             break
                     else:
-                        self.pruned_txo[ser] = tx_hash
+                        self._add_pruned_txo(ser, tx_hash)
+            touched.update(d)
 
             # add outputs
             self.txo[tx_hash] = d = {}
             for n, txo in enumerate(tx.outputs()):
-                ser = tx_hash + ':%d'%n
+                ser = (tx_hash, n)
                 _type, addr, v = txo
                 if self.is_mine(addr):
                     if not addr in d:
                         d[addr] = []
                     d[addr].append((n, v, is_coinbase))
                 # give v to txi that spends me
-                next_tx = self.pruned_txo.get(ser)
+                next_tx = self._pop_pruned_txo(ser)
                 if next_tx is not None:
-                    self.pruned_txo.pop(ser)
                     dd = self.txi.get(next_tx, {})
                     if dd.get(addr) is None:
                         dd[addr] = []
                     dd[addr].append((ser, v))
+                    self.txi_spenders.setdefault(tx_hash, set()).add(next_tx)
+                    touched.add(addr)
+                    self._invalidate_history((next_tx,))
+            touched.update(d)
+            self._invalidate_addr_cache(touched)
+            self._invalidate_history((tx_hash,))
             # save
             self.transactions[tx_hash] = tx
 
@@ -772,36 +1088,47 @@ class Abstract_Wallet(PrintError):
         with self.transaction_lock:
             self.print_error("removing tx from history", tx_hash)
             #tx = self.transactions.pop(tx_hash)
-            for ser, hh in list(self.pruned_txo.items()):
-                if hh == tx_hash:
-                    self.pruned_txo.pop(ser)
+            touched = set(self.txi.get(tx_hash, ())) | set(self.txo.get(tx_hash, ()))
+            for ser in list(self.pruned_spends.get(tx_hash, ())):
+                self._pop_pruned_txo(ser)
             # add tx to pruned_txo, and undo the txi addition
-            for next_tx, dd in self.txi.items():
+            for next_tx in self.txi_spenders.pop(tx_hash, ()):
+                dd = self.txi.get(next_tx, {})
                 for addr, l in list(dd.items()):
                     ll = l[:]
                     for item in ll:
                         ser, v = item
-                        prev_hash, prev_n = ser.split(':')
-                        if prev_hash == tx_hash:
+                        if ser[0] == tx_hash:
                             l.remove(item)
-                            self.pruned_txo[ser] = next_tx
+                            self._add_pruned_txo(ser, next_tx)
+                            touched.add(addr)
+                            self._invalidate_history((next_tx,))
                     if l == []:
                         dd.pop(addr)
                     else:
                         dd[addr] = l
+            self._discard_txi_spender(tx_hash, self.txi.get(tx_hash, {}))
             try:
                 self.txi.pop(tx_hash)
                 self.txo.pop(tx_hash)
             except KeyError:
                 self.print_error("tx was not in history", tx_hash)
+            self._invalidate_addr_cache(touched)
+            self._invalidate_history((tx_hash,))
+        with self.lock:
+            self._remove_spv_proof(tx_hash)
 
     def receive_tx_callback(self, tx_hash, tx, tx_height):
         self.add_transaction(tx_hash, tx)
         self.add_unverified_tx(tx_hash, tx_height)
 
-    def receive_history_callback(self, addr, hist, tx_fees):
+    def receive_history_callback(self, addr, hist, tx_fees, status=None):
+        '''status is the status hash of hist, if already known.'''
         with self.lock:
             old_hist = self.get_address_history(addr)
+            # stored histories are lists of lists
+            changed = set(map(tuple, old_hist)).symmetric_difference(map(tuple, hist))
+            self._invalidate_history(tx_hash for tx_hash, height in changed)
             for tx_hash, height in old_hist:
                 if (tx_hash, height) not in hist:
                     # remove tx if it's not referenced in histories
@@ -809,6 +1136,12 @@ class Abstract_Wallet(PrintError):
                     if not self.tx_addr_hist[tx_hash]:
                         self.remove_transaction(tx_hash)
             self._history[addr] = hist
+            if status is None:
+                self._status.pop(addr, None)
+            else:
+                self._status[addr] = status
+            # heights may have changed even if the txs did not
+            self._invalidate_addr_cache((addr,))
 
         for tx_hash, tx_height in hist:
             # add it in case it was previously unconfirmed
@@ -828,10 +1161,113 @@ class Abstract_Wallet(PrintError):
         if self.network:
             self.network.trigger_callback('on_history')
 
-    def get_history(self, domain=None):
-        # get domain
-        if domain is None:
-            domain = self.get_addresses()
+    def _reset_history_index(self):
+        with self.lock:
+            # sorted list of (txpos, tx_hash) of the whole wallet history
+            self._hist_keys = []
+            # tx_hash -> (key in _hist_keys, wallet delta)
+            self._hist_deltas = {}
+            # prefix sums of the deltas, as (sum, index of last None delta);
+            # entries past _hist_prefix_valid need to be recomputed
+            self._hist_prefix = []
+            self._hist_prefix_valid = 0
+            # txs whose delta or position may have changed
+            self._hist_dirty = set(self.tx_addr_hist)
+
+    def _invalidate_history(self, tx_hashes):
+        '''Mark txs whose delta or position in the history changed.'''
+        self._hist_dirty.update(tx_hashes)
+
+    def _get_history_delta(self, tx_hash, addresses):
+        delta = 0
+        for addr in addresses:
+            d = self.get_tx_delta(tx_hash, addr)
+            if d is None:
+                return None
+            delta += d
+        return delta
+
+    def _update_history_index(self):
+        '''Move the dirty txs to their (possibly new) place in the index.
+        Only the running balances after the first changed position need
+        to be recomputed.'''
+        keys = self._hist_keys
+        first = self._hist_prefix_valid
+        while self._hist_dirty:
+            tx_hash = self._hist_dirty.pop()
+            old = self._hist_deltas.pop(tx_hash, None)
+            if old is not None:
+                i = bisect.bisect_left(keys, old[0])
+                del keys[i]
+                first = min(first, i)
+            # skip addresses that were deleted from the wallet
+            addresses = [addr for addr in self.tx_addr_hist.get(tx_hash, ())
+                         if addr in self._history]
+            if not addresses:
+                continue
+            key = (self.get_txpos(tx_hash), tx_hash)
+            delta = self._get_history_delta(tx_hash, addresses)
+            i = bisect.bisect_left(keys, key)
+            keys.insert(i, key)
+            self._hist_deltas[tx_hash] = (key, delta)
+            first = min(first, i)
+        del self._hist_prefix[first:]
+        self._hist_prefix_valid = first
+
+    def _get_history_prefix(self):
+        prefix = self._hist_prefix
+        keys = self._hist_keys
+        i = self._hist_prefix_valid
+        total, last_none = prefix[i - 1] if i else (0, -1)
+        for key in keys[i:]:
+            delta = self._hist_deltas[key[1]][1]
+            if delta is None:
+                last_none = i
+            else:
+                total += delta
+            prefix.append((total, last_none))
+            i += 1
+        self._hist_prefix_valid = i
+        return prefix
+
+    def get_history(self, domain=None, offset=0, limit=None):
+        '''Returns the history sorted by position in the blockchain, as
+        (tx_hash, height, conf, timestamp, delta, balance) tuples.  offset
+        and limit select a slice of it.  The history of the whole wallet
+        (domain=None) is served from an index that is kept up to date as
+        transactions are added, verified or removed.'''
+        if domain is not None:
+            return self._get_domain_history(domain)[offset:None if limit is None else offset + limit]
+        with self.lock, self.transaction_lock:
+            c, u, x = self.get_balance()
+            self._update_history_index()
+            n = len(self._hist_keys)
+            end = n if limit is None else min(n, offset + limit)
+            prefix = self._get_history_prefix()
+            if not n:
+                return []
+            # anchor the running balance on the current balance
+            last_total, last_none = prefix[n - 1]
+            offset_balance = c + u + x - last_total
+            h = []
+            for i in range(offset, end):
+                tx_hash = self._hist_keys[i][1]
+                delta = self._hist_deltas[tx_hash][1]
+                height, conf, timestamp = self.get_tx_height(tx_hash)
+                if i < last_none:
+                    balance = None
+                else:
+                    balance = prefix[i][0] + offset_balance
+                h.append((tx_hash, height, conf, timestamp, delta, balance))
+            return h
+
+    def get_history_len(self):
+        '''Number of txs in the history of the whole wallet.'''
+        with self.lock, self.transaction_lock:
+            self._update_history_index()
+            return len(self._hist_keys)
+
+    def _get_domain_history(self, domain):
         # 1. Get the history of each address in the domain, maintain the
         #    delta of a tx as the sum of its deltas on domain addresses
         tx_deltas = defaultdict(int)
@@ -1007,7 +1443,7 @@ class Abstract_Wallet(PrintError):
         if i_max is None:
             # Let the coin chooser select the coins to spend
             max_change = self.max_change_outputs if self.multiple_change else 1
-            coin_chooser = coinchooser.CoinChooserPrivacy()
+            coin_chooser = coinchooser.get_coin_chooser(config)
             tx = coin_chooser.make_tx(inputs, outputs, change_addrs[:max_change],
                                       fee_estimator, self.dust_threshold())
         else:
@@ -1038,6 +1474,77 @@ class Abstract_Wallet(PrintError):
         run_hook('make_unsigned_transaction', self, tx)
         return tx
 
+    def make_payout_transactions(self, inputs, outputs, config, fixed_fee=None,
+                                 change_addr=None, max_size=transaction.MAX_STANDARD_TX_SIZE):
+        '''Pays outputs, an iterable of (type, address, amount) tuples too
+        long for a single transaction, in as few transactions of at most
+        max_size bytes as the inputs allow.  Outputs are read as they are
+        needed, and the unsigned transactions are yielded as they are made,
+        each spending coins the previous ones did not.  A fixed fee is paid
+        by each transaction.  Unless change_addr is given, each transaction
+        sends its change to an unused change address of its own.
+
+        Yields (transaction, number of outputs it pays).  NotEnoughFunds is
+        raised once the inputs run out, after the transactions they
+        could pay for.'''
+        outputs = iter(outputs)
+        pending = deque()
+        coins = list(inputs)
+        # Change addresses taken by the previous transactions
+        taken = set()
+        def next_change_addr():
+            if change_addr or not self.use_change or not self.get_change_addresses():
+                return change_addr
+            for addr in self.get_change_addresses():
+                if addr not in taken and self.get_num_tx(addr) == 0:
+                    return addr
+            if self.is_deterministic():
+                return self.create_new_address(for_change=True)
+        # Room kept for the inputs, as many as the previous transaction used
+        inputs_size = 0
+        while True:
+            tx_change_addr = next_change_addr()
+            if tx_change_addr is None:
+                max_change = self.max_change_outputs if self.multiple_change else 1
+            else:
+                max_change = 1
+            # Version, locktime, input and output counts, and change
+            size = 14 + inputs_size + 34 * max_change
+            chunk = []
+            while True:
+                if not pending:
+                    output = next(outputs, None)
+                    if output is None:
+                        break
+                    if output[2] == '!':
+                        raise BaseException("Cannot spend max in a payout")
+                    pending.append(output)
+                output_size = Transaction.estimated_output_size(pending[0])
+                if chunk and size + output_size > max_size:
+                    break
+                chunk.append(pending.popleft())
+                size += output_size
+            if not chunk:
+                return
+            while True:
+                tx = self.make_unsigned_transaction(coins, chunk, config, fixed_fee, tx_change_addr)
+                excess = tx.estimated_size() - max_size
+                if excess <= 0:
+                    break
+                if len(chunk) == 1:
+                    raise BaseException(_("Transaction larger than {} bytes").format(max_size))
+                # Fewer outputs need fewer inputs, so this converges
+                while excess > 0 and len(chunk) > 1:
+                    output = chunk.pop()
+                    pending.appendleft(output)
+                    excess -= Transaction.estimated_output_size(output)
+            inputs_size = sum(map(Transaction.estimated_input_size, tx.inputs()))
+            spent = set((txin['prevout_hash'], txin['prevout_n']) for txin in tx.inputs())
+            coins = [coin for coin in coins
+                     if (coin['prevout_hash'], coin['prevout_n']) not in spent]
+            taken.update(o[1] for o in tx.outputs())
+            yield tx, len(chunk)
+
     def mktx(self, outputs, password, config, fee=None, change_addr=None, domain=None):
         coins = self.get_spendable_coins(domain, config)
         tx = self.make_unsigned_transaction(coins, outputs, config, fee, change_addr)
@@ -1050,15 +1557,17 @@ class Abstract_Wallet(PrintError):
         return addr in self.frozen_addresses
 
     def is_frozen_coin(self, utxo):
-        ''' 'coin' level frozen query. `utxo' is a prevout:n string, or a dict as returned from get_utxos().
+        ''' 'coin' level frozen query. `utxo' is a prevout:n string, an outpoint tuple, or a dict as returned from get_utxos().
             Note: this is set/unset independent of 'address' level freezing. '''
-        assert isinstance(utxo, (str, dict))
+        assert isinstance(utxo, (str, tuple, dict))
         if isinstance(utxo, dict):
-            ret = ("{}:{}".format(utxo['prevout_hash'], utxo['prevout_n'])) in self.frozen_coins
+            ret = (utxo['prevout_hash'], utxo['prevout_n']) in self.frozen_coins
             if ret != utxo['is_frozen_coin']:
                 self.print_error("*** WARNING: utxo has stale is_frozen_coin flag")
                 utxo['is_frozen_coin'] = ret # update stale flag
             return ret
+        if isinstance(utxo, str):
+            utxo = outpoint_from_string(utxo)
         return utxo in self.frozen_coins
 
     def set_frozen_state(self, addrs, freeze):
@@ -1078,20 +1587,22 @@ class Abstract_Wallet(PrintError):
 
     def set_frozen_coin_state(self, utxos, freeze):
         ''' Set frozen state of the COINS to FREEZE, True or False.
-            utxos is a (possibly mixed) list of either "prevout:n" strings and/or coin-dicts as returned from get_utxos().
-            Note that if passing prevout:n strings as input, 'is_mine()' status is not checked for the specified coin.
+            utxos is a (possibly mixed) list of "prevout:n" strings, (prevout, n) outpoints and/or coin-dicts as returned from get_utxos().
+            Note that if passing prevout:n strings or outpoints as input, 'is_mine()' status is not checked for the specified coin.
             Also note that coin-level freezing is set/unset independent of address-level freezing, however both must
             be satisfied for a coin to be defined as spendable. '''
         ok = 0
         for utxo in utxos:
-            if isinstance(utxo, str):
+            if isinstance(utxo, (str, tuple)):
+                if isinstance(utxo, str):
+                    utxo = outpoint_from_string(utxo)
                 if freeze:
                     self.frozen_coins |= { utxo }
                 else:
                     self.frozen_coins -= { utxo }
                 ok += 1
             elif isinstance(utxo, dict) and self.is_mine(utxo['address']):
-                txo = "{}:{}".format(utxo['prevout_hash'], utxo['prevout_n'])
+                txo = (utxo['prevout_hash'], utxo['prevout_n'])
                 if freeze:
                     self.frozen_coins |= { txo }
                 else:
@@ -1099,7 +1610,7 @@ class Abstract_Wallet(PrintError):
                 utxo['is_frozen_coin'] = bool(freeze)
                 ok += 1
         if ok:
-            self.storage.put('frozen_coins', list(self.frozen_coins))
+            self.storage.put('frozen_coins', [outpoint_to_string(txo) for txo in self.frozen_coins])
         return ok
 
     def prepare_for_verifier(self):
@@ -1139,7 +1650,7 @@ class Abstract_Wallet(PrintError):
             self.storage.put('stored_height', self.get_local_height())
         self.save_transactions()
         self.save_verified_tx()
-        self.storage.write()
+        self.storage.compact()
 
     def wait_until_synchronized(self, callback=None):
         def wait_for_wallet():
@@ -1196,7 +1707,7 @@ class Abstract_Wallet(PrintError):
         else:
             return
         coins = self.get_addr_utxo(address)
-        item = coins.get(txid+':%d'%i)
+        item = coins.get((txid, i))
         if not item:
             return
         self.add_input_info(item)
@@ -1212,7 +1723,7 @@ class Abstract_Wallet(PrintError):
             txin['type'] = self.get_txin_type(address)
             # Bitcoin Cash needs value to sign
             received, spent = self.get_addr_io(address)
-            item = received.get(txin['prevout_hash']+':%d'%txin['prevout_n'])
+            item = received.get((txin['prevout_hash'], txin['prevout_n']))
             tx_height, value, is_cb = item
             txin['value'] = value
             self.add_input_sig_info(txin, address)
@@ -1316,7 +1827,7 @@ class Abstract_Wallet(PrintError):
         l = []
         for txo, x in received.items():
             h, v, is_cb = x
-            txid, n = txo.split(':')
+            txid, n = txo
             info = self.verified_tx.get(txid)
             if info:
                 tx_height, timestamp, pos = info
@@ -1586,7 +2097,7 @@ class ImportedWalletBase(Simple_Wallet):
 
     def delete_address(self, address):
         assert isinstance(address, Address)
-        if address not in self.get_addresses():
+        if not self.is_mine(address):
             return
 
         transactions_to_remove = set()  # only referred to by this address
@@ -1600,7 +2111,10 @@ class ImportedWalletBase(Simple_Wallet):
                     for tx_hash, height in details:
                         transactions_new.add(tx_hash)
             transactions_to_remove -= transactions_new
-            self._history.pop(address, None)
+            hist = self._history.pop(address, [])
+            self._status.pop(address, None)
+            self._invalidate_addr_cache((address,))
+            self._invalidate_history(tx_hash for tx_hash, height in hist)
 
             for tx_hash in transactions_to_remove:
                 self.remove_transaction(tx_hash)
@@ -1610,7 +2124,8 @@ class ImportedWalletBase(Simple_Wallet):
                 self.transactions.pop(tx_hash, None)
                 # FIXME: what about pruned_txo?
 
-            self.storage.put('verified_tx3', self.verified_tx)
+            self.storage.put_nocopy('verified_tx3', dict(self.verified_tx))
+            self.storage.put_nocopy('spv_proofs', dict(self.spv_proofs))
             
         self.save_transactions()
 
@@ -1619,6 +2134,7 @@ class ImportedWalletBase(Simple_Wallet):
         self.set_frozen_state([address], False)
 
         self.delete_address_derived(address)
+        self._addr_index.pop(address, None)
         self.save_addresses()
 
 
@@ -1662,6 +2178,11 @@ class ImportedAddressWallet(ImportedWalletBase):
                                        for addr in self.addresses])
         self.storage.write()
 
+    def _build_address_index(self):
+        # In import order, rather than sorting them as get_addresses() does
+        self._addr_index = {addr: (False, i)
+                            for i, addr in enumerate(self.addresses)}
+
     def can_change_password(self):
         return False
 
@@ -1679,6 +2200,7 @@ class ImportedAddressWallet(ImportedWalletBase):
         if address in self.addresses:
             return False
         self.addresses.append(address)
+        self._addr_index[address] = (False, len(self._addr_index))
         self.save_addresses()
         self.storage.write()
         self.add_address(address)
@@ -1744,6 +2266,10 @@ class ImportedPrivkeyWallet(ImportedWalletBase):
     def get_addresses(self, include_change=False):
         return self.keystore.get_addresses()
 
+    def _build_address_index(self):
+        self._addr_index = {pubkey.address: (False, i)
+                            for i, pubkey in enumerate(self.keystore.keypairs)}
+
     def delete_address_derived(self, address):
         self.keystore.remove_address(address)
         self.save_keystore()
@@ -1756,6 +2282,7 @@ class ImportedPrivkeyWallet(ImportedWalletBase):
 
     def import_private_key(self, sec, pw):
         pubkey = self.keystore.import_privkey(sec, pw)
+        self._addr_index.setdefault(pubkey.address, (False, len(self._addr_index)))
         self.save_keystore()
         self.storage.write()
         return pubkey.address.to_ui_string()
@@ -1810,6 +2337,7 @@ class Deterministic_Wallet(Abstract_Wallet):
             k = self.num_unused_trailing_addresses(addresses)
             n = len(addresses) - k + value
             self.receiving_addresses = self.receiving_addresses[0:n]
+            self._build_address_index()
             self.gap_limit = value
             self.storage.put('gap_limit', self.gap_limit)
             self.save_addresses()
@@ -1840,28 +2368,38 @@ class Deterministic_Wallet(Abstract_Wallet):
         return nmax + 1
 
     def create_new_address(self, for_change=False):
+        return self.create_new_addresses(for_change, 1)[0]
+
+    def create_new_addresses(self, for_change, count):
+        '''Derive the next count addresses of a branch, saving them once.'''
         assert type(for_change) is bool
         with self.lock:
             addr_list = self.change_addresses if for_change else self.receiving_addresses
             n = len(addr_list)
-            x = self.derive_pubkeys(for_change, n)
-            address = self.pubkeys_to_address(x)
-            addr_list.append(address)
+            addresses = [self.pubkeys_to_address(x)
+                         for x in self.derive_pubkeys_batch(for_change, n, count)]
+            addr_list.extend(addresses)
+            self._addr_index.update((addr, (for_change, n + i))
+                                    for i, addr in enumerate(addresses))
             self.save_addresses()
-            self.add_address(address)
-            return address
+            for address in addresses:
+                self.add_address(address)
+            return addresses
 
     def synchronize_sequence(self, for_change):
         limit = self.gap_limit_for_change if for_change else self.gap_limit
-        while True:
+        addresses = self.get_change_addresses() if for_change else self.get_receiving_addresses()
+        if len(addresses) < limit:
+            self.create_new_addresses(for_change, limit - len(addresses))
             addresses = self.get_change_addresses() if for_change else self.get_receiving_addresses()
-            if len(addresses) < limit:
-                self.create_new_address(for_change)
-                continue
-            if list(map(lambda a: self.address_is_old(a), addresses[-limit:] )) == limit*[False]:
+        # Extend the branch until its last `limit` addresses are all
+        # unused; new addresses have no history, so everything after the
+        # last old address in the window counts.
+        window = addresses[-limit:]
+        for i in range(len(window) - 1, -1, -1):
+            if self.address_is_old(window[i]):
+                self.create_new_addresses(for_change, i + 1)
                 break
-            else:
-                self.create_new_address(for_change)
 
     def synchronize(self):
         with self.lock:
@@ -1932,6 +2470,9 @@ class Simple_Deterministic_Wallet(Simple_Wallet, Deterministic_Wallet):
     def derive_pubkeys(self, c, i):
         return self.keystore.derive_pubkey(c, i)
 
+    def derive_pubkeys_batch(self, c, i, count):
+        return self.keystore.derive_pubkeys(c, i, count)
+
 
 
 
@@ -1967,6 +2508,10 @@ class Multisig_Wallet(Deterministic_Wallet):
     def derive_pubkeys(self, c, i):
         return [k.derive_pubkey(c, i) for k in self.get_keystores()]
 
+    def derive_pubkeys_batch(self, c, i, count):
+        return [list(x) for x in zip(*[k.derive_pubkeys(c, i, count)
+                                       for k in self.get_keystores()])]
+
     def load_keystore(self):
         self.keystores = {}
         for i in range(self.n):
@@ -1,7 +1,8 @@
-import select, time, queue
+import asyncio, json, select, threading, time, queue
 from electroncash import Connection, Interface, SimpleConfig
 
-from electroncash.network import parse_servers
+from electroncash.network import Network, parse_servers
+from electroncash.networks import NetworkConstants
 from collections import defaultdict
 
 # electrum.util.set_verbosity(1)
@@ -80,3 +81,112 @@ def send_request(peers, method, params):
     results = dict(zip(responses.keys(), [t[0][1].get('result') for t in responses.values()]))
     print("%d answers"%len(results))
     return results
+
+
+class StubServer(asyncio.Protocol):
+    '''A local stand-in for an ElectrumX server for benchmarks.  Answers
+    the requests a Network makes on connecting and scripthash and
+    transaction requests, singly or in batches.  Requests take 'cost'
+    seconds each to serve, one at a time, and responses arrive 'latency'
+    seconds later.  Pushes scripthash notifications when asked to.  A
+    corrupt server sends transactions with their bytes reversed.'''
+
+    latency = 0
+    cost = 0
+    results = {
+        'server.version': ['ElectrumX stub', '1.4'],
+        'server.banner': '',
+        'server.donation_address': '',
+        'server.peers.subscribe': [],
+        'server.ping': None,
+        'blockchain.relayfee': 0.00001,
+        'blockchain.estimatefee': 0.00001,
+        'blockchain.headers.subscribe': {
+            'hex': '00' * 80,
+            'height': NetworkConstants.VERIFICATION_BLOCK_HEIGHT + 10,
+        },
+        'blockchain.scripthash.subscribe': None,
+        'blockchain.scripthash.get_history': [],
+    }
+    transactions = {}   # txid -> raw transaction hex
+    clients = []
+    sent = {}
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.busy_until = 0
+        self.corrupt = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.buf = b''
+        self.clients.append(self)
+
+    def data_received(self, data):
+        self.buf += data
+        while b'\n' in self.buf:
+            line, self.buf = self.buf.split(b'\n', 1)
+            message = json.loads(line.decode())
+            if type(message) is list:
+                response = [self.answer(request) for request in message]
+            else:
+                response = [self.answer(message)]
+            if not self.latency and not self.cost:
+                self.write(response if type(message) is list else response[0])
+                continue
+            self.busy_until = max(self.loop.time(), self.busy_until) + self.cost * len(response)
+            self.loop.call_at(self.busy_until + self.latency, self.write,
+                              response if type(message) is list else response[0])
+
+    def answer(self, request):
+        response = {'jsonrpc': '2.0', 'id': request['id']}
+        method, params = request['method'], request['params']
+        if method in self.results:
+            response['result'] = self.results[method]
+        elif method == 'blockchain.transaction.get' and params[0] in self.transactions:
+            response['result'] = self.transactions[params[0]]
+            if self.corrupt:
+                response['result'] = response['result'][::-1]
+        else:
+            response['error'] = {'code': -32601, 'message': 'unsupported'}
+        return response
+
+    def write(self, message):
+        if not self.transport.is_closing():
+            self.transport.write(json.dumps(message).encode() + b'\n')
+
+    def notify(self, scripthash, status):
+        self.sent[status] = time.perf_counter()
+        self.write({'jsonrpc': '2.0', 'method': 'blockchain.scripthash.subscribe',
+                    'params': [scripthash, status]})
+
+
+def start_stub_server(host='127.0.0.1'):
+    '''Runs a StubServer in a thread; returns its server string'''
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(
+        loop.create_server(lambda: StubServer(loop), host, 0))
+    port = server.sockets[0].getsockname()[1]
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return '%s:%d:t' % (host, port)
+
+
+def start_stub_network(servers, path, **options):
+    '''Returns a started Network connected to the given stub servers, the
+    first being the main one, and the StubServers serving it.'''
+    clients = len(StubServer.clients)
+    NetworkConstants.DEFAULT_SERVERS = {}
+    for server in servers[1:]:
+        host, port, protocol = server.split(':')
+        NetworkConstants.DEFAULT_SERVERS[host] = {'t': port}
+    options.update({'electron_cash_path': path, 'server': servers[0],
+                    'oneserver': len(servers) == 1, 'auto_connect': False})
+    network = Network(SimpleConfig(options))
+    network.start()
+    deadline = time.time() + 10
+    while (not network.is_connected() or len(network.get_interfaces()) < len(servers)
+           or len(StubServer.clients) < clients + len(servers)):
+        if time.time() > deadline:
+            raise Exception('could not connect to the stub servers')
+        time.sleep(0.01)
+    return network, StubServer.clients[clients:]